@@ -145,3 +145,45 @@ CORS_ALLOWED_ORIGINS = env.list("CORS_ALLOWED_ORIGINS")
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+
+# Paginació i streaming de l'API
+API_PAGE_SIZE = env.int("API_PAGE_SIZE", default=50)
+API_MAX_PAGE_SIZE = env.int("API_MAX_PAGE_SIZE", default=500)
+API_STREAM_CHUNK_SIZE = env.int("API_STREAM_CHUNK_SIZE", default=2000)
+
+# Cerca al catàleg (biblioteca/cerca.py). El backend es detecta segons la base
+# de dades: "fts5" a SQLite, "termes" a la resta. Es pot forçar amb:
+# CERCA_BACKEND = "termes"
+CERCA_MAX_RESULTATS = env.int("CERCA_MAX_RESULTATS", default=500)
+
+# Segons abans de reconstruir els índexs d'autocompletat de cada procés
+AUTOCOMPLETE_TTL = env.int("AUTOCOMPLETE_TTL", default=300)
+# Segons abans de reconstruir l'índex de facetes de cada procés (biblioteca/facetes.py)
+FACETES_TTL = env.int("FACETES_TTL", default=900)
+
+# Caches. "api" guarda les respostes de lectura del catàleg (biblioteca/cache_api.py).
+# Backends: locmemcache://nom (memòria del procés, LRU), filecache:///ruta
+# o rediscache://host:6379/1.
+CACHES = {
+    'default': env.cache('CACHE_URL', default='locmemcache://'),
+    'api': env.cache('API_CACHE_URL', default='locmemcache://api'),
+}
+if 'redis' not in CACHES['api']['BACKEND']:
+    CACHES['api'].setdefault('OPTIONS', {})['MAX_ENTRIES'] = env.int('API_CACHE_MAX_ENTRIES', default=5000)
+API_CACHE_TIMEOUT = env.int("API_CACHE_TIMEOUT", default=300)
+
+# Tokens Bearer de l'API (biblioteca/tokens.py), en segons
+API_TOKEN_TTL = env.int("API_TOKEN_TTL", default=7 * 24 * 3600)
+API_TOKEN_CACHE_TTL = env.int("API_TOKEN_CACHE_TTL", default=60)
+# es rota el token quan li queda menys d'aquest temps
+API_TOKEN_ROTACIO = env.int("API_TOKEN_ROTACIO", default=24 * 3600)
+# credencials verificades que no tornen a passar pel hasher
+API_CREDENCIALS_TTL = env.int("API_CREDENCIALS_TTL", default=30)
+
+# Tasques en segon pla (biblioteca/tasques.py): segons sense batec abans que
+# un altre treballador pugui reclamar una tasca en curs, i intents per tasca
+TASQUES_TERMINI = env.int("TASQUES_TERMINI", default=300)
+TASQUES_MAX_INTENTS = env.int("TASQUES_MAX_INTENTS", default=3)
+# Files per lot de les importacions en segon pla (cada lot desa el progrés i
+# renova el batec). Per defecte, el de cada importació:
+# TASQUES_MIDA_LOT = 500
@@ -5,59 +5,69 @@ from django.forms.models import BaseInlineFormSet
 from django.core.exceptions import ObjectDoesNotExist
 from django import forms
 from django.utils.safestring import mark_safe
+from django.utils.html import format_html
+from django.http import JsonResponse
+from django.urls import path, reverse
+from django.db import transaction
+from django.utils import timezone
+from datetime import timedelta
+
+from . import autocompletar, prestecs, reserves
 
 from .models import (
     Categoria, Pais, Llengua, Llibre, Exemplar, Usuari, Prestec, Reserva,
-    Centre, Grup, Revista, CD, DVD, BR, Dispositiu, Imatge, Autor, Editorial, Peticio
+    Centre, Grup, Revista, CD, DVD, BR, Dispositiu, Imatge, Autor, Editorial, Peticio,
+    TokenAcces, Tasca, PoliticaPrestec, Avis
 )
 
 # ============================
 # Widgets personalizados usando HTML5 datalist
 # ============================
-class AutorWidget(forms.TextInput):
+# El datalist es carrega sota demanda (static/biblioteca/lookup.js) des de
+# la vista LlibreAdmin.lookup_view; el nom del valor inicial es resol des de
+# l'índex d'autocompletat si ja és a memòria, o amb una consulta per pk (mai
+# no es carrega tota la taula per mostrar un sol nom).
+class LookupWidget(forms.TextInput):
+    model = None
+    tipus = None
+
+    class Media:
+        js = ('biblioteca/lookup.js',)
+
     def format_value(self, value):
         # Si ya es una cadena, retornarla
         if isinstance(value, str):
             return value
-        # Si es una instancia de Autor, retorna su nombre
-        if isinstance(value, Autor):
+        # Si es una instancia del model, retorna su nombre
+        if isinstance(value, self.model):
             return value.nom
-        # Si se recibe un valor (por ejemplo, pk), se intenta obtener la instancia
+        # Si se recibe un valor (pk), es resol amb l'índex o amb la base de dades
         if value:
             try:
-                autor = Autor.objects.get(pk=value)
-                return autor.nom
-            except (Autor.DoesNotExist, ValueError, TypeError):
+                pk = int(value)
+            except (ValueError, TypeError):
                 return value
+            nom = autocompletar.INDEXOS[self.tipus].nom(pk)
+            if nom is None:
+                nom = self.model.objects.filter(pk=pk).values_list('nom', flat=True).first()
+            return nom if nom is not None else value
         return ''
 
     def render(self, name, value, attrs=None, renderer=None):
-        # El valor ya se formateó en format_value, así que procedemos a renderizar
+        attrs = dict(attrs or {})
+        attrs['data-lookup-url'] = reverse('admin:biblioteca_llibre_lookup', args=[self.tipus])
+        attrs.setdefault('autocomplete', 'off')
         html = super().render(name, value, attrs, renderer)
-        # Genera el datalist con todos los autores existentes
-        options = ''.join(f'<option value="{autor.nom}">' for autor in Autor.objects.all())
-        datalist = f'<datalist id="autors_list">{options}</datalist>'
+        datalist = format_html('<datalist id="{}"></datalist>', self.attrs.get('list', ''))
         return mark_safe(html + datalist)
 
-class EditorialWidget(forms.TextInput):
-    def format_value(self, value):
-        if isinstance(value, str):
-            return value
-        if isinstance(value, Editorial):
-            return value.nom
-        if value:
-            try:
-                editorial = Editorial.objects.get(pk=value)
-                return editorial.nom
-            except (Editorial.DoesNotExist, ValueError, TypeError):
-                return value
-        return ''
+class AutorWidget(LookupWidget):
+    model = Autor
+    tipus = 'autor'
 
-    def render(self, name, value, attrs=None, renderer=None):
-        html = super().render(name, value, attrs, renderer)
-        options = ''.join(f'<option value="{edi.nom}">' for edi in Editorial.objects.all())
-        datalist = f'<datalist id="editorials_list">{options}</datalist>'
-        return mark_safe(html + datalist)
+class EditorialWidget(LookupWidget):
+    model = Editorial
+    tipus = 'editorial'
 
 # ============================
 # Formulario personalizado para Llibre
@@ -92,8 +102,14 @@ class LlibreForm(forms.ModelForm):
 # ADMIN PARA CATEGORIA
 # ============================
 class CategoriaAdmin(admin.ModelAdmin):
-    list_display = ('nom', 'parent')
-    ordering = ('parent', 'nom')
+    list_display = ('arbre', 'parent')
+    list_select_related = ('parent',)
+    # el camí materialitzat ordena en preordre: cada categoria sota la seva mare
+    ordering = ('cami',)
+
+    @admin.display(description='Nom', ordering='cami')
+    def arbre(self, obj):
+        return format_html('{}{}', '— ' * obj.nivell, obj.nom)
 
 # ============================
 # ADMIN PARA USUARI
@@ -172,11 +188,53 @@ class LlibreAdmin(admin.ModelAdmin):
     filter_horizontal = ('tags',)
     inlines = [ExemplarsInline,]
     search_fields = ('titol', 'CDU', 'signatura', 'ISBN', 'colleccio')
-    list_display = ('titol', 'autor', 'editorial', 'num_exemplars')
+    list_display = ('titol', 'autor', 'editorial', 'num_exemplars',
+                    'exemplars_disponibles', 'exemplars_prestec', 'exemplars_baixa')
     readonly_fields = ('thumb',)
 
+    def get_urls(self):
+        urls = [
+            path('lookup/<str:tipus>/', self.admin_site.admin_view(self.lookup_view),
+                 name='biblioteca_llibre_lookup'),
+        ]
+        return urls + super().get_urls()
+
+    def lookup_view(self, request, tipus):
+        # JSON paginat per als widgets d'autor i editorial
+        index = autocompletar.INDEXOS.get(tipus)
+        if index is None or tipus == 'titol':
+            return JsonResponse({'error': 'Tipus desconegut'}, status=404)
+        try:
+            pagina = max(int(request.GET.get('page', 1)), 1)
+        except ValueError:
+            pagina = 1
+        per_pagina = 20
+        # es demana un element de més per saber si hi ha pàgina següent
+        resultats = index.cercar(request.GET.get('q', ''), per_pagina + 1, (pagina - 1) * per_pagina)
+        return JsonResponse({
+            'results': resultats[:per_pagina],
+            'next': pagina + 1 if len(resultats) > per_pagina else None,
+        })
+
+    def get_queryset(self, request):
+        # comptadors d'exemplars en la mateixa consulta del llistat
+        return super().get_queryset(request).amb_exemplars()
+
+    @admin.display(description='Exemplars', ordering='n_exemplars')
     def num_exemplars(self, obj):
-        return obj.exemplar_set.count()
+        return obj.n_exemplars
+
+    @admin.display(description='Disponibles', ordering='n_disponibles')
+    def exemplars_disponibles(self, obj):
+        return obj.n_disponibles
+
+    @admin.display(description='En préstec', ordering='n_prestec')
+    def exemplars_prestec(self, obj):
+        return obj.n_prestec
+
+    @admin.display(description='De baixa', ordering='n_baixa')
+    def exemplars_baixa(self, obj):
+        return obj.n_baixa
 
     def thumb(self, obj):
         return mark_safe("<img src='{}' />".format(escape(obj.thumbnail_url)))
@@ -187,16 +245,68 @@ class LlibreAdmin(admin.ModelAdmin):
 # ============================
 class PrestecAdmin(admin.ModelAdmin):
     readonly_fields = ('data_prestec',)
-    fields = ('exemplar', 'usuari', 'data_prestec', 'data_retorn', 'anotacions')
-    list_display = ('exemplar', 'usuari', 'data_prestec', 'data_retorn')
+    fields = ('exemplar', 'usuari', 'data_prestec', 'data_venciment', 'data_retorn', 'anotacions')
+    list_display = ('exemplar', 'usuari', 'data_prestec', 'data_venciment', 'data_retorn')
 
 # ============================
 # ADMIN PARA RESERVA
 # ============================
 class ReservaAdmin(admin.ModelAdmin):
-    readonly_fields = ('data',)
-    fields = ('exemplar', 'usuari', 'data')
-    list_display = ('exemplar', 'usuari', 'data')
+    # l'estat i l'exemplar només canvien per les transicions de la cua
+    # (reserves.py): des de les accions, no editant-los a mà
+    readonly_fields = ('estat', 'exemplar', 'data', 'posicio', 'assignada', 'expira')
+    fields = ('cataleg', 'usuari', 'estat', 'exemplar', 'data', 'posicio', 'assignada', 'expira')
+    list_display = ('cataleg', 'usuari', 'estat', 'posicio', 'exemplar', 'expira')
+    list_filter = ('estat',)
+    raw_id_fields = ('cataleg',)
+    actions = ('cancellar', 'caducar')
+
+    def get_readonly_fields(self, request, obj=None):
+        if obj:
+            # canviar de registre o d'usuari trencaria la cua
+            return self.readonly_fields + ('cataleg', 'usuari')
+        return self.readonly_fields
+
+    def save_model(self, request, obj, form, change):
+        # una reserva nova va al final de la cua del registre
+        if not change:
+            obj.posicio = reserves.seguent_posicio(obj.cataleg_id)
+        super().save_model(request, obj, form, change)
+        if not change and reserves.assignar_registre(obj.cataleg_id):
+            reserves.actualitzar([obj.cataleg_id])
+
+    @admin.action(description="Cancel·lar les reserves seleccionades")
+    def cancellar(self, request, queryset):
+        fetes = 0
+        for pk, usuari_id in queryset.filter(estat__in=Reserva.ACTIVES).values_list('pk', 'usuari_id'):
+            try:
+                prestecs.cancellar_reserva(pk, usuari_id)
+                fetes += 1
+            except Reserva.DoesNotExist:
+                pass
+        self.message_user(request, f"{fetes} reserves cancel·lades")
+
+    @admin.action(description="Caducar ara les reserves assignades seleccionades")
+    def caducar(self, request, queryset):
+        with transaction.atomic():
+            ara = timezone.now()
+            queryset.filter(estat=Reserva.ASSIGNADA).update(expira=ara)
+            fetes = reserves.caducar(ara + timedelta(microseconds=1))
+        self.message_user(request, f"{fetes} reserves caducades")
+
+# ============================
+# ADMIN PARA VENCIMIENTOS
+# ============================
+class PoliticaPrestecAdmin(admin.ModelAdmin):
+    list_display = ('grup', 'tipus', 'dies')
+    list_filter = ('tipus',)
+
+class AvisAdmin(admin.ModelAdmin):
+    readonly_fields = ('creat',)
+    list_display = ('usuari', 'tipus', 'data', 'enviat')
+    list_filter = ('tipus', 'data')
+    # un resum pot tenir molts préstecs: sense desplegable
+    raw_id_fields = ('usuari', 'prestecs')
 
 # ============================
 # REGISTRO DE MODELOS EN EL ADMIN
@@ -209,6 +319,19 @@ class AutorAdmin(admin.ModelAdmin):
 class EditorialAdmin(admin.ModelAdmin):
     search_fields = ['nom']
 
+@admin.register(TokenAcces)
+class TokenAccesAdmin(admin.ModelAdmin):
+    list_display = ('usuari', 'creat', 'expira', 'revocat')
+    list_filter = ('revocat',)
+    readonly_fields = ('usuari', 'hash', 'creat')
+    search_fields = ('usuari__username',)
+
+@admin.register(Tasca)
+class TascaAdmin(admin.ModelAdmin):
+    list_display = ('id', 'tipus', 'usuari', 'estat', 'creat', 'processades', 'creades', 'treballador', 'intents')
+    list_filter = ('estat', 'tipus')
+    readonly_fields = ('inici', 'fi', 'processades', 'creades', 'errors', 'missatge', 'treballador', 'batec', 'intents')
+
 admin.site.register(Usuari, UsuariAdmin)
 admin.site.register(Categoria, CategoriaAdmin)
 admin.site.register(Pais)
@@ -221,6 +344,8 @@ admin.site.register(Centre)
 admin.site.register(Grup)
 admin.site.register(Reserva, ReservaAdmin)
 admin.site.register(Prestec, PrestecAdmin)
+admin.site.register(PoliticaPrestec, PoliticaPrestecAdmin)
+admin.site.register(Avis, AvisAdmin)
 admin.site.register(Peticio)
 admin.site.register(CD)
 admin.site.register(DVD)
@@ -1,20 +1,24 @@
 
+from django.db import transaction
+from django.utils import timezone
 from django.db.models import Q
 from django.contrib.auth import authenticate, get_user_model
 from django.shortcuts import get_object_or_404
 from django.core.files.storage import default_storage
 from django.conf import settings
-from django.http import JsonResponse
+from django.http import JsonResponse, StreamingHttpResponse
 from django.core.exceptions import ValidationError
 
 from ninja import NinjaAPI, Field, Field, Router
 from ninja.security import HttpBasicAuth, HttpBearer
 from ninja.files import UploadedFile
+from ninja.errors import HttpError
+from ninja.responses import NinjaJSONEncoder
 
-import secrets
 import hashlib
 import csv
-import traceback
+import json
+import logging
 import os
 import re
 
@@ -25,10 +29,17 @@ from pydantic import BaseModel, Field, validator
 from typing import Optional
 
 from .models import *
-from datetime import date
+from .paginacio import paginar_ids, paginar_keyset
+from . import cerca, autocompletar
+from . import serialitzadors
+from . import cache_api, facetes, tokens
+from . import importacio, prestecs, reserves, tasques
+from datetime import date, datetime, time
 
 api = NinjaAPI()
 
+logger = logging.getLogger(__name__)
+
 router = Router()
 
 User = get_user_model()
@@ -36,23 +47,19 @@ User = get_user_model()
 # Autenticació bàsica
 class BasicAuth(HttpBasicAuth):
     def authenticate(self, request, username, password):
-        user = authenticate(username=username, password=password)
+        user = tokens.verificar(username, password)
         if user:
-            # Genera un token simple
-            token = secrets.token_hex(16)
-            user.auth_token = token
-            user.save()
-            return token
+            # Torna el token vigent o en rota un (vegeu tokens.py)
+            return tokens.emetre(user)
         return None
 
-# Autenticació per Token Bearer
+# Autenticació per Token Bearer (vegeu tokens.py)
 class AuthBearer(HttpBearer):
     def authenticate(self, request, token):
-        try:
-            user = User.objects.get(auth_token=token)
-            return user
-        except User.DoesNotExist:
-            return None
+        user = tokens.resoldre(token)
+        if user is not None:
+            request.token = token
+        return user
 
 # Endpoint per obtenir un token
 @api.get("/token", auth=BasicAuth())
@@ -60,6 +67,12 @@ class AuthBearer(HttpBearer):
 def obtenir_token(request):
     return {"token": request.auth}
 
+# Revoca el token amb què es fa la petició
+@api.post("/token/revocar", auth=AuthBearer())
+def revocar_token(request):
+    tokens.revocar(token=request.token)
+    return {"revocat": True}
+
 # Esquema de respuesta
 class AuthResponse(BaseModel):
     exists: bool
@@ -197,6 +210,8 @@ class LlibreOut(CatalegOut):
     ISBN: Optional[str] = Field(None)
     editorial: Optional[str] = Field(None)
     thumbnail_url: Optional[str]
+    comptador_exemplars: int = 0
+    comptador_disponibles: int = 0
     
     @validator('editorial', pre=True)
     def extract_editorial(cls, value):
@@ -209,12 +224,35 @@ class LlibreOut(CatalegOut):
 
 
 
+class RevistaOut(CatalegOut):
+    ISSN: Optional[str] = None
+    editorial: Optional[str] = None
+    numero: Optional[int] = None
+
+class CDOut(CatalegOut):
+    discografica: Optional[str] = None
+    estil: Optional[str] = None
+    duracio: Optional[time] = None
+
+class DVDOut(CatalegOut):
+    productora: Optional[str] = None
+    duracio: Optional[time] = None
+
+class BROut(DVDOut):
+    pass
+
+class DispositiuOut(CatalegOut):
+    marca: Optional[str] = None
+    model: Optional[str] = None
+
+
 class ExemplarOut(BaseModel):
     id: int
-    registre: str
+    registre: Optional[str] = None
     exclos_prestec: bool
     baixa: bool
-    cataleg: Union[LlibreOut,CatalegOut]
+    # l'esquema depèn de 'tipus' (llibre, revista, cd, dvd, br, dispositiu)
+    cataleg: Union[LlibreOut, RevistaOut, CDOut, DVDOut, BROut, DispositiuOut, CatalegOut]
     tipus: str
     centre: dict
 
@@ -223,24 +261,176 @@ class LlibreIn(BaseModel):
     editorial: str
 
 
-@api.get("/llibres", response=List[LlibreOut])
-@api.get("/llibres/", response=List[LlibreOut])
+class LlibresPaginaOut(BaseModel):
+    results: List[LlibreOut]
+    next: Optional[str] = None
+
+
+# columnes de LlibreOut per serialitzar directament des de .values()
+LLIBRE_OUT_VALUES = {
+    "id": "id",
+    "titol": "titol",
+    "autor": "autor__nom",
+    "ISBN": "ISBN",
+    "editorial": "editorial__nom",
+    "thumbnail_url": "thumbnail_url",
+    "comptador_exemplars": "comptador_exemplars",
+    "comptador_disponibles": "comptador_disponibles",
+}
+
+
+def _llibres_ndjson(qs):
+    chunk_size = getattr(settings, "API_STREAM_CHUNK_SIZE", 2000)
+    columnes = list(LLIBRE_OUT_VALUES.values())
+    for fila in qs.values(*columnes).iterator(chunk_size=chunk_size):
+        yield json.dumps({
+            camp: fila[columna] for camp, columna in LLIBRE_OUT_VALUES.items()
+        }, ensure_ascii=False) + "\n"
+
+
+@api.get("/llibres", response=Union[LlibresPaginaOut, List[LlibreOut]])
+@api.get("/llibres/", response=Union[LlibresPaginaOut, List[LlibreOut]])
 #@api.get("/llibres/", response=List[LlibreOut], auth=AuthBearer())
-def get_llibres(request, search: str = None):
+@cache_api.lectura("llibres", "llibres", marques=lambda p: [
+    Cataleg.objects.all(), *([Categoria.objects.all()] if p.get("categoria") else []),
+])
+def get_llibres(request, search: str = None, limit: int = None,
+                cursor: str = None, stream: bool = False, categoria: int = None):
 
     # Devuelve todos los llibres. Si se proporciona el parámetro 'search',
-    # se filtran los llibres cuyo titol o autor contenga el término de búsqueda.
-
+    # es fa servir l'índex de cerca (cerca.py) i els resultats surten
+    # ordenats per rellevància.
+    #
+    # - limit/cursor: paginació per cursor sobre la pk de Cataleg
+    #   ({"results": [...], "next": "<cursor>"}). Amb search, les pàgines
+    #   segueixen el rànquing de la cerca i el cursor n'és la posició: les
+    #   pàgines juntes donen el mateix que la crida sense paginar.
+    # - stream=true: NDJSON, una línia per llibre, sense carregar tot el
+    #   queryset a memòria.
+    # - categoria: llibres de la categoria o de qualsevol subcategoria.
+    # Sense cap d'aquests paràmetres es manté la llista completa.
+
+    qs = Llibre.objects.all().select_related('autor', 'editorial')
+    ids = None
     if search:
-        qs = Llibre.objects.filter(
-            Q(titol__icontains=search) | Q(autor__nom__icontains=search)
-        ).select_related('autor', 'editorial')
-    else:
-        qs = Llibre.objects.all().select_related('autor', 'editorial')
+        # el límit de resultats s'aplica ja només sobre els llibres
+        ids = cerca.cercar(search, model=Llibre)
+        qs = qs.filter(pk__in=ids)
+    if categoria is not None:
+        qs = qs.filter(pk__in=_cataleg_de_categoria(categoria))
+
+    if stream:
+        return StreamingHttpResponse(
+            _llibres_ndjson(qs.order_by("pk")),
+            content_type="application/x-ndjson",
+        )
+
+    if limit is not None or cursor:
+        try:
+            if ids is not None:
+                llibres, seguent = paginar_ids(qs, ids, cursor, limit)
+            else:
+                llibres, seguent = paginar_keyset(qs, ("pk",), cursor, limit)
+        except ValueError as e:
+            raise HttpError(400, str(e))
+        return {"results": llibres, "next": seguent}
+
+    if ids is not None:
+        posicio = {pk: i for i, pk in enumerate(ids)}
+        return sorted(qs, key=lambda llibre: posicio[llibre.pk])
     return qs
 
 
 
+def _cataleg_de_categoria(categoria_id):
+    # subconsulta sobre la taula de tags amb un sol rang indexat (Categoria.cami)
+    categoria = get_object_or_404(Categoria.objects.only('cami'), pk=categoria_id)
+    return Cataleg.tags.through.objects.filter(
+        categoria__in=Categoria.objects.subarbre(categoria)
+    ).values('cataleg_id')
+
+
+class CategoriaOut(BaseModel):
+    id: int
+    nom: str
+    fills: List['CategoriaOut'] = []
+
+
+@api.get("/categories", response=List[CategoriaOut])
+@api.get("/categories/", response=List[CategoriaOut])
+@cache_api.lectura("categories", "categories", marques=lambda p: [Categoria.objects.all()])
+def get_categories(request):
+    # Arbre complet amb una sola consulta: ordenades per camí, cada
+    # categoria arriba després de la seva mare.
+    arrels, nodes = [], {}
+    for pk, nom, parent_id in Categoria.objects.order_by('cami').values_list('pk', 'nom', 'parent_id'):
+        node = nodes[pk] = {"id": pk, "nom": nom, "fills": []}
+        (nodes[parent_id]["fills"] if parent_id in nodes else arrels).append(node)
+    return JsonResponse(arrels, safe=False)
+
+
+class FacetaValorOut(BaseModel):
+    valor: Union[int, str]
+    nom: Optional[str]
+    n: int
+
+
+class FacetesOut(BaseModel):
+    total: int
+    facetes: Dict[str, List[FacetaValorOut]]
+
+
+@api.get("/cataleg/facets", response=FacetesOut)
+@api.get("/cataleg/facets/", response=FacetesOut)
+@cache_api.lectura("facetes", "facetes", "llibres", marques=lambda p: [Cataleg.objects.all(), Categoria.objects.all()])
+def get_facetes(request, search: str = None, tipus: str = None, llengua: int = None,
+                pais: int = None, editorial: int = None, categoria: int = None,
+                decada: int = None, limit: int = None):
+    # Recomptes per faceta des de l'índex en memòria (facetes.py). Cada
+    # faceta es compta amb els filtres de les altres; total aplica tots.
+    # categoria inclou les subcategories.
+    filtres = {
+        "tipus": tipus, "llengua": llengua, "pais": pais,
+        "editorial": editorial, "categoria": categoria, "decada": decada,
+    }
+    filtres = {faceta: valor for faceta, valor in filtres.items() if valor is not None}
+    ids = cerca.cercar(search) if search else None
+    total, recomptes = facetes.index.comptar(filtres, ids=ids, limit=limit)
+    noms = facetes.noms(recomptes)
+    return JsonResponse({
+        "total": total,
+        "facetes": {
+            faceta: [{"valor": valor, "nom": noms[faceta].get(valor), "n": n} for valor, n in valors]
+            for faceta, valors in recomptes.items()
+        },
+    })
+
+
+class SuggerimentOut(BaseModel):
+    id: int
+    nom: str
+
+class AutocompleteOut(BaseModel):
+    titol: List[SuggerimentOut] = []
+    autor: List[SuggerimentOut] = []
+    editorial: List[SuggerimentOut] = []
+
+
+@api.get("/autocomplete", response=AutocompleteOut)
+@api.get("/autocomplete/", response=AutocompleteOut)
+def autocomplete(request, q: str, tipus: str = None, limit: int = 10):
+    # Suggeriments per prefix des dels índexs en memòria (autocompletar.py).
+    # Amb 'tipus' (titol, autor, editorial) només es consulta aquell índex.
+    if tipus and tipus not in autocompletar.INDEXOS:
+        raise HttpError(400, f"Tipus desconegut: {tipus}")
+    limit = max(1, min(limit, 50))
+    return {
+        nom: index.cercar(q, limit)
+        for nom, index in autocompletar.INDEXOS.items()
+        if not tipus or nom == tipus
+    }
+
+
 @api.post("/llibres/")
 def post_llibres(request, payload: LlibreIn):
     llibre = Llibre.objects.create(**payload.dict())
@@ -259,264 +449,146 @@ class LlibreDetallOut(LlibreOut):
     class Config:
         from_attributes = True  # muy importante
 
+class ExemplarsPaginaOut(BaseModel):
+    results: List[ExemplarOut]
+    next: Optional[str] = None
+
+
+def _exemplars_resposta(paginat=False, **filtres):
+    # Tots els endpoints d'exemplars passen per consultar_exemplars()
+    # (serialitzadors.py). La resposta ja és JSON-serialitzable, així que
+    # no es torna a validar amb pydantic.
+    try:
+        files, seguent = serialitzadors.consultar_exemplars(**filtres)
+    except ValueError as e:
+        raise HttpError(400, str(e))
+    if paginat:
+        return JsonResponse({"results": files, "next": seguent}, encoder=NinjaJSONEncoder)
+    return JsonResponse(files, safe=False, encoder=NinjaJSONEncoder)
+
+
 @api.get("/llibres/{id}", response=LlibreDetallOut)
+@cache_api.lectura("llibre", "detalls", "llibre:{id}", marques=lambda p: [Cataleg.objects.filter(pk=p["id"])])
 def get_llibre_by_id(request, id: int):
-    llibre = get_object_or_404(Llibre, id=id)
-
-    exemplars = Exemplar.objects.select_related(
-        "cataleg__llibre",
-        "centre",
-    ).filter(cataleg__llibre__id=id)
-
-    exemplars_serialitzats = []
-    for e in exemplars:
-        cataleg_instance = e.cataleg
-        if hasattr(cataleg_instance, "llibre"):
-            cataleg_Field = LlibreOut.from_orm(cataleg_instance.llibre)
-            tipus = "llibre"
-        else:
-            cataleg_Field = CatalegOut.from_orm(cataleg_instance)
-            tipus = "indefinit"
-
-        exemplars_serialitzats.append(
-            ExemplarOut(
-                id=e.id,
-                registre=e.registre,
-                exclos_prestec=e.exclos_prestec,
-                baixa=e.baixa,
-                cataleg=cataleg_Field,
-                tipus=tipus,
-                centre={"id": e.centre.id, "nom": e.centre.nom},
-            )
-        )
+    llibre = get_object_or_404(Llibre.objects.select_related("autor", "editorial"), id=id)
+
+    exemplars, _ = serialitzadors.consultar_exemplars(cataleg=id)
 
     # Creamos manualmente el objeto de salida
-    llibre_out = LlibreDetallOut.from_orm(llibre)
-    llibre_out.exemplars = exemplars_serialitzats
-    return llibre_out
-
-
-
-@api.get("/exemplars", response=List[ExemplarOut])
-@api.get("/exemplars/", response=List[ExemplarOut])
-def get_exemplars(request):
-    # carreguem objectes amb els proxy models relacionats exactes
-    exemplars = Exemplar.objects.select_related(
-        "cataleg__llibre",
-        "cataleg__revista",
-        "cataleg__cd",
-        "cataleg__dvd",
-        "cataleg__br",
-        "cataleg__dispositiu",
-        "centre",
-    ).all()
-    result = []
-
-    for exemplar in exemplars:
-        cataleg_instance = exemplar.cataleg
-
-        # Determinar el tipus de l'objecte Cataleg
-        if hasattr(cataleg_instance, "llibre"):
-            cataleg_Field = LlibreOut.from_orm(cataleg_instance.llibre)
-            tipus = "llibre"
-        #elif hasattr(cataleg_instance, "dispositiu"):
-        #    cataleg_Field = LlibreOut.from_orm(cataleg_instance.dispositiu)
-        # TODO: afegir altres esquemes
-        else:
-            cataleg_Field = CatalegOut.from_orm(cataleg_instance)
-            tipus = "indefinit"
-
-        # Afegir l'Exemplar amb el Cataleg serialitzat
-        result.append(
-            ExemplarOut(
-                id=exemplar.id,
-                registre=exemplar.registre,
-                exclos_prestec=exemplar.exclos_prestec,
-                baixa=exemplar.baixa,
-                cataleg=cataleg_Field,
-                tipus=tipus,
-                centre={
-                    "id": exemplar.centre.id,
-                    "nom": exemplar.centre.nom
-                },
-                
-            )
-        )
+    llibre_out = LlibreOut.from_orm(llibre).model_dump()
+    llibre_out["exemplars"] = exemplars
+    return JsonResponse(llibre_out, encoder=NinjaJSONEncoder)
+
+
+
+@api.get("/exemplars", response=Union[ExemplarsPaginaOut, List[ExemplarOut]])
+@api.get("/exemplars/", response=Union[ExemplarsPaginaOut, List[ExemplarOut]])
+@cache_api.lectura("exemplars", "exemplars", marques=lambda p: [Cataleg.objects.all()])
+def get_exemplars(request, cataleg: int = None, centre: int = None,
+                  disponible: bool = None, tipus: str = None, fields: str = None,
+                  limit: int = None, cursor: str = None):
+    # Filtres opcionals per catàleg, centre, disponibilitat i tipus de
+    # material; 'fields' limita els camps retornats (p. ex. fields=id,registre)
+    # i amb limit/cursor la resposta es pagina per cursor.
+    return _exemplars_resposta(
+        paginat=limit is not None or bool(cursor),
+        cataleg=cataleg, centre=centre, disponible=disponible, tipus=tipus,
+        fields=fields, limit=limit, cursor=cursor,
+    )
 
-    return result
 
+@api.get("/llibres/{id}/exemplars", response=Union[ExemplarsPaginaOut, List[ExemplarOut]])
+@cache_api.lectura("llibre_exemplars", "exemplars", marques=lambda p: [Cataleg.objects.filter(pk=p["id"])])
+def get_exemplars_by_llibre(request, id: int, centre: int = None,
+                            disponible: bool = None, fields: str = None,
+                            limit: int = None, cursor: str = None):
+    return _exemplars_resposta(
+        paginat=limit is not None or bool(cursor),
+        cataleg=id, tipus="llibre", centre=centre, disponible=disponible,
+        fields=fields, limit=limit, cursor=cursor,
+    )
 
-@api.get("/llibres/{id}/exemplars", response=List[ExemplarOut])
-def get_exemplars_by_llibre(request, id: int):
-    exemplars = Exemplar.objects.select_related(
-        "cataleg__llibre",
-        "cataleg__revista",
-        "cataleg__cd",
-        "cataleg__dvd",
-        "cataleg__br",
-        "cataleg__dispositiu",
-        "centre",
-    ).filter(cataleg__llibre__id=id)
 
-    result = []
-    for exemplar in exemplars:
-        cataleg_instance = exemplar.cataleg
+class PrestecObertOut(BaseModel):
+    id: int
+    usuari: str
+    data_prestec: date
 
-        if hasattr(cataleg_instance, "llibre"):
-            cataleg_Field = LlibreOut.from_orm(cataleg_instance.llibre)
-            tipus = "llibre"
-        else:
-            cataleg_Field = CatalegOut.from_orm(cataleg_instance)
-            tipus = "indefinit"
-
-        result.append(
-            ExemplarOut(
-                id=exemplar.id,
-                registre=exemplar.registre,
-                exclos_prestec=exemplar.exclos_prestec,
-                baixa=exemplar.baixa,
-                cataleg=cataleg_Field,
-                tipus=tipus,
-                centre={
-                    "id": exemplar.centre.id,
-                    "nom": exemplar.centre.nom
-                },
-            )
-        )
+class ReservaEscaneigOut(BaseModel):
+    id: int
+    usuari: str
+    data: date
+    expira: Optional[datetime] = None
 
-    return result
+class EscaneigOut(BaseModel):
+    exemplar: ExemplarOut
+    disponible: bool
+    prestec: Optional[PrestecObertOut] = None
+    reserva: Optional[ReservaEscaneigOut] = None
+    reserves: int
 
 
+@api.get("/exemplars/by-registre/{code}", response=EscaneigOut)
+@cache_api.lectura("exemplar_registre", "detalls", "registre:{code}", marques=lambda p: [
+    Exemplar.objects.filter(registre=p["code"]), Cataleg.objects.filter(exemplar__registre=p["code"]),
+])
+def get_exemplar_per_registre(request, code: str, centre: int = None):
+    # Lectura del codi de barres al taulell: una consulta (serialitzadors.escanejar).
+    # La resposta es guarda a la cache fins que canvia l'exemplar, un préstec
+    # o una reserva del registre (grup "registre:<codi>").
+    files = serialitzadors.escanejar(code, centre)
+    if not files:
+        raise HttpError(404, "Exemplar no trobat")
+    if len(files) > 1:
+        raise HttpError(409, "El registre existeix a més d'un centre: cal indicar centre")
+    return JsonResponse(files[0], encoder=NinjaJSONEncoder)
 
-class UsuariCSV:
-    def __init__(self, nom: str, cognom1: str, cognom2: str, email: str, telefon: str, centre: str, grup: str):
-        self.nom = nom
-        self.cognom1 = cognom1
-        self.cognom2 = cognom2
-        self.email = email
-        self.telefon = telefon
-        self.centre = centre
-        self.grup = grup
 
-    def to_dict(self):
-        return {
-            "nom": self.nom,
-            "cognom1": self.cognom1,
-            "cognom2": self.cognom2,
-            "email": self.email,
-            "telefon": self.telefon,
-            "centre": self.centre,
-            "grup": self.grup
-        }
+class CacheMetricaOut(BaseModel):
+    hits: int
+    misses: int
+    ratio: float
 
-class UploadResponse(BaseModel):
-    mensaje: str
-    errores: Optional[List[Dict]] = None
-    usuarios_creados: Optional[int] = 0
 
-def validar_nombre(nombre):
-    # Ejemplo de validación: no vacío y solo letras
-    if not nombre:
-        raise ValueError("El nombre está vacío.")
-    if not nombre.isalpha():
-        raise ValueError(f"Nombre inválido: '{nombre}' contiene caracteres no permitidos.")
+@api.get("/cache/stats", response=Dict[str, CacheMetricaOut])
+def cache_stats(request):
+    # hits i misses de la cache de respostes per endpoint
+    return cache_api.metriques(cache_api.ENDPOINTS)
 
-def validar_telefono(telefono):
-    # Validación simple: debe ser numérico y contener al menos 9 dígitos
-    if not telefono or not telefono.isdigit() or len(telefono) < 9:
-        raise ValueError("Teléfono inválido. Debe contener al menos 9 dígitos numéricos.")
 
-@api.post("/subir-documento/", response={200: UploadResponse, 500: UploadResponse})
-def subir_documento(request, archivo: UploadedFile):
-    file_path = default_storage.save(f"temp/{archivo.name}", archivo)
-    full_path = os.path.join(settings.MEDIA_ROOT, file_path)
 
-    registros: List[UsuariCSV] = []
-    errores: List[Dict] = []
-    usuarios_creados = 0
+class UploadResponse(BaseModel):
+    mensaje: str
+    errores: Optional[List[Dict]] = None
+    usuarios_creados: Optional[int] = 0
 
+class TascaCreadaOut(BaseModel):
+    job: int
+    estat: str
+
+@api.post("/subir-documento/", response={200: UploadResponse, 202: TascaCreadaOut, 500: UploadResponse})
+def subir_documento(request, archivo: UploadedFile, asincron: bool = False):
+    if asincron:
+        # Es desa el fitxer i l'importa el worker (manage.py executar_tasques).
+        # La tasca és de qui la encua: cal un token per consultar-la després.
+        usuari = AuthBearer()(request)
+        if usuari is None:
+            raise HttpError(401, "Cal un token per importar en segon pla")
+        document = Documento.objects.create(archivo=archivo)
+        tasca = tasques.encuar("importar_usuaris", document, usuari=usuari)
+        return 202, {"job": tasca.pk, "estat": tasca.estat}
+
+    # El CSV es llegeix directament de la pujada, per lots (vegeu importacio.py)
     try:
-        with open(full_path, newline='', encoding='utf-8') as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                cleaned_row = {key.strip(): (value.strip() if value is not None else "") for key, value in row.items()}
-
-                if not any(cleaned_row.values()):
-                    continue
-
-                email = (cleaned_row.get("email") or "").strip().replace(' ', '').lower()
-
-                if not email or "@" not in email:
-                    errores.append({"fila": cleaned_row, "error": "Email vacío o inválido"})
-                    continue
-
-                if Usuari.objects.filter(username=email).exists():
-                    errores.append({"fila": cleaned_row, "error": f"El email {email} ya existe."})
-                    continue
-
-                nom = (cleaned_row.get("nom") or "").strip()
-                cognom1 = (cleaned_row.get("cognom1") or "").strip()
-                cognom2 = (cleaned_row.get("cognom2") or "").strip()
-                telefon = cleaned_row.get("telefon", "")
-                centre_nom = cleaned_row.get("centre", "")
-                grup_nom = cleaned_row.get("grup", "")
-
-                if not all([nom, cognom1, cognom2, telefon, centre_nom, grup_nom]):
-                    errores.append({"fila": cleaned_row, "error": "Faltan campos obligatorios."})
-                    continue
-
-                try:
-                    validar_nombre(nom)
-                    validar_nombre(cognom1)
-                    if cognom2:
-                        validar_nombre(cognom2)
-                    validar_telefono(telefon)
-
-                    centre, _ = Centre.objects.get_or_create(nom=centre_nom)
-                    grup, _ = Grup.objects.get_or_create(nom=grup_nom)
-
-                    Usuari.objects.create_user(
-                        username=email,
-                        email=email,
-                        first_name=nom,
-                        last_name=f"{cognom1} {cognom2}",
-                        telefon=telefon,
-                        centre=centre,
-                        grup=grup,
-                        password="1234"
-                    )
-                    usuarios_creados += 1
-
-                    registros.append(UsuariCSV(
-                        nom=nom,
-                        cognom1=cognom1,
-                        cognom2=cognom2,
-                        email=email,
-                        telefon=telefon,
-                        centre=centre_nom,
-                        grup=grup_nom
-                    ))
-
-                except (ValidationError, ValueError) as e:
-                    errores.append({"fila": cleaned_row, "error": str(e)})
-                    continue
-
+        usuarios_creados, errores = importacio.importar_usuaris(archivo.file)
     except Exception as e:
-        print("Error procesando CSV:", e)
-        traceback.print_exc()
+        logger.exception("Error processant el CSV d'usuaris")
         return 500, {
             "mensaje": f"Error interno del servidor: {e}",
             "errores": [],
             "usuarios_creados": 0
         }
 
-
-    finally:
-        try:
-            os.remove(full_path)
-        except:
-            pass
-
     return 200, {
         "mensaje": f"{usuarios_creados} usuario(s) creados correctamente.",
         "usuarios_creados": usuarios_creados,
@@ -527,6 +599,66 @@ def subir_documento(request, archivo: UploadedFile):
 
 
 
+class TascaOut(BaseModel):
+    id: int
+    tipus: str
+    estat: str
+    creat: datetime
+    inici: Optional[datetime] = None
+    fi: Optional[datetime] = None
+    processades: int
+    creades: int
+    errors: List[Dict]
+    missatge: str
+    files_per_segon: Optional[float] = None
+
+# Només qui ha encuat la tasca la pot consultar: els errors porten dades
+# personals de les files importades
+@api.get("/jobs/{id}", response=TascaOut, auth=AuthBearer())
+def get_job(request, id: int):
+    tasca = get_object_or_404(Tasca, pk=id, usuari=request.auth)
+    return {
+        "id": tasca.pk,
+        "tipus": tasca.tipus,
+        "estat": tasca.estat,
+        "creat": tasca.creat,
+        "inici": tasca.inici,
+        "fi": tasca.fi,
+        "processades": tasca.processades,
+        "creades": tasca.creades,
+        "errors": tasca.errors,
+        "missatge": tasca.missatge,
+        "files_per_segon": tasca.files_per_segon(),
+    }
+
+
+class ImportacioCatalegOut(BaseModel):
+    llegides: int
+    creades: int
+    duplicades: int
+    omeses: List[Dict] = []
+    errors: List[Dict]
+    segons: float
+    files_per_segon: Optional[float] = None
+
+# Importació massiva del catàleg (MARC21, CSV o JSON lines), només personal
+@api.post("/cataleg/importar", response={200: ImportacioCatalegOut, 202: TascaCreadaOut}, auth=AuthBearer())
+def importar_cataleg(request, archivo: UploadedFile, format: Optional[str] = None, asincron: bool = False):
+    if not request.auth.is_staff:
+        raise HttpError(403, "Només el personal de la biblioteca pot importar el catàleg")
+    try:
+        format = format or importacio.format_de(archivo.name)
+    except ValueError as e:
+        raise HttpError(400, str(e))
+    if format not in importacio.FORMATS:
+        raise HttpError(400, f"Format desconegut: {format}")
+
+    if asincron:
+        document = Documento.objects.create(archivo=archivo)
+        tasca = tasques.encuar("importar_cataleg", document, usuari=request.auth, format=format)
+        return 202, {"job": tasca.pk, "estat": tasca.estat}
+    return 200, importacio.importar_cataleg(archivo.file, format)
+
 
 # prestamos
 
@@ -534,42 +666,82 @@ class PrestecOut(BaseModel):
     id: int
     data_prestec: date
     data_retorn: Optional[date] = None
+    data_venciment: Optional[date] = None
     anotacions: Optional[str] = None
     exemplar_titol: str
 
+class PrestecsPaginaOut(BaseModel):
+    results: List[PrestecOut]
+    next: Optional[str] = None
+
 class PrestecsRequest(BaseModel):
     username: str
+    estat: Optional[str] = None
+    limit: Optional[int] = None
+    cursor: Optional[str] = None
 
-@api.post("/prestecs", response=List[PrestecOut])
+@api.post("/prestecs", response=Union[PrestecsPaginaOut, List[PrestecOut]])
 def get_prestecs(request, payload: PrestecsRequest):
-    username = payload.username
-    qs = Prestec.objects.filter(usuari__username=username).order_by("-data_prestec")
-    
-    results = []
-    for prestec in qs:
-        exemplar_titol = prestec.exemplar.cataleg.titol if prestec.exemplar and prestec.exemplar.cataleg else "N/A"
-        results.append({
-            "id": prestec.id,
-            "data_prestec": prestec.data_prestec,
-            "data_retorn": prestec.data_retorn,
-            "anotacions": prestec.anotacions,
-            "exemplar_titol": exemplar_titol,
-        })
-    return results
+    return _prestecs_usuari(payload.username, payload.estat, payload.limit, payload.cursor)
+
+
+@api.get("/prestecs", response=Union[PrestecsPaginaOut, List[PrestecOut]])
+@cache_api.lectura("prestecs", "prestecs", "prestecs:{username}", cache=False, marques=lambda p: [
+    Prestec.objects.filter(usuari__username=p["username"]),
+    Cataleg.objects.filter(exemplar__prestec__usuari__username=p["username"]),
+])
+def get_prestecs_condicional(request, username: str, estat: str = None,
+                             limit: int = None, cursor: str = None):
+    # Mateixa llista que POST /prestecs, però amb ETag/Last-Modified
+    return _prestecs_usuari(username, estat, limit, cursor)
+
+
+# columnes de PrestecOut des de .values()
+PRESTEC_OUT_VALUES = {
+    "id": "id",
+    "data_prestec": "data_prestec",
+    "data_retorn": "data_retorn",
+    "data_venciment": "data_venciment",
+    "anotacions": "anotacions",
+    "exemplar_titol": "exemplar__cataleg__titol",
+}
+
+ESTATS_PRESTEC = {
+    "actius": Q(data_retorn__isnull=True),
+    "retornats": Q(data_retorn__isnull=False),
+}
+
+
+def _prestecs_usuari(username, estat=None, limit=None, cursor=None):
+    # Historial de l'usuari, del més recent al més antic, en una sola
+    # consulta (índex prestec_usuari_data_idx; el títol ve amb un JOIN).
+    # - estat: "actius" (sense retornar) o "retornats".
+    # - limit/cursor: paginació per cursor sobre (data_prestec, id)
+    #   ({"results": [...], "next": "<cursor>"}).
+    if estat is not None and estat not in ESTATS_PRESTEC:
+        raise HttpError(400, f"estat ha de ser un de: {', '.join(ESTATS_PRESTEC)}")
+    qs = Prestec.objects.filter(usuari__username=username)
+    if estat:
+        qs = qs.filter(ESTATS_PRESTEC[estat])
+    qs = qs.values(*PRESTEC_OUT_VALUES.values())
+    ordre = ("-data_prestec", "-id")
+
+    if limit is not None or cursor:
+        try:
+            files, seguent = paginar_keyset(qs, ordre, cursor, limit)
+        except ValueError as e:
+            raise HttpError(400, str(e))
+        return {"results": [_prestec_out(fila) for fila in files], "next": seguent}
+    return [_prestec_out(fila) for fila in qs.order_by(*ordre)]
 
 
-#para prestamo del biblio en detalle libro
+def _prestec_out(fila):
+    resultat = {camp: fila[columna] for camp, columna in PRESTEC_OUT_VALUES.items()}
+    resultat["exemplar_titol"] = resultat["exemplar_titol"] or "N/A"
+    return resultat
 
-# Autenticación basada en el token
-class AuthBearer(HttpBearer):
-    def authenticate(self, request, token):
-        try:
-            # Buscar al usuario con el token proporcionado
-            user = get_user_model().objects.get(auth_token=token)
-            # Aquí puedes añadir la verificación del grupo específico del bibliotecario si lo deseas
-            return user
-        except get_user_model().DoesNotExist:
-            return None
+
+#para prestamo del biblio en detalle libro
 
 # Esquema de búsqueda de usuarios
 class UserSearchField(BaseModel):
@@ -638,30 +810,162 @@ class CrearPrestecRequest(BaseModel):
 
 @api.post("/crear_prestec")
 def crear_prestec(request, payload: CrearPrestecRequest):
+    # prestecs.prestar bloqueja l'exemplar i comprova que no estigui ja en
+    # préstec dins la mateixa transacció
     try:
-        usuari = Usuari.objects.get(id=payload.usuari)
-        exemplar = Exemplar.objects.get(id=payload.exemplar)
-
-        # Creamos el préstamo
-        prestec = Prestec.objects.create(
-            usuari=usuari,
-            exemplar=exemplar,
-            data_prestec=payload.data_prestec or date.today(),
-            anotacions=payload.anotacions or ""
+        prestec = prestecs.prestar(
+            payload.usuari, payload.exemplar, payload.data_prestec, payload.anotacions,
         )
+    except Usuari.DoesNotExist:
+        raise HttpError(404, "Usuari no trobat")
+    except Exemplar.DoesNotExist:
+        raise HttpError(404, "Exemplar no trobat")
+    except prestecs.PrestecError as e:
+        raise HttpError(409, str(e))
 
-        # Marcamos el ejemplar como exclòs del préstec
-        exemplar.exclos_prestec = True
-        exemplar.save()
+    return {
+        "message": "Préstamo creado correctamente",
+        "id": prestec.id
+    }
 
-        return {
-            "message": "Préstamo creado correctamente",
-            "id": prestec.id
-        }
 
-    except Usuari.DoesNotExist:
-        return {"error": "Usuari no trobat"}, 404
+class RetornarPrestecRequest(BaseModel):
+    exemplar: int
+    data_retorn: Optional[date] = None
+
+@api.post("/retornar_prestec")
+def retornar_prestec(request, payload: RetornarPrestecRequest):
+    try:
+        prestec = prestecs.retornar(payload.exemplar, payload.data_retorn)
     except Exemplar.DoesNotExist:
-        return {"error": "Exemplar no trobat"}, 404
-    except Exception as e:
-        return {"error": str(e)}, 500
+        raise HttpError(404, "Exemplar no trobat")
+    except prestecs.PrestecError as e:
+        raise HttpError(409, str(e))
+
+    return {
+        "message": "Préstec retornat",
+        "id": prestec.id
+    }
+
+
+# préstecs i retorns per lots (prestecs.prestar_lot / retornar_lot)
+
+class ElementLotPrestec(BaseModel):
+    usuari: int
+    exemplar: Optional[int] = None
+    registre: Optional[str] = None
+
+class ElementLotRetorn(BaseModel):
+    exemplar: Optional[int] = None
+    registre: Optional[str] = None
+
+class PrestecsLotRequest(BaseModel):
+    prestecs: List[ElementLotPrestec]
+    anotacions: Optional[str] = None
+
+class RetornsLotRequest(BaseModel):
+    retorns: List[ElementLotRetorn]
+    data_retorn: Optional[date] = None
+
+class ResultatLotOut(BaseModel):
+    exemplar: Optional[int] = None
+    ok: bool
+    prestec: Optional[int] = None
+    error: Optional[str] = None
+
+class LotOut(BaseModel):
+    fets: int
+    errors: int
+    results: List[ResultatLotOut]
+
+
+def _resum_lot(resultats):
+    fets = sum(1 for r in resultats if r["ok"])
+    return {"fets": fets, "errors": len(resultats) - fets, "results": resultats}
+
+
+def _comprovar_mida_lot(elements):
+    maxim = getattr(settings, "PRESTECS_LOT_MAX", 500)
+    if len(elements) > maxim:
+        raise HttpError(400, f"Com a màxim {maxim} elements per lot")
+
+
+@api.post("/prestecs/batch", response=LotOut)
+def prestecs_lot(request, payload: PrestecsLotRequest):
+    # Un resultat per element, en el mateix ordre; els que fallen no
+    # aturen els altres. Cada element porta exemplar o registre.
+    _comprovar_mida_lot(payload.prestecs)
+    resultats = prestecs.prestar_lot(
+        [e.model_dump() for e in payload.prestecs], payload.anotacions or "",
+    )
+    return _resum_lot(resultats)
+
+
+@api.post("/prestecs/batch/retorn", response=LotOut)
+def retorns_lot(request, payload: RetornsLotRequest):
+    _comprovar_mida_lot(payload.retorns)
+    resultats = prestecs.retornar_lot([e.model_dump() for e in payload.retorns], payload.data_retorn)
+    return _resum_lot(resultats)
+
+
+# Reserves de l'usuari autenticat (cua per registre, vegeu reserves.py)
+
+class ReservaRequest(BaseModel):
+    cataleg: int
+
+class ReservaOut(BaseModel):
+    id: int
+    cataleg: int
+    titol: str
+    estat: str
+    data: date
+    lloc: Optional[int] = None
+    exemplar: Optional[int] = None
+    registre: Optional[str] = None
+    expira: Optional[datetime] = None
+
+
+def _reserva_out(reserva):
+    # lloc a la cua només mentre espera; assignada, l'exemplar que té guardat
+    return {
+        "id": reserva.id,
+        "cataleg": reserva.cataleg_id,
+        "titol": reserva.cataleg.titol,
+        "estat": reserva.estat,
+        "data": reserva.data,
+        "lloc": reserves.lloc_a_la_cua(reserva) if reserva.estat == Reserva.ESPERA else None,
+        "exemplar": reserva.exemplar_id if reserva.estat == Reserva.ASSIGNADA else None,
+        "registre": reserva.exemplar.registre if reserva.estat == Reserva.ASSIGNADA else None,
+        "expira": reserva.expira if reserva.estat == Reserva.ASSIGNADA else None,
+    }
+
+
+@api.post("/reserves", response=ReservaOut, auth=AuthBearer())
+def crear_reserva(request, payload: ReservaRequest):
+    try:
+        reserva = prestecs.reservar(request.auth.pk, payload.cataleg)
+    except Usuari.DoesNotExist:
+        raise HttpError(404, "Usuari no trobat")
+    except Cataleg.DoesNotExist:
+        raise HttpError(404, "Registre no trobat")
+    except prestecs.PrestecError as e:
+        raise HttpError(409, str(e))
+    return _reserva_out(Reserva.objects.select_related("cataleg", "exemplar").get(pk=reserva.pk))
+
+
+@api.get("/reserves", response=List[ReservaOut], auth=AuthBearer())
+def llistar_reserves(request):
+    qs = (
+        Reserva.objects.filter(usuari=request.auth, estat__in=Reserva.ACTIVES)
+        .select_related("cataleg", "exemplar").order_by("data", "pk")
+    )
+    return [_reserva_out(reserva) for reserva in qs]
+
+
+@api.delete("/reserves/{id}", auth=AuthBearer())
+def cancellar_reserva(request, id: int):
+    try:
+        prestecs.cancellar_reserva(id, request.auth.pk)
+    except Reserva.DoesNotExist:
+        raise HttpError(404, "Reserva no trobada")
+    return {"cancel·lada": True}
@@ -0,0 +1,144 @@
+import threading
+import time
+from bisect import bisect_left, insort
+
+from django.conf import settings
+
+from .cerca import tokenitzar
+from .models import Cataleg, Autor, Editorial
+
+
+# Autocompletat per prefix
+#
+# Cada índex és una llista ordenada de (clau, id) en memòria del procés.
+# Per cada nom s'hi afegeix una clau per cada paraula on pot començar la
+# cerca ("merce rodoreda", "rodoreda"), de manera que "rodo" troba l'autora.
+# La cerca és un bisect + un recorregut curt, sense tocar la base de dades.
+#
+# L'índex es construeix la primera vegada que es consulta i els signals el
+# mantenen al dia dins del procés (en fer commit). Com que cada procés té la
+# seva còpia, es reconstrueix igualment passat AUTOCOMPLETE_TTL segons: només
+# ho fa una petició, mentre les altres continuen amb l'índex anterior, i els
+# canvis que arriben mentre es carrega s'hi tornen a aplicar en acabar.
+
+
+def _claus(nom):
+    tokens = tokenitzar(nom)
+    return [" ".join(tokens[i:]) for i in range(len(tokens))]
+
+
+class IndexPrefix:
+    def __init__(self, carregar):
+        self._carregar = carregar
+        self._claus = []
+        self._noms = {}
+        self._construit = 0
+        # canvis rebuts mentre es reconstrueix (None si no s'està reconstruint)
+        self._pendents = None
+        self._lock = threading.Lock()
+        self._reconstruint = threading.Lock()
+
+    def _caducat(self):
+        ttl = getattr(settings, "AUTOCOMPLETE_TTL", 300)
+        return not self._construit or time.monotonic() - self._construit > ttl
+
+    def _al_dia(self):
+        if not self._caducat():
+            return
+        if self._construit:
+            # caducat: el refà una sola petició, les altres no esperen
+            if self._reconstruint.acquire(blocking=False):
+                try:
+                    self._reconstruir()
+                finally:
+                    self._reconstruint.release()
+            return
+        # encara no n'hi ha: s'espera que el construeixi la primera
+        with self._reconstruint:
+            if not self._construit:
+                self._reconstruir()
+
+    def reconstruir(self):
+        with self._reconstruint:
+            self._reconstruir()
+
+    def _reconstruir(self):
+        with self._lock:
+            self._pendents = []
+        try:
+            noms = {pk: nom for pk, nom in self._carregar() if nom}
+            claus = sorted((clau, pk) for pk, nom in noms.items() for clau in _claus(nom))
+        except Exception:
+            with self._lock:
+                self._pendents = None
+            raise
+        with self._lock:
+            pendents, self._pendents = self._pendents, None
+            self._noms = noms
+            self._claus = claus
+            self._construit = time.monotonic()
+            for pk, nom in pendents:
+                self._posar(pk, nom)
+
+    def actualitzar(self, pk, nom):
+        with self._lock:
+            if self._pendents is not None:
+                self._pendents.append((pk, nom))
+            if self._construit:
+                self._posar(pk, nom)
+
+    def treure(self, pk):
+        self.actualitzar(pk, None)
+
+    def _posar(self, pk, nom):
+        self._treure(pk)
+        if nom:
+            self._noms[pk] = nom
+            for clau in _claus(nom):
+                insort(self._claus, (clau, pk))
+
+    def _treure(self, pk):
+        nom = self._noms.pop(pk, None)
+        if nom is None:
+            return
+        for clau in _claus(nom):
+            i = bisect_left(self._claus, (clau, pk))
+            if i < len(self._claus) and self._claus[i] == (clau, pk):
+                del self._claus[i]
+
+    def cercar(self, prefix, limit=10, offset=0):
+        self._al_dia()
+        prefix = " ".join(tokenitzar(prefix))
+        if not prefix:
+            return []
+        resultat = []
+        vistos = set()
+        with self._lock:
+            i = bisect_left(self._claus, (prefix,))
+            while i < len(self._claus) and len(resultat) < limit:
+                clau, pk = self._claus[i]
+                if not clau.startswith(prefix):
+                    break
+                if pk not in vistos:
+                    vistos.add(pk)
+                    if len(vistos) > offset:
+                        resultat.append({"id": pk, "nom": self._noms[pk]})
+                i += 1
+        return resultat
+
+    def nom(self, pk):
+        """Nom des de la memòria; None si l'índex no està carregat (no el carrega)."""
+        if self._caducat():
+            return None
+        return self._noms.get(pk)
+
+
+titols = IndexPrefix(lambda: Cataleg.objects.values_list("pk", "titol").iterator(chunk_size=5000))
+autors = IndexPrefix(lambda: Autor.objects.values_list("pk", "nom").iterator(chunk_size=5000))
+editorials = IndexPrefix(lambda: Editorial.objects.values_list("pk", "nom").iterator(chunk_size=5000))
+
+INDEXOS = {
+    "titol": titols,
+    "autor": autors,
+    "editorial": editorials,
+}
@@ -0,0 +1,219 @@
+import hashlib
+import time
+from collections import defaultdict
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import Count, Max
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.http import http_date, parse_http_date_safe, parse_etags
+from ninja.decorators import decorate_view
+
+
+# Cache de respostes de lectura del catàleg
+#
+# Es guarden els bytes de la resposta ja serialitzada, indexats per ruta i
+# paràmetres. El backend és qualsevol cache de Django (settings.CACHES["api"]):
+# memòria local amb expulsió LRU, fitxers o Redis.
+#
+# Cada endpoint pertany a un o més grups ("llibres", "exemplars",
+# "llibre:12"...). La versió d'un grup és el moment (en ns) de l'últim canvi.
+# La clau de cada entrada inclou les versions dels seus grups, de manera que
+# invalidar un grup és canviar-ne la versió: les entrades antigues ja no es
+# troben i acaben expulsades pel backend. Els signals (signals.py) invaliden
+# els grups afectats per cada escriptura.
+#
+# Amb locmemcache cada procés té les seves versions; amb diversos workers
+# cal un backend compartit (fitxers o Redis) perquè la invalidació arribi
+# a tots.
+#
+# L'ETag i el Last-Modified, en canvi, surten de la base de dades (marca()):
+# el nombre de files i l'últim updated_at de les taules de què depèn cada
+# endpoint. Així són els mateixos a tots els processos. Com que l'agregat
+# pot recórrer tota la taula, es calcula una sola vegada per cada versió
+# dels grups de l'endpoint i es guarda a la cache (clau "e") fins que
+# s'invalida algun grup; una resposta guardada porta els mateixos
+# validadors. Un 304 amb els grups sense canvis no toca la base de dades.
+
+PREFIX = "api"
+
+
+def _cache():
+    return caches[getattr(settings, "API_CACHE_ALIAS", "api")]
+
+
+def _clau_versio(grup):
+    return f"{PREFIX}:v:{grup}"
+
+
+def versions(grups):
+    cache = _cache()
+    claus = [_clau_versio(g) for g in grups]
+    trobades = cache.get_many(claus)
+    for clau in claus:
+        if clau not in trobades:
+            # versió inicial basada en el rellotge: si una versió s'expulsa,
+            # la nova no pot coincidir amb una d'anterior
+            cache.add(clau, time.time_ns(), timeout=None)
+            trobades[clau] = cache.get(clau)
+    return [trobades[clau] for clau in claus]
+
+
+def invalidar(*grups):
+    # la nova versió és el moment del canvi (ns); serveix també de Last-Modified
+    ara = time.time_ns()
+    _cache().set_many({_clau_versio(g): ara for g in grups}, timeout=None)
+
+
+def invalidar_en_commit(*grups):
+    transaction.on_commit(lambda: invalidar(*grups))
+
+
+def _metrica(nom, resultat):
+    cache = _cache()
+    clau = f"{PREFIX}:m:{nom}:{resultat}"
+    try:
+        cache.incr(clau)
+    except ValueError:
+        cache.add(clau, 1, timeout=None)
+
+
+def metriques(noms):
+    cache = _cache()
+    resultat = {}
+    for nom in noms:
+        hits = cache.get(f"{PREFIX}:m:{nom}:hit", 0)
+        misses = cache.get(f"{PREFIX}:m:{nom}:miss", 0)
+        total = hits + misses
+        resultat[nom] = {
+            "hits": hits,
+            "misses": misses,
+            "ratio": round(hits / total, 4) if total else 0.0,
+        }
+    return resultat
+
+
+ENDPOINTS = []
+
+
+def marca(querysets):
+    """
+    Validadors a partir de la base de dades: (files, últim updated_at) de
+    cada queryset. Retorna (valors, ultima), amb ultima el més recent.
+    """
+    valors, ultima = [], None
+    for qs in querysets:
+        fila = qs.order_by().aggregate(n=Count("pk"), ultima=Max("updated_at"))
+        valors.append((fila["n"], fila["ultima"] and fila["ultima"].isoformat()))
+        if fila["ultima"] is not None and (ultima is None or fila["ultima"] > ultima):
+            ultima = fila["ultima"]
+    return valors, ultima
+
+
+def _params(request, kwargs):
+    # paràmetres de ruta i de query, per completar grups i marques
+    return {**request.GET.dict(), **kwargs}
+
+
+def _ruta(request):
+    return f"{request.path}?{request.META.get('QUERY_STRING', '')}"
+
+
+def _validadors(nom, marques, request, params):
+    valors, ultima = marca(marques(params))
+    etag = '"%s"' % hashlib.sha1(f"{nom}:{_ruta(request)}:{valors}".encode()).hexdigest()
+    return etag, int(ultima.timestamp()) if ultima else 0
+
+
+def _no_modificat(request, etag, ultima):
+    if_none_match = request.META.get("HTTP_IF_NONE_MATCH")
+    if if_none_match:
+        etags = parse_etags(if_none_match)
+        return "*" in etags or etag in etags
+    des_de = parse_http_date_safe(request.META.get("HTTP_IF_MODIFIED_SINCE", ""))
+    return des_de is not None and ultima <= des_de
+
+
+def _amb_validadors(resposta, etag, ultima):
+    resposta["ETag"] = etag
+    resposta["Last-Modified"] = http_date(ultima)
+    return resposta
+
+
+def lectura(nom, *grups, marques, cache=True):
+    """
+    Decorador d'una operació GET de ninja (via decorate_view):
+
+    - marques(params) torna els querysets de què depèn la resposta; en
+      surten l'ETag i el Last-Modified (marca()), un cop per versió dels
+      grups. Si el client ja té la versió actual es respon 304 abans de
+      mirar la cache de respostes o executar la vista.
+    - amb cache=True la resposta es guarda a la cache, amb els validadors,
+      fins que s'invalida algun dels grups. Els grups poden fer servir
+      paràmetres de ruta o de query: "llibre:{id}".
+    """
+    if cache:
+        ENDPOINTS.append(nom)
+
+    def decorador(vista):
+        @wraps(vista)
+        def wrapper(request, *args, **kwargs):
+            if request.method not in ("GET", "HEAD"):
+                return vista(request, *args, **kwargs)
+
+            params = _params(request, kwargs)
+            sufix = None
+            if grups:
+                grups_resolts = [g.format_map(defaultdict(str, params)) for g in grups]
+                versio = ".".join(str(v) for v in versions(grups_resolts))
+                sufix = f"{nom}:{versio}:{hashlib.sha1(_ruta(request).encode()).hexdigest()}"
+
+            def validadors_actuals():
+                if sufix is None:
+                    return _validadors(nom, marques, request, params)
+                clau_validadors = f"{PREFIX}:e:{sufix}"
+                guardats = _cache().get(clau_validadors)
+                if guardats is None:
+                    guardats = _validadors(nom, marques, request, params)
+                    _cache().set(clau_validadors, guardats, getattr(settings, "API_CACHE_TIMEOUT", 300))
+                return guardats
+
+            validadors = None
+            if "HTTP_IF_NONE_MATCH" in request.META or "HTTP_IF_MODIFIED_SINCE" in request.META:
+                validadors = validadors_actuals()
+                if _no_modificat(request, *validadors):
+                    return _amb_validadors(HttpResponseNotModified(), *validadors)
+
+            clau = None
+            if cache and sufix is not None:
+                clau = f"{PREFIX}:r:{sufix}"
+                guardat = _cache().get(clau)
+                if guardat is not None:
+                    _metrica(nom, "hit")
+                    contingut, content_type, etag, ultima = guardat
+                    resposta = HttpResponse(contingut, content_type=content_type)
+                    resposta["X-Cache"] = "HIT"
+                    return _amb_validadors(resposta, etag, ultima)
+                _metrica(nom, "miss")
+
+            # abans de la vista: una escriptura mentre s'executa deixa un
+            # ETag antic (el client tornarà a demanar), mai un de nou amb
+            # dades velles
+            if validadors is None:
+                validadors = validadors_actuals()
+            resposta = vista(request, *args, **kwargs)
+            if clau is not None:
+                if resposta.status_code == 200 and not resposta.streaming:
+                    _cache().set(
+                        clau,
+                        (resposta.content, resposta["Content-Type"], *validadors),
+                        getattr(settings, "API_CACHE_TIMEOUT", 300),
+                    )
+                resposta["X-Cache"] = "MISS"
+            if resposta.status_code != 200:
+                return resposta
+            return _amb_validadors(resposta, *validadors)
+        return wrapper
+    return decorate_view(decorador)
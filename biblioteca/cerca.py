@@ -0,0 +1,219 @@
+import re
+import unicodedata
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q, Sum
+
+from .models import Cataleg, TermeCerca
+
+
+# Cerca al catàleg
+#
+# Índex invertit sobre els camps textuals del catàleg. El text es normalitza
+# (minúscules i sense accents) abans d'indexar-lo i abans de cercar, de manera
+# que "rodoreda", "Rodoreda" i "RODORÉDA" troben el mateix.
+#
+# Hi ha dos backends:
+#   - Fts5Backend: taula virtual FTS5 de SQLite amb rànquing bm25.
+#   - TermesBackend: taula TermeCerca (terme, cataleg, pes) indexada per terme,
+#     portable a MySQL i PostgreSQL.
+# El backend es tria segons la connexió o amb settings.CERCA_BACKEND.
+#
+# L'última paraula de la consulta es busca com a prefix ("rodo" troba
+# "rodoreda") si té com a mínim CERCA_MIN_PREFIX lletres; si és més curta,
+# com a paraula sencera. Un model (p. ex. Llibre) restringeix la cerca als
+# seus registres abans d'aplicar el límit de resultats.
+
+FTS_TAULA = "biblioteca_cerca_fts"
+
+# pes de cada camp en el rànquing
+PESOS = {
+    "titol": 10.0,
+    "titol_original": 5.0,
+    "resum": 1.0,
+    "autor": 6.0,
+    "editorial": 2.0,
+    "isbn": 10.0,
+}
+
+# camp de l'índex -> columna de Cataleg.objects.values()
+COLUMNES = {
+    "titol": "titol",
+    "titol_original": "titol_original",
+    "resum": "resum",
+    "autor": "autor__nom",
+    "editorial": "editorial__nom",
+    "isbn": "llibre__ISBN",
+}
+
+_PARAULA = re.compile(r"\w+")
+
+
+def normalitzar(text):
+    if not text:
+        return ""
+    text = unicodedata.normalize("NFKD", str(text))
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return text.lower()
+
+
+def tokenitzar(text):
+    return _PARAULA.findall(normalitzar(text))
+
+
+def documents(ids=None):
+    """Files normalitzades {id, camp: text} llestes per indexar."""
+    qs = Cataleg.objects.order_by()
+    if ids is not None:
+        qs = qs.filter(pk__in=ids)
+    for fila in qs.values("id", *COLUMNES.values()).iterator(chunk_size=2000):
+        doc = {camp: normalitzar(fila[columna]) for camp, columna in COLUMNES.items()}
+        doc["id"] = fila["id"]
+        yield doc
+
+
+class Fts5Backend:
+    nom = "fts5"
+
+    def indexar(self, docs):
+        camps = list(PESOS)
+        with connection.cursor() as cursor:
+            for doc in docs:
+                cursor.execute(f"DELETE FROM {FTS_TAULA} WHERE rowid = %s", [doc["id"]])
+                cursor.execute(
+                    f"INSERT INTO {FTS_TAULA} (rowid, {', '.join(camps)}) "
+                    f"VALUES (%s, {', '.join(['%s'] * len(camps))})",
+                    [doc["id"]] + [doc[camp] for camp in camps],
+                )
+
+    def esborrar(self, ids):
+        with connection.cursor() as cursor:
+            for pk in ids:
+                cursor.execute(f"DELETE FROM {FTS_TAULA} WHERE rowid = %s", [pk])
+
+    def buidar(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {FTS_TAULA}")
+
+    def cercar(self, tokens, limit, prefix=True, model=None):
+        # totes les paraules han d'aparèixer; l'última, si cal, com a prefix
+        consulta = " ".join(f'"{t}"' for t in tokens)
+        if prefix:
+            consulta += "*"
+        pesos = ", ".join(str(p) for p in PESOS.values())
+        restriccio = ""
+        if model is not None:
+            restriccio = f" AND rowid IN (SELECT {model._meta.pk.column} FROM {model._meta.db_table})"
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT rowid FROM {FTS_TAULA} WHERE {FTS_TAULA} MATCH %s{restriccio} "
+                f"ORDER BY bm25({FTS_TAULA}, {pesos}) LIMIT %s",
+                [consulta, limit],
+            )
+            return [fila[0] for fila in cursor.fetchall()]
+
+
+class TermesBackend:
+    nom = "termes"
+
+    def indexar(self, docs):
+        docs = list(docs)
+        TermeCerca.objects.filter(cataleg_id__in=[d["id"] for d in docs]).delete()
+        termes = []
+        for doc in docs:
+            pesos = defaultdict(float)
+            for camp, pes in PESOS.items():
+                for token in _PARAULA.findall(doc[camp]):
+                    pesos[token[:TermeCerca.MAX_TERME]] += pes
+            termes.extend(
+                TermeCerca(terme=terme, cataleg_id=doc["id"], pes=pes)
+                for terme, pes in pesos.items()
+            )
+        TermeCerca.objects.bulk_create(termes, batch_size=2000)
+
+    def esborrar(self, ids):
+        TermeCerca.objects.filter(cataleg_id__in=ids).delete()
+
+    def buidar(self):
+        TermeCerca.objects.all().delete()
+
+    def cercar(self, tokens, limit, prefix=True, model=None):
+        # Una sola consulta: els registres han de tenir totes les paraules
+        # (una subconsulta per paraula) i la base de dades suma els pesos,
+        # ordena i talla. Només viatgen `limit` files, encara que el prefix
+        # d'una lletra toqui milers de termes.
+        condicions = []
+        for i, token in enumerate(tokens):
+            token = token[:TermeCerca.MAX_TERME]
+            if prefix and i == len(tokens) - 1:
+                condicions.append(Q(terme__startswith=token))
+            else:
+                condicions.append(Q(terme=token))
+        qs = TermeCerca.objects.filter(Q(*condicions, _connector=Q.OR))
+        if len(condicions) > 1:
+            qs = qs.filter(*(
+                Q(cataleg_id__in=TermeCerca.objects.filter(condicio).values("cataleg_id"))
+                for condicio in condicions
+            ))
+        if model is not None:
+            qs = qs.filter(cataleg_id__in=model.objects.values("pk"))
+        return list(
+            qs.values("cataleg_id").annotate(puntuacio=Sum("pes"))
+            .order_by("-puntuacio", "cataleg_id").values_list("cataleg_id", flat=True)[:limit]
+        )
+
+
+_backend = None
+
+
+def backend():
+    global _backend
+    if _backend is None:
+        nom = getattr(settings, "CERCA_BACKEND", None)
+        if nom is None:
+            fts = connection.vendor == "sqlite" and FTS_TAULA in connection.introspection.table_names()
+            nom = "fts5" if fts else "termes"
+        _backend = Fts5Backend() if nom == "fts5" else TermesBackend()
+    return _backend
+
+
+def cercar(text, limit=None, model=None):
+    """Ids de Cataleg (o només dels registres de model) ordenats per rellevància."""
+    tokens = tokenitzar(text)
+    if not tokens:
+        return []
+    limit = limit or getattr(settings, "CERCA_MAX_RESULTATS", 500)
+    prefix = len(tokens[-1]) >= getattr(settings, "CERCA_MIN_PREFIX", 2)
+    return backend().cercar(tokens, limit, prefix, model)
+
+
+def indexar(ids):
+    ids = list(ids)
+    if ids:
+        backend().indexar(documents(ids))
+
+
+def desindexar(ids):
+    ids = list(ids)
+    if ids:
+        backend().esborrar(ids)
+
+
+def reindexar_tot(mida_lot=2000):
+    b = backend()
+    total = 0
+    with transaction.atomic():
+        b.buidar()
+        lot = []
+        for doc in documents():
+            lot.append(doc)
+            if len(lot) >= mida_lot:
+                b.indexar(lot)
+                total += len(lot)
+                lot = []
+        if lot:
+            b.indexar(lot)
+            total += len(lot)
+    return total
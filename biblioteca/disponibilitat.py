@@ -0,0 +1,124 @@
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import Count
+from django.utils import timezone
+
+from .models import (
+    Cataleg, Exemplar, Reserva, DisponibilitatCentre, comptadors_exemplars
+)
+
+
+# Comptadors de disponibilitat materialitzats
+#
+# Cataleg.comptador_* i DisponibilitatCentre guarden quants exemplars té cada
+# registre (en total i per centre), quants estan disponibles, en préstec o
+# reservats. Cada escriptura que els afecta recalcula els comptadors dels
+# catàlegs tocats dins la mateixa transacció, amb la fila de Cataleg
+# bloquejada, de manera que dues escriptures concurrents no es trepitgen.
+# Les operacions massives (bulk_create/update) han de cridar recalcular().
+
+CAMPS = ("exemplars", "disponibles", "prestec", "reserves")
+
+
+def calcular(cataleg_ids):
+    """
+    Comptadors reals a partir d'Exemplar, Prestec i Reserva.
+    Retorna {cataleg_id: {centre_id: {camp: n}}}.
+    """
+    resultat = defaultdict(lambda: defaultdict(lambda: dict.fromkeys(CAMPS, 0)))
+    files = (
+        Exemplar.objects.filter(cataleg_id__in=cataleg_ids)
+        .order_by()
+        .values("cataleg_id", "centre_id")
+        .annotate(**comptadors_exemplars())
+    )
+    for fila in files:
+        comptadors = resultat[fila["cataleg_id"]][fila["centre_id"]]
+        comptadors["exemplars"] = fila["n_exemplars"]
+        comptadors["disponibles"] = fila["n_disponibles"]
+        comptadors["prestec"] = fila["n_prestec"]
+    # les reserves en espera encara no tenen exemplar: compten al total del
+    # registre (centre None) però no a cap centre
+    reserves = (
+        Reserva.objects.filter(cataleg_id__in=cataleg_ids, estat__in=Reserva.ACTIVES)
+        .order_by()
+        .values("cataleg_id", "exemplar__centre_id")
+        .annotate(n=Count("pk"))
+    )
+    for fila in reserves:
+        resultat[fila["cataleg_id"]][fila["exemplar__centre_id"]]["reserves"] = fila["n"]
+    return resultat
+
+
+def per_centre(calculat_cataleg):
+    return {centre: dict(c) for centre, c in calculat_cataleg.items() if centre is not None}
+
+
+def totals(per_centre):
+    return {camp: sum(c[camp] for c in per_centre.values()) for camp in CAMPS}
+
+
+def desar(cataleg_ids, calculat):
+    catalegs = []
+    ara = timezone.now()
+    for pk in cataleg_ids:
+        total = totals(calculat.get(pk, {}))
+        catalegs.append(Cataleg(
+            pk=pk,
+            comptador_exemplars=total["exemplars"],
+            comptador_disponibles=total["disponibles"],
+            comptador_prestec=total["prestec"],
+            comptador_reserves=total["reserves"],
+            updated_at=ara,
+        ))
+    Cataleg.objects.bulk_update(
+        catalegs,
+        ["comptador_exemplars", "comptador_disponibles", "comptador_prestec",
+         "comptador_reserves", "updated_at"],
+    )
+    DisponibilitatCentre.objects.filter(cataleg_id__in=cataleg_ids).delete()
+    DisponibilitatCentre.objects.bulk_create([
+        DisponibilitatCentre(cataleg_id=pk, centre_id=centre_id, **comptadors)
+        for pk, comptadors_cataleg in calculat.items()
+        for centre_id, comptadors in per_centre(comptadors_cataleg).items()
+    ])
+
+
+def recalcular(cataleg_ids):
+    ids = sorted({pk for pk in cataleg_ids if pk is not None})
+    if not ids:
+        return
+    with transaction.atomic():
+        # bloqueja els catàlegs en ordre per evitar interbloquejos
+        ids = list(
+            Cataleg.objects.select_for_update().filter(pk__in=ids)
+            .order_by("pk").values_list("pk", flat=True)
+        )
+        desar(ids, calcular(ids))
+
+
+def derives(cataleg_ids):
+    """Ids dels catàlegs amb comptadors que no quadren amb les dades reals."""
+    calculat = calcular(cataleg_ids)
+    guardat = defaultdict(dict)
+    for fila in DisponibilitatCentre.objects.filter(cataleg_id__in=cataleg_ids).values(
+        "cataleg_id", "centre_id", *CAMPS
+    ):
+        guardat[fila["cataleg_id"]][fila["centre_id"]] = {camp: fila[camp] for camp in CAMPS}
+
+    errors = []
+    for pk, exemplars, disponibles, prestec, reserves in Cataleg.objects.filter(
+        pk__in=cataleg_ids
+    ).values_list(
+        "pk", "comptador_exemplars", "comptador_disponibles", "comptador_prestec", "comptador_reserves"
+    ):
+        real = calculat.get(pk, {})
+        total = dict(zip(CAMPS, (exemplars, disponibles, prestec, reserves)))
+        if total != totals(real) or guardat.get(pk, {}) != per_centre(real):
+            errors.append(pk)
+    return errors
+
+
+def cataleg_de_exemplar(exemplar_id):
+    return Exemplar.objects.filter(pk=exemplar_id).values_list("cataleg_id", flat=True).first()
@@ -0,0 +1,356 @@
+import threading
+import time
+
+from django.conf import settings
+
+from . import cache_api
+from .models import BR, CD, DVD, Cataleg, Categoria, Dispositiu, Editorial, Llengua, Llibre, Pais, Revista
+
+
+# Facetes del catàleg
+#
+# Per cada valor de faceta ("llengua" 3, "decada" 1970, "tipus" "cd"...) hi
+# ha els registres de Cataleg que el tenen, sense GROUP BY a la base de
+# dades. Cada registre té una posició compacta (0, 1, 2... en l'ordre en què
+# entra a l'índex), de manera que la mida no depèn del pk més gran.
+#
+# Els valors freqüents són bitsets (un int amb el bit de cada posició):
+# intersecar és un AND i comptar és int.bit_count(), tot en C. Un bitset
+# ocupa el mateix per a 10 registres que per a 10.000, així que els valors
+# rars (la majoria d'editorials i països) es guarden com a frozenset de
+# posicions, que ocupen segons els registres que tenen. El llindar és DENS:
+# un valor és bitset si el té almenys un de cada DENS registres.
+#
+# Les consultes no agafen cap lock: llegeixen una instantània immutable
+# (_Instantania) i les actualitzacions en construeixen una de nova i la
+# substitueixen d'un sol cop.
+#
+# Una categoria compta els registres de tot el seu subarbre: en carregar-los,
+# els tags s'expandeixen als ancestres a partir de Categoria.cami.
+#
+# L'índex viu a la memòria del procés i es construeix la primera vegada que
+# es consulta. Els signals publiquen els ids de cada canvi en un registre
+# numerat a la cache de l'API (actualitzar()); cada procés, en consultar,
+# torna a llegir només aquests registres. Es reconstrueix sencer si la
+# versió del grup "facetes" canvia (facetes.invalidar(): categories,
+# importacions massives), si falten canvis al registre o passats FACETES_TTL
+# segons, per si alguna escriptura no ha passat pels signals.
+
+GRUP = "facetes"
+
+TIPUS = {
+    "llibre": Llibre,
+    "revista": Revista,
+    "cd": CD,
+    "dvd": DVD,
+    "br": BR,
+    "dispositiu": Dispositiu,
+}
+
+# faceta -> model amb els noms dels valors
+MODELS = {
+    "llengua": Llengua,
+    "pais": Pais,
+    "editorial": Editorial,
+    "categoria": Categoria,
+}
+
+FACETES = ("tipus", "llengua", "pais", "editorial", "categoria", "decada")
+
+
+def decada(data):
+    return data.year // 10 * 10 if data else None
+
+
+def valors(ids=None):
+    """{cataleg_id: {(faceta, valor), ...}} dels registres indicats (o tots)."""
+    def filtrar(qs, camp="pk"):
+        qs = qs.order_by()
+        return qs if ids is None else qs.filter(**{f"{camp}__in": ids})
+
+    resultat = {}
+    files = filtrar(Cataleg.objects).values_list("pk", "llengua_id", "pais_id", "editorial_id", "data_edicio")
+    for pk, llengua, pais, editorial, data in files.iterator(chunk_size=5000):
+        parells = {("llengua", llengua), ("pais", pais), ("editorial", editorial), ("decada", decada(data))}
+        resultat[pk] = {(faceta, valor) for faceta, valor in parells if valor is not None}
+    for nom, model in TIPUS.items():
+        for pk in filtrar(model.objects).values_list("pk", flat=True).iterator(chunk_size=5000):
+            resultat[pk].add(("tipus", nom))
+    tags = filtrar(Cataleg.tags.through.objects, "cataleg_id").values_list("cataleg_id", "categoria__cami")
+    for pk, cami in tags.iterator(chunk_size=5000):
+        resultat[pk].update(("categoria", int(segment)) for segment in cami.split(".") if segment)
+    return resultat
+
+
+# canvis pendents a partir dels quals surt més a compte reconstruir
+MAX_CANVIS = 1000
+
+
+def _clau_seq():
+    return f"{cache_api.PREFIX}:{GRUP}:seq"
+
+
+def _clau_canvi(n):
+    return f"{cache_api.PREFIX}:{GRUP}:canvi:{n}"
+
+
+def _seq():
+    cache = cache_api._cache()
+    seq = cache.get(_clau_seq())
+    if seq is None:
+        # com les versions de cache_api: si s'expulsa, no torna a començar per 0
+        cache.add(_clau_seq(), time.time_ns(), timeout=None)
+        seq = cache.get(_clau_seq())
+    return seq
+
+
+def _publicar(ids):
+    cache = cache_api._cache()
+    _seq()
+    n = cache.incr(_clau_seq())
+    cache.set(_clau_canvi(n), ids, timeout=_ttl())
+    return n
+
+
+def _ttl():
+    return getattr(settings, "FACETES_TTL", 900)
+
+
+# un valor és bitset si el té almenys 1 de cada DENS registres
+DENS = 32
+
+
+def _bits(posicions, mida):
+    octets = bytearray(mida // 8 + 1)
+    for p in posicions:
+        octets[p >> 3] |= 1 << (p & 7)
+    return int.from_bytes(octets, "little")
+
+
+def _octets(bits, mida):
+    return bits.to_bytes(mida // 8 + 1, "little")
+
+
+def _forma(posicions, mida):
+    if len(posicions) * DENS >= mida:
+        return _bits(posicions, mida)
+    return frozenset(posicions)
+
+
+def _len(conjunt):
+    return conjunt.bit_count() if isinstance(conjunt, int) else len(conjunt)
+
+
+def _interseccio(conjunts, mida):
+    """AND dels bitsets i & dels frozensets (del més petit al més gran)."""
+    bits = None
+    for conjunt in conjunts:
+        if isinstance(conjunt, int):
+            bits = conjunt if bits is None else bits & conjunt
+    petits = sorted((c for c in conjunts if not isinstance(c, int)), key=len)
+    if not petits:
+        return bits
+    resultat = petits[0]
+    for conjunt in petits[1:]:
+        resultat = resultat & conjunt
+    if bits is not None:
+        octets = _octets(bits, mida)
+        resultat = frozenset(p for p in resultat if octets[p >> 3] >> (p & 7) & 1)
+    return resultat
+
+
+def _comptar(valors, seleccio, snap):
+    """{valor: n} dels valors d'una faceta dins de la selecció."""
+    if seleccio is snap.tots:
+        return {valor: _len(conjunt) for valor, conjunt in valors.items()}
+    resultat = {}
+    if isinstance(seleccio, int):
+        # selecció àmplia: AND amb els bitsets, i els valors rars es miren
+        # bit a bit (en total, com a molt un de cada DENS registres per valor)
+        octets = None
+        for valor, conjunt in valors.items():
+            if isinstance(conjunt, int):
+                resultat[valor] = (conjunt & seleccio).bit_count()
+            else:
+                octets = octets or _octets(seleccio, snap.mida)
+                resultat[valor] = sum(octets[p >> 3] >> (p & 7) & 1 for p in conjunt)
+    else:
+        # selecció petita: es passa a bitset una vegada per als valors freqüents
+        bits = None
+        for valor, conjunt in valors.items():
+            if isinstance(conjunt, int):
+                bits = bits if bits is not None else _bits(seleccio, snap.mida)
+                resultat[valor] = (conjunt & bits).bit_count()
+            else:
+                resultat[valor] = len(conjunt & seleccio)
+    return resultat
+
+
+class _Instantania:
+    """
+    Estat de l'índex que llegeixen les consultes; no es modifica mai.
+    conjunts: {faceta: {valor: int o frozenset de posicions}}; tots: bitset
+    dels registres presents; mida: posicions assignades fins ara.
+    """
+    __slots__ = ("conjunts", "tots", "mida", "posicio")
+
+    def __init__(self, conjunts, tots, mida, posicio):
+        self.conjunts, self.tots, self.mida = conjunts, tots, mida
+        # {pk: posició}. És del fil que actualitza (només s'hi afegeixen pks
+        # nous i se'n treuen els esborrats, mai no es reaprofita una posició
+        # fins a reconstruir): les consultes només en fan servir les
+        # posicions < mida que són a tots.
+        self.posicio = posicio
+
+
+class IndexFacetes:
+    def __init__(self):
+        self._snap = _Instantania({faceta: {} for faceta in FACETES}, 0, 0, {})
+        # {pk: {(faceta, valor), ...}}, només per als fils que actualitzen
+        self._valors = {}
+        self._versio = None
+        # últim canvi del registre aplicat
+        self._seq = None
+        self._construit = 0
+        # un sol fil alhora reconstrueix o aplica canvis
+        self._refrescant = threading.Lock()
+
+    def _al_dia(self):
+        with self._refrescant:
+            versio = cache_api.versions([GRUP])[0]
+            seq = _seq()
+            caducat = not self._construit or time.monotonic() - self._construit > _ttl()
+            if caducat or versio != self._versio or seq < self._seq or seq - self._seq > MAX_CANVIS:
+                self._reconstruir(versio, seq)
+            elif seq != self._seq:
+                canvis = cache_api._cache().get_many([_clau_canvi(n) for n in range(self._seq + 1, seq + 1)])
+                if len(canvis) < seq - self._seq:
+                    # expulsats o encara no escrits
+                    self._reconstruir(versio, seq)
+                    return
+                self._aplicar({pk for ids in canvis.values() for pk in ids})
+                self._seq = seq
+
+    def reconstruir(self):
+        with self._refrescant:
+            self._reconstruir(cache_api.versions([GRUP])[0], _seq())
+
+    def _reconstruir(self, versio, seq):
+        # versio i seq es llegeixen abans que les dades: un canvi posterior
+        # es tornarà a aplicar, no es perd
+        per_doc = valors()
+        posicio = {}
+        conjunts = {faceta: {} for faceta in FACETES}
+        for p, (pk, parells) in enumerate(per_doc.items()):
+            posicio[pk] = p
+            for faceta, valor in parells:
+                conjunts[faceta].setdefault(valor, set()).add(p)
+        mida = len(posicio)
+        conjunts = {
+            faceta: {valor: _forma(posicions, mida) for valor, posicions in per_valor.items()}
+            for faceta, per_valor in conjunts.items()
+        }
+        self._valors = per_doc
+        self._snap = _Instantania(conjunts, (1 << mida) - 1, mida, posicio)
+        self._versio, self._seq = versio, seq
+        self._construit = time.monotonic()
+
+    def _aplicar(self, ids):
+        ids = list(ids)
+        nous = {}
+        for i in range(0, len(ids), 1000):
+            nous.update(valors(ids[i:i + 1000]))
+        snap = self._snap
+        posicio, mida, tots = snap.posicio, snap.mida, snap.tots
+        treure, afegir = {}, {}
+        for pk in ids:
+            p = posicio.get(pk)
+            for parell in self._valors.pop(pk, ()):
+                treure.setdefault(parell, set()).add(p)
+            if pk in nous:
+                if p is None:
+                    p, mida = mida, mida + 1
+                    posicio[pk] = p
+                    tots |= 1 << p
+                self._valors[pk] = nous[pk]
+                for parell in nous[pk]:
+                    afegir.setdefault(parell, set()).add(p)
+            elif p is not None:
+                del posicio[pk]
+                tots &= ~(1 << p)
+
+        # només es copien els valors que canvien; la resta es comparteixen
+        conjunts = {faceta: dict(per_valor) for faceta, per_valor in snap.conjunts.items()}
+        for faceta, valor in treure.keys() | afegir.keys():
+            fora, dins = treure.get((faceta, valor), set()), afegir.get((faceta, valor), set())
+            conjunt = conjunts[faceta].get(valor, frozenset())
+            if isinstance(conjunt, int):
+                conjunt = conjunt & ~_bits(fora, mida) | _bits(dins, mida)
+            else:
+                conjunt = _forma((conjunt - fora) | dins, mida)
+            if _len(conjunt):
+                conjunts[faceta][valor] = conjunt
+            else:
+                conjunts[faceta].pop(valor, None)
+        self._snap = _Instantania(conjunts, tots, mida, posicio)
+
+    def actualitzar(self, ids):
+        """Torna a llegir els registres indicats (els que ja no hi són surten de l'índex)."""
+        ids = list(ids)
+        if not ids:
+            return
+        # els altres processos el llegiran del registre en la propera consulta
+        n = _publicar(ids)
+        # si algú l'està refrescant, ja ho recollirà la propera consulta
+        if not self._refrescant.acquire(blocking=False):
+            return
+        try:
+            if self._seq == n - 1:
+                self._aplicar(ids)
+                self._seq = n
+        finally:
+            self._refrescant.release()
+
+    def comptar(self, filtres, ids=None, limit=None):
+        """
+        Recomptes de cada faceta amb els filtres {faceta: valor}. Cada faceta
+        es compta amb els filtres de les altres, no amb el seu, perquè es
+        vegin les alternatives. ids restringeix a un conjunt (p. ex. una cerca).
+        Retorna (total, {faceta: [(valor, n), ...]}) de més a menys.
+        """
+        self._al_dia()
+        limit = limit or getattr(settings, "FACETES_MAX_VALORS", 50)
+        snap = self._snap
+        base = [snap.tots]
+        if ids is not None:
+            posicions = (snap.posicio.get(pk) for pk in ids)
+            base.append(frozenset(p for p in posicions if p is not None and p < snap.mida))
+        seleccio = {f: snap.conjunts[f].get(v, frozenset()) for f, v in filtres.items()}
+        total = _len(_interseccio(base + list(seleccio.values()), snap.mida))
+        recomptes = {}
+        for faceta in FACETES:
+            conjunt = _interseccio(base + [c for altra, c in seleccio.items() if altra != faceta], snap.mida)
+            ordenats = sorted(
+                ((valor, n) for valor, n in _comptar(snap.conjunts[faceta], conjunt, snap).items() if n),
+                key=lambda item: (-item[1], str(item[0])),
+            )
+            recomptes[faceta] = ordenats[:limit]
+        return total, recomptes
+
+
+index = IndexFacetes()
+
+
+def invalidar():
+    """Per a escriptures massives que no passen pels signals."""
+    cache_api.invalidar(GRUP)
+
+
+def noms(recomptes):
+    """{faceta: {valor: nom}} dels valors que surten als recomptes."""
+    resultat = {"tipus": {nom: str(model._meta.verbose_name) for nom, model in TIPUS.items()}}
+    for faceta, model in MODELS.items():
+        pks = [valor for valor, _ in recomptes.get(faceta, [])]
+        resultat[faceta] = dict(model.objects.filter(pk__in=pks).values_list("pk", "nom"))
+    resultat["decada"] = {valor: f"{valor}s" for valor, _ in recomptes.get("decada", [])}
+    return resultat
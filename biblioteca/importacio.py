@@ -0,0 +1,551 @@
+import csv
+import io
+import json
+import re
+import time
+from datetime import date
+from itertools import islice
+
+from django.contrib.auth.hashers import make_password
+from django.db import connection, transaction
+
+from . import cache_api, cerca, facetes
+from .models import (
+    Autor, Cataleg, Categoria, Centre, Editorial, Grup, Llengua, Llibre, Pais,
+    Revista, Rol, Usuari,
+)
+
+
+# Importació massiva d'usuaris des de CSV
+#
+# El fitxer es llegeix en streaming des de la pujada (sense desar-lo a disc)
+# i es processa per lots de MIDA_LOT files. Per cada lot hi ha una consulta
+# per saber quins emails ja existeixen, un bulk_create d'usuaris i un altre
+# de la pertinença al rol "usuari". Centres i grups es carreguen una sola
+# vegada al principi i els que falten es creen en bloc. La contrasenya per
+# defecte es calcula una sola vegada (PBKDF2 és car a propòsit). Cada lot és
+# una transacció: una importació llarga en segon pla (tasques.py) va fent
+# visible el progrés i no bloqueja la base de dades tota l'estona. El
+# progrés es desa dins la transacció del lot, de manera que una tasca
+# interrompuda pot continuar a partir de la fila inici sense repetir res.
+#
+# bulk_create no crida Usuari.save() ni els signals: el rol "usuari" que
+# afegeix save() s'afegeix aquí directament a la taula intermèdia.
+
+MIDA_LOT = 2000
+PASSWORD_DEFECTE = "1234"
+CAMPS_OBLIGATORIS = ("nom", "cognom1", "cognom2", "telefon", "centre", "grup")
+
+
+def validar_nombre(nombre):
+    # Ejemplo de validación: no vacío y solo letras
+    if not nombre:
+        raise ValueError("El nombre está vacío.")
+    if not nombre.isalpha():
+        raise ValueError(f"Nombre inválido: '{nombre}' contiene caracteres no permitidos.")
+
+
+def validar_telefono(telefono):
+    # Validación simple: debe ser numérico y contener al menos 9 dígitos
+    if not telefono or not telefono.isdigit() or len(telefono) < 9:
+        raise ValueError("Teléfono inválido. Debe contener al menos 9 dígitos numéricos.")
+
+
+def llegir_csv(fitxer, encoding="utf-8"):
+    """Files netes (dicts) d'un fitxer binari, sense carregar-lo sencer."""
+    text = io.TextIOWrapper(fitxer, encoding=encoding, newline="")
+    try:
+        for row in csv.DictReader(text):
+            fila = {
+                (clau or "").strip(): (valor.strip() if isinstance(valor, str) else "")
+                for clau, valor in row.items()
+            }
+            if any(fila.values()):
+                yield fila
+    finally:
+        # no tanquis el fitxer de la pujada en tancar el wrapper
+        text.detach()
+
+
+def lots(files, mida):
+    files = iter(files)
+    while lot := list(islice(files, mida)):
+        yield lot
+
+
+def validar_fila(fila):
+    """Retorna (email, dades) o llança ValueError amb el missatge de l'error."""
+    email = (fila.get("email") or "").replace(" ", "").lower()
+    if not email or "@" not in email:
+        raise ValueError("Email vacío o inválido")
+    dades = {camp: fila.get(camp) or "" for camp in CAMPS_OBLIGATORIS}
+    if not all(dades.values()):
+        raise ValueError("Faltan campos obligatorios.")
+    validar_nombre(dades["nom"])
+    validar_nombre(dades["cognom1"])
+    validar_nombre(dades["cognom2"])
+    validar_telefono(dades["telefon"])
+    return email, dades
+
+
+def _per_nom(model, noms, existents):
+    """Completa {nom: pk} creant en bloc els noms que falten."""
+    nous = sorted(set(noms) - existents.keys())
+    if nous:
+        model.objects.bulk_create([model(nom=nom) for nom in nous])
+        existents.update(
+            model.objects.filter(nom__in=nous).values_list("nom", "pk")
+        )
+    return existents
+
+
+def _carregar_noms(model):
+    # si hi ha noms repetits es queda el primer, com get_or_create
+    noms = {}
+    for nom, pk in model.objects.order_by("-pk").values_list("nom", "pk"):
+        noms[nom] = pk
+    return noms
+
+
+def importar_usuaris(fitxer, mida_lot=MIDA_LOT, progres=None, inici=0):
+    """
+    Crea els usuaris del CSV. Retorna (creats, errors), on errors és una
+    llista de {"fila": ..., "error": ...} amb les files descartades.
+    Si es dona progres, es crida al final de cada lot, dins la seva
+    transacció, amb (files processades, usuaris creats, errors). inici és
+    el nombre de files que ja s'han processat i se salten.
+    """
+    password = make_password(PASSWORD_DEFECTE)
+    errors = []
+    creats = 0
+    processades = 0
+    vistos = set()
+
+    centres = _carregar_noms(Centre)
+    grups = _carregar_noms(Grup)
+    rol, _ = Rol.objects.get_or_create(name="usuari")
+    Membre = Usuari.groups.through
+
+    for lot in lots(islice(llegir_csv(fitxer), inici, None), mida_lot):
+        valides = []
+        for fila in lot:
+            try:
+                valides.append((fila, *validar_fila(fila)))
+            except ValueError as e:
+                errors.append({"fila": fila, "error": str(e)})
+
+        with transaction.atomic():
+            existents = set(
+                Usuari.objects.filter(
+                    username__in=[email for _, email, _ in valides]
+                ).values_list("username", flat=True)
+            )
+            nous = []
+            for fila, email, dades in valides:
+                if email in existents or email in vistos:
+                    errors.append({"fila": fila, "error": f"El email {email} ya existe."})
+                    continue
+                vistos.add(email)
+                nous.append((email, dades))
+
+            _per_nom(Centre, [d["centre"] for _, d in nous], centres)
+            _per_nom(Grup, [d["grup"] for _, d in nous], grups)
+
+            Usuari.objects.bulk_create([
+                Usuari(
+                    username=email,
+                    email=email,
+                    first_name=dades["nom"],
+                    last_name=f"{dades['cognom1']} {dades['cognom2']}",
+                    telefon=dades["telefon"],
+                    centre_id=centres[dades["centre"]],
+                    grup_id=grups[dades["grup"]],
+                    password=password,
+                )
+                for email, dades in nous
+            ])
+            # els pk es tornen a llegir: no tots els backends els retornen
+            ids = Usuari.objects.filter(
+                username__in=[email for email, _ in nous]
+            ).values_list("pk", flat=True)
+            Membre.objects.bulk_create([Membre(usuari_id=pk, group_id=rol.pk) for pk in ids])
+
+            creats += len(nous)
+            processades += len(lot)
+            if progres is not None:
+                progres(processades, creats, errors)
+
+    return creats, errors
+
+
+def _rellegir_pks(pares, abans):
+    """
+    Assigna les pk als Cataleg acabats d'inserir. Són files amb pk més gran
+    que abans i en el mateix ordre; es comparen els camps per saltar les que
+    hagi pogut inserir una altra connexió alhora.
+    """
+    camps = [camp.attname for camp in Cataleg._meta.concrete_fields if not camp.primary_key]
+    pendents = iter(pares)
+    pare = next(pendents, None)
+    for pk, *valors in Cataleg.objects.filter(pk__gt=abans).order_by("pk").values_list("pk", *camps).iterator():
+        if pare is None:
+            break
+        if valors == [getattr(pare, camp) for camp in camps]:
+            pare.pk = pk
+            pare = next(pendents, None)
+    if pare is not None:
+        raise RuntimeError("No s'han pogut llegir les pk dels registres inserits")
+
+
+def bulk_create_mti(model, objectes):
+    """
+    bulk_create per a subclasses de Cataleg, que Django no admet amb herència
+    multi-taula: insereix els pares amb bulk_create i després les files
+    filles (cataleg_ptr_id + camps propis) per lots.
+    """
+    pares = [
+        Cataleg(**{camp.attname: getattr(obj, camp.attname) for camp in Cataleg._meta.concrete_fields})
+        for obj in objectes
+    ]
+    if connection.features.can_return_rows_from_bulk_insert:
+        Cataleg.objects.bulk_create(pares)
+    else:
+        # MySQL no retorna les pk de bulk_create: es tornen a llegir
+        abans = Cataleg.objects.order_by("-pk").values_list("pk", flat=True).first() or 0
+        Cataleg.objects.bulk_create(pares)
+        _rellegir_pks(pares, abans)
+    for obj, pare in zip(objectes, pares):
+        obj.cataleg_ptr_id = obj.id = pare.pk
+
+    camps = model._meta.local_concrete_fields
+    lot = max(connection.ops.bulk_batch_size(camps, objectes), 1)
+    for i in range(0, len(objectes), lot):
+        # el mateix INSERT que fa Model.save() per a la taula filla
+        model._base_manager._insert(objectes[i:i + lot], fields=camps)
+    return objectes
+
+
+# Importació massiva del catàleg (MARC21, CSV i JSON lines)
+#
+# Cada format es llegeix en streaming i es converteix a files amb les claus
+# de CAMPS_CATALEG (més "tipus" i "tags"). Per lots: autors, editorials,
+# països, llengües i categories es resolen amb diccionaris nom -> id
+# carregats una vegada (els que falten es creen en bloc), es descarten els
+# ISBN/ISSN que ja existeixen o que surten repetits al fitxer i s'insereixen
+# Llibre i Revista amb bulk_create_mti() i els tags a la taula intermèdia.
+# Les files sense ISBN/ISSN es comparen per títol, autor i data d'edició
+# (clau_natural): tornar a pujar un fitxer no en duplica cap. Les files
+# descartades surten al resum a "omeses" amb el motiu.
+# Com que bulk_create no llança signals, cada lot s'indexa per a la cerca i
+# en acabar s'invalida la cache de l'API; l'autocompletat es reconstrueix
+# sol quan li passa el TTL.
+
+FORMATS = ("marc", "csv", "jsonl")
+CAMPS_CATALEG = (
+    "titol", "titol_original", "autor", "editorial", "pais", "llengua", "lloc",
+    "data_edicio", "resum", "CDU", "signatura", "ISBN", "ISSN", "numero", "pagines",
+)
+# camps que són claus foranes resoltes per nom
+RELACIONS = {"autor": Autor, "editorial": Editorial, "pais": Pais, "llengua": Llengua}
+
+# codis MARC (008/35-37 i 008/15-17) amb els noms que fa servir generar_datos
+LLENGUES_MARC = {
+    "cat": "Catalán", "spa": "Español", "eng": "Inglés", "fre": "Francés", "ger": "Alemán",
+    "ita": "Italiano", "por": "Portugués", "chi": "Chino", "jpn": "Japonés", "rus": "Ruso",
+    "ara": "Árabe",
+}
+PAISOS_MARC = {
+    "sp": "España", "fr": "Francia", "it": "Italia", "xxk": "Reino Unido", "gw": "Alemania",
+    "xxu": "Estados Unidos", "mx": "México", "ag": "Argentina", "cc": "China", "ja": "Japón",
+}
+
+
+def format_de(nom):
+    extensio = nom.rsplit(".", 1)[-1].lower()
+    formats = {"mrc": "marc", "marc": "marc", "csv": "csv", "jsonl": "jsonl", "ndjson": "jsonl"}
+    if extensio not in formats:
+        raise ValueError(f"Format desconegut: {nom}")
+    return formats[extensio]
+
+
+# --- MARC21 (ISO 2709) ---
+
+FI_CAMP, SUBCAMP, FI_REGISTRE = b"\x1e", b"\x1f", b"\x1d"
+
+
+def registres_marc(fitxer, mida=1 << 16):
+    """Registres MARC21 d'un fitxer binari com a (líder, {etiqueta: [valors]})."""
+    resta = b""
+    while tros := fitxer.read(mida):
+        *registres, resta = (resta + tros).split(FI_REGISTRE)
+        for registre in registres:
+            if registre.strip():
+                yield _llegir_marc(registre.lstrip())
+    if resta.strip():
+        yield _llegir_marc(resta.strip())
+
+
+def _llegir_marc(dades):
+    # un registre malmès es torna com a (None, motiu) i compta com a error
+    try:
+        return _descodificar_marc(dades)
+    except (ValueError, IndexError) as e:
+        return None, f"Registre MARC malmès: {e}"
+
+
+def _descodificar_marc(dades):
+    lider = dades[:24].decode("ascii", "replace")
+    base = int(lider[12:17])
+    directori = dades[24:base - 1]
+    camps = {}
+    for i in range(0, len(directori) - 11, 12):
+        entrada = directori[i:i + 12].decode("ascii", "replace")
+        etiqueta, llargada, inici = entrada[:3], int(entrada[3:7]), int(entrada[7:12])
+        valor = dades[base + inici:base + inici + llargada].rstrip(FI_CAMP)
+        camps.setdefault(etiqueta, []).append(valor)
+    return lider, camps
+
+
+def _subcamp(camps, etiqueta, codi):
+    for valor in camps.get(etiqueta, ()):
+        for part in valor.split(SUBCAMP)[1:]:
+            if part[:1] == codi.encode():
+                return part[1:].decode("utf-8", "replace").strip(" /:;,.") or None
+    return None
+
+
+def _subcamps(camps, etiqueta, codi):
+    return [
+        part[1:].decode("utf-8", "replace").strip(" /:;,.")
+        for valor in camps.get(etiqueta, ())
+        for part in valor.split(SUBCAMP)[1:]
+        if part[:1] == codi.encode()
+    ]
+
+
+def fila_marc(lider, camps):
+    if lider is None:
+        return {"_error": camps}
+    control = (camps.get("008") or [b""])[0].decode("ascii", "replace")
+    titol = " ".join(filter(None, [_subcamp(camps, "245", "a"), _subcamp(camps, "245", "b")]))
+    publicacio = "264" if "264" in camps else "260"
+    return {
+        "tipus": "revista" if lider[7:8] == "s" else "llibre",
+        "titol": titol,
+        "titol_original": _subcamp(camps, "240", "a") or _subcamp(camps, "246", "a"),
+        "autor": _subcamp(camps, "100", "a") or _subcamp(camps, "110", "a"),
+        "editorial": _subcamp(camps, publicacio, "b"),
+        "lloc": _subcamp(camps, publicacio, "a"),
+        "data_edicio": _subcamp(camps, publicacio, "c") or control[7:11],
+        "pais": PAISOS_MARC.get(control[15:18].strip()),
+        "llengua": LLENGUES_MARC.get(control[35:38]),
+        "resum": _subcamp(camps, "520", "a"),
+        "CDU": _subcamp(camps, "080", "a"),
+        "ISBN": _subcamp(camps, "020", "a"),
+        "ISSN": _subcamp(camps, "022", "a"),
+        "pagines": _subcamp(camps, "300", "a"),
+        "tags": _subcamps(camps, "650", "a"),
+    }
+
+
+# --- CSV i JSON lines ---
+
+def files_jsonl(fitxer, encoding="utf-8"):
+    text = io.TextIOWrapper(fitxer, encoding=encoding)
+    try:
+        for linia in text:
+            if linia.strip():
+                yield json.loads(linia)
+    finally:
+        text.detach()
+
+
+def files_cataleg(fitxer, format):
+    if format == "marc":
+        return (fila_marc(*registre) for registre in registres_marc(fitxer))
+    if format == "csv":
+        return llegir_csv(fitxer)
+    if format == "jsonl":
+        return files_jsonl(fitxer)
+    raise ValueError(f"Format desconegut: {format}")
+
+
+def _any(valor):
+    m = re.search(r"\d{4}", str(valor or ""))
+    return date(int(m.group()), 1, 1) if m else None
+
+
+def _enter(valor):
+    m = re.search(r"\d+", str(valor or ""))
+    return int(m.group()) if m else None
+
+
+def _codi(valor):
+    # ISBN/ISSN sense guions ni espais; "84-123-4567-8 (rústica)" -> "8412345678"
+    valor = str(valor or "").split(" (")[0]
+    return re.sub(r"[^0-9Xx]", "", valor).upper()[:13] or None
+
+
+def normalitzar_fila(fila):
+    """Fila neta per inserir o ValueError si no es pot importar."""
+    if fila.get("_error"):
+        raise ValueError(fila["_error"])
+    titol = (fila.get("titol") or "").strip()
+    if not titol:
+        raise ValueError("Falta el títol")
+    dades = {camp: fila.get(camp) or None for camp in CAMPS_CATALEG}
+    dades["titol"] = titol
+    dades["ISBN"] = _codi(dades["ISBN"])
+    dades["ISSN"] = _codi(dades["ISSN"])
+    if fila.get("data_edicio") and re.fullmatch(r"\d{4}-\d{2}-\d{2}", str(fila["data_edicio"])):
+        dades["data_edicio"] = date.fromisoformat(fila["data_edicio"])
+    else:
+        dades["data_edicio"] = _any(dades["data_edicio"])
+    dades["pagines"] = _enter(dades["pagines"])
+    dades["numero"] = _enter(dades["numero"])
+
+    tipus = (fila.get("tipus") or "").lower()
+    if not tipus:
+        tipus = "revista" if dades["ISSN"] and not dades["ISBN"] else "llibre"
+    if tipus not in ("llibre", "revista"):
+        raise ValueError(f"Tipus no admès: {tipus}")
+    dades["tipus"] = tipus
+
+    tags = fila.get("tags") or []
+    if isinstance(tags, str):
+        tags = re.split(r"[|;]", tags)
+    dades["tags"] = [t.strip() for t in tags if t and t.strip()]
+    return dades
+
+
+def _retallar(model, dades):
+    # els textos massa llargs es tallen a la mida de la columna
+    for camp in model._meta.concrete_fields:
+        valor = dades.get(camp.attname)
+        if isinstance(valor, str) and camp.max_length and len(valor) > camp.max_length:
+            dades[camp.attname] = valor[:camp.max_length]
+    return dades
+
+
+def _objecte(dades, ids):
+    model = Revista if dades["tipus"] == "revista" else Llibre
+    camps = {f.attname for f in model._meta.concrete_fields}
+    valors = {camp: dades[camp] for camp in CAMPS_CATALEG if camp in camps and camp not in RELACIONS}
+    for camp in RELACIONS:
+        valors[f"{camp}_id"] = ids[camp].get(dades[camp]) if dades[camp] else None
+    return model(**_retallar(model, valors))
+
+
+def _codi_de(dades):
+    clau = "ISSN" if dades["tipus"] == "revista" else "ISBN"
+    return clau, dades[clau]
+
+
+def clau_natural(tipus, titol, autor, data_edicio):
+    """Identifica un registre sense ISBN/ISSN: tipus, títol (com es desa), autor i data."""
+    return tipus, titol[:Cataleg._meta.get_field("titol").max_length], autor or None, data_edicio
+
+
+def _claus_existents(valides):
+    # claus naturals del lot que ja són a la base de dades
+    existents = set()
+    for tipus, model in (("llibre", Llibre), ("revista", Revista)):
+        titols = {clau_natural(tipus, d["titol"], None, None)[1] for d in valides if d["tipus"] == tipus}
+        if not titols:
+            continue
+        files = model.objects.filter(titol__in=titols).values_list("titol", "autor__nom", "data_edicio")
+        existents.update(clau_natural(tipus, *fila) for fila in files)
+    return existents
+
+
+def importar_cataleg(fitxer, format, mida_lot=1000, progres=None, inici=0):
+    """
+    Importa el catàleg d'un fitxer MARC21, CSV o JSON lines. Retorna un
+    resum amb files llegides, creades, duplicades (i quines, a omeses), errors
+    i files/segon.
+    Si es dona progres, es crida al final de cada lot, dins la seva
+    transacció, amb (files processades, registres creats, errors). inici és
+    el nombre de files que ja s'han processat i se salten.
+    """
+    cronometre = time.monotonic()
+    ids = {camp: _carregar_noms(model) for camp, model in RELACIONS.items()}
+    categories = _carregar_noms(Categoria)
+    errors = []
+    omeses = []
+    creades = processades = 0
+    vistos = {"ISBN": set(), "ISSN": set(), "natural": set()}
+
+    for numero, lot in enumerate(lots(islice(files_cataleg(fitxer, format), inici, None), mida_lot)):
+        valides = []
+        for i, fila in enumerate(lot, start=inici + numero * mida_lot + 1):
+            try:
+                valides.append((i, normalitzar_fila(fila)))
+            except (ValueError, TypeError) as e:
+                errors.append({"fila": i, "error": str(e)})
+
+        with transaction.atomic():
+            existents = {
+                "ISBN": set(Llibre.objects.filter(
+                    ISBN__in=[d["ISBN"] for _, d in valides if d["ISBN"]]
+                ).values_list("ISBN", flat=True)),
+                "ISSN": set(Revista.objects.filter(
+                    ISSN__in=[d["ISSN"] for _, d in valides if d["ISSN"]]
+                ).values_list("ISSN", flat=True)),
+                "natural": _claus_existents([d for _, d in valides if not _codi_de(d)[1]]),
+            }
+            nous = []
+            for i, dades in valides:
+                clau, codi = _codi_de(dades)
+                if codi:
+                    motiu = f"{clau} {codi} repetit"
+                else:
+                    clau = "natural"
+                    codi = clau_natural(dades["tipus"], dades["titol"], dades["autor"], dades["data_edicio"])
+                    motiu = "Ja hi ha un registre amb el mateix títol, autor i data d'edició"
+                if codi in existents[clau] or codi in vistos[clau]:
+                    omeses.append({"fila": i, "motiu": motiu})
+                    continue
+                vistos[clau].add(codi)
+                nous.append(dades)
+
+            for camp, model in RELACIONS.items():
+                _per_nom(model, [d[camp] for d in nous if d[camp]], ids[camp])
+            _per_nom(Categoria, [t for d in nous for t in d["tags"]], categories)
+            Categoria.objects.completar_camins()
+
+            objectes = {Llibre: [], Revista: []}
+            tags = []
+            for dades in nous:
+                obj = _objecte(dades, ids)
+                objectes[type(obj)].append(obj)
+                tags.append((obj, dades["tags"]))
+            for model, llista in objectes.items():
+                if llista:
+                    bulk_create_mti(model, llista)
+
+            Through = Cataleg.tags.through
+            Through.objects.bulk_create([
+                Through(cataleg_id=obj.pk, categoria_id=categories[nom])
+                for obj, noms in tags
+                for nom in dict.fromkeys(noms)
+            ])
+            cerca.indexar(obj.pk for obj, _ in tags)
+
+            creades += len(nous)
+            processades += len(lot)
+            if progres is not None:
+                progres(processades, creades, errors)
+
+    if creades:
+        cache_api.invalidar("llibres", "categories")
+        facetes.invalidar()
+    segons = time.monotonic() - cronometre
+    return {
+        "llegides": processades,
+        "creades": creades,
+        "duplicades": len(omeses),
+        "omeses": omeses,
+        "errors": errors,
+        "segons": round(segons, 2),
+        "files_per_segon": round(processades / segons, 1) if segons > 0 else None,
+    }
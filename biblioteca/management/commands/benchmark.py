@@ -0,0 +1,211 @@
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from biblioteca.models import Centre, Exemplar, Llibre, CD
+
+
+# Benchmarks de rendiment
+#
+# Cada prova crea les seves dades dins d'una transacció que es desfà en
+# acabar, de manera que es pot executar sobre una base de dades de
+# desenvolupament sense deixar-hi res.
+
+
+class Rollback(Exception):
+    pass
+
+
+def cronometrar(funcio, repeticions=3):
+    temps = []
+    for _ in range(repeticions):
+        inici = time.perf_counter()
+        funcio()
+        temps.append(time.perf_counter() - inici)
+    return statistics.median(temps)
+
+
+# --- exemplars ---------------------------------------------------------------
+
+def _exemplars_orm():
+    # Serialització anterior de /api/exemplars: objectes ORM, hasattr() i
+    # un ExemplarOut de pydantic per fila.
+    from biblioteca.api import ExemplarOut, LlibreOut, CatalegOut
+
+    exemplars = Exemplar.objects.select_related(
+        "cataleg__llibre", "cataleg__revista", "cataleg__cd",
+        "cataleg__dvd", "cataleg__br", "cataleg__dispositiu", "centre",
+    ).all()
+    result = []
+    for exemplar in exemplars:
+        cataleg_instance = exemplar.cataleg
+        if hasattr(cataleg_instance, "llibre"):
+            cataleg = LlibreOut.from_orm(cataleg_instance.llibre)
+            tipus = "llibre"
+        else:
+            cataleg = CatalegOut.from_orm(cataleg_instance)
+            tipus = "indefinit"
+        result.append(ExemplarOut(
+            id=exemplar.id,
+            registre=exemplar.registre,
+            exclos_prestec=exemplar.exclos_prestec,
+            baixa=exemplar.baixa,
+            cataleg=cataleg,
+            tipus=tipus,
+            centre={"id": exemplar.centre.id, "nom": exemplar.centre.nom},
+        ))
+    return result
+
+
+def benchmark_exemplars(command, n):
+    from biblioteca.serialitzadors import serialitzar_exemplars
+
+    centre = Centre.objects.create(nom="Benchmark")
+    catalegs = [Llibre.objects.create(titol=f"Llibre {i}", ISBN=f"{i:013d}") for i in range(500)]
+    catalegs += [
+        CD.objects.create(titol=f"CD {i}", discografica="D", estil="Pop", duracio="00:45:00")
+        for i in range(100)
+    ]
+    Exemplar.objects.bulk_create(
+        [
+            Exemplar(cataleg=catalegs[i % len(catalegs)], centre=centre, registre=f"BM-{i}")
+            for i in range(n)
+        ],
+        batch_size=5000,
+    )
+    command.stdout.write(f"{n} exemplars creats")
+
+    abans = cronometrar(_exemplars_orm, repeticions=1)
+    despres = cronometrar(serialitzar_exemplars)
+    command.stdout.write(f"ORM + pydantic per fila: {abans:.2f}s ({abans / n * 1e6:.1f} µs/fila)")
+    command.stdout.write(f"values() + dicts:        {despres:.2f}s ({despres / n * 1e6:.1f} µs/fila)")
+    command.stdout.write(f"x{abans / despres:.1f}")
+
+
+# --- autenticació Bearer ------------------------------------------------------
+
+def benchmark_auth(command, n):
+    import random
+    from datetime import timedelta
+    from django.utils import timezone
+    from biblioteca import tokens
+    from biblioteca.api import AuthBearer
+    from biblioteca.models import Usuari, TokenAcces
+
+    valors = [f"{i:032x}" for i in range(n)]
+    # last_name fa de columna sense índex, com l'antic Usuari.auth_token
+    Usuari.objects.bulk_create(
+        [Usuari(username=f"bm{i}", password="!", last_name=valors[i]) for i in range(n)],
+        batch_size=5000,
+    )
+    ids = dict(Usuari.objects.filter(username__startswith="bm").values_list("username", "pk"))
+    expira = timezone.now() + timedelta(days=1)
+    TokenAcces.objects.bulk_create(
+        [TokenAcces(usuari_id=ids[f"bm{i}"], hash=tokens.hash_token(valors[i]), expira=expira) for i in range(n)],
+        batch_size=5000,
+    )
+    command.stdout.write(f"{n} usuaris amb token creats")
+
+    mostra = random.Random(0).sample(valors, min(n, 1000))
+    auth = AuthBearer()
+
+    class Peticio:
+        pass
+
+    def antic():
+        for token in mostra[:50]:
+            Usuari.objects.get(last_name=token)
+
+    def fred():
+        for token in mostra:
+            tokens.cache.buidar()
+            auth.authenticate(Peticio(), token)
+
+    def calent():
+        for token in mostra:
+            auth.authenticate(Peticio(), token)
+
+    calent()
+    abans = cronometrar(antic, repeticions=1) / 50
+    sense_cache = cronometrar(fred) / len(mostra)
+    amb_cache = cronometrar(calent) / len(mostra)
+    command.stdout.write(f"columna sense índex:       {abans * 1e3:.3f} ms/petició")
+    command.stdout.write(f"hash amb índex únic:       {sense_cache * 1e3:.3f} ms/petició")
+    command.stdout.write(f"hash + cache en memòria:   {amb_cache * 1e3:.3f} ms/petició")
+
+
+# --- escaneig per registre ------------------------------------------------------
+
+def percentils(temps):
+    ordenats = sorted(temps)
+    return ordenats[len(ordenats) // 2], ordenats[min(len(ordenats) - 1, int(len(ordenats) * 0.99))]
+
+
+def benchmark_registre(command, n):
+    import random
+    from django.test import Client
+    from biblioteca.models import Prestec, Reserva, Usuari
+
+    centres = [Centre.objects.create(nom=f"Benchmark {i}") for i in range(3)]
+    catalegs = [Llibre.objects.create(titol=f"Llibre {i}", ISBN=f"{i:013d}") for i in range(500)]
+    # prefix propi de cada execució: la cache de respostes sobreviu al rollback
+    prefix = f"BM{time.time_ns()}"
+    codis = [f"{prefix}-{i}" for i in range(n)]
+    exemplars = Exemplar.objects.bulk_create(
+        [
+            Exemplar(cataleg=catalegs[i % len(catalegs)], centre=centres[i % len(centres)], registre=codis[i])
+            for i in range(n)
+        ],
+        batch_size=5000,
+    )
+    usuari = Usuari.objects.create(username=prefix, password="!")
+    Prestec.objects.bulk_create([Prestec(usuari=usuari, exemplar=e) for e in exemplars[::10]], batch_size=5000)
+    Reserva.objects.bulk_create(
+        [
+            Reserva(usuari=usuari, cataleg_id=e.cataleg_id, exemplar=e, estat=Reserva.ASSIGNADA)
+            for e in exemplars[5::20]
+        ],
+        batch_size=5000,
+    )
+    command.stdout.write(f"{n} exemplars creats")
+
+    client = Client()
+    mostra = random.Random(0).sample(codis, min(n, 1000))
+
+    def escanejar():
+        temps = []
+        for codi in mostra:
+            inici = time.perf_counter()
+            resposta = client.get(f"/api/exemplars/by-registre/{codi}")
+            temps.append(time.perf_counter() - inici)
+            assert resposta.status_code == 200, resposta.content
+        return temps
+
+    for nom, temps in (("freda (consulta)", escanejar()), ("calenta (cache)", escanejar())):
+        p50, p99 = percentils(temps)
+        command.stdout.write(f"{nom:18} p50 {p50 * 1e3:.2f} ms  p99 {p99 * 1e3:.2f} ms")
+
+
+PROVES = {
+    "exemplars": benchmark_exemplars,
+    "auth": benchmark_auth,
+    "registre": benchmark_registre,
+}
+
+
+class Command(BaseCommand):
+    help = "Executa un benchmark de rendiment sobre dades temporals"
+
+    def add_arguments(self, parser):
+        parser.add_argument("prova", choices=sorted(PROVES))
+        parser.add_argument("-n", type=int, default=100_000, help="Nombre de files de la prova")
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                PROVES[options["prova"]](self, options["n"])
+                raise Rollback
+        except Rollback:
+            pass
@@ -0,0 +1,46 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import django
+from django.core.management.base import BaseCommand
+from django.db import connection, connections
+
+from biblioteca import tasques
+
+
+class Command(BaseCommand):
+    help = "Executa les tasques en segon pla de la cua (importacions...)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--treballadors", type=int, default=2, help="Tasques en paral·lel")
+        parser.add_argument(
+            "--processos", action="store_true",
+            help="Fa servir processos en lloc de fils (tasques que gasten CPU)",
+        )
+        parser.add_argument(
+            "--una-vegada", action="store_true",
+            help="Surt quan la cua és buida en lloc d'esperar tasques noves",
+        )
+        parser.add_argument("--interval", type=float, default=1.0, help="Segons entre consultes a la cua buida")
+
+    def handle(self, *args, **options):
+        n = options["treballadors"]
+        if connection.vendor == "sqlite" and n > 1:
+            # SQLite només admet un escriptor: dues importacions alhora
+            # acaben en "database is locked"
+            self.stderr.write("SQLite: s'executa un sol treballador")
+            n = 1
+        if options["processos"]:
+            # els processos fills no poden compartir la connexió del pare
+            connections.close_all()
+            pool = ProcessPoolExecutor(max_workers=n, initializer=django.setup)
+        else:
+            pool = ThreadPoolExecutor(max_workers=n)
+
+        self.stdout.write(f"{n} treballador(s) a l'espera de tasques")
+        with pool:
+            futurs = [
+                pool.submit(tasques.bucle, options["una_vegada"], options["interval"])
+                for _ in range(n)
+            ]
+            fetes = sum(futur.result() for futur in futurs)
+        self.stdout.write(f"{fetes} tasca(ques) executades")
@@ -1,7 +1,13 @@
+import inspect
+import multiprocessing
 import os
 import random
-from datetime import datetime, timedelta
+import time as reloj
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
 from django.core.management.base import BaseCommand
+from django.db import connection, connections, transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
 from django.utils.timezone import make_aware
 from django.contrib.auth.hashers import make_password
 from faker import Faker
@@ -18,8 +24,11 @@ fake.add_provider(misc)
 
 from biblioteca.models import (
     Categoria, Pais, Llengua, Llibre, Exemplar, Usuari, Prestec, Reserva,
-    Centre, Grup, Revista, CD, DVD, BR, Dispositiu, Imatge, Autor, Editorial
+    Centre, Grup, Revista, CD, DVD, BR, Dispositiu, Imatge, Autor, Editorial,
+    Cataleg, TokenAcces
 )
+from biblioteca import cache_api, cerca, disponibilitat, facetes, reserves, signals
+from biblioteca.importacio import bulk_create_mti
 
 
 from django.contrib.auth import get_user_model
@@ -32,21 +41,23 @@ from biblioteca.models import Centre
 
 titulos_usados = set()
 
-def generar_titulo_unico(tipo="libro"):
-    adjetivos = [
-        "Oscuro", "Eterno", "Perdido", "Brillante", "Prohibido", "Infinito", "Olvidado", "Roto", "Oculto",
-        "Sagrado", "Maldito", "Lejano", "Desconocido", "Celestial", "Sombrío", "Rojo", "Azul", "Violeta",
-        "Peligroso", "Invisible", "Errante", "Silencioso", "Salvaje", "Misterioso"
-    ]
+ADJETIVOS = [
+    "Oscuro", "Eterno", "Perdido", "Brillante", "Prohibido", "Infinito", "Olvidado", "Roto", "Oculto",
+    "Sagrado", "Maldito", "Lejano", "Desconocido", "Celestial", "Sombrío", "Rojo", "Azul", "Violeta",
+    "Peligroso", "Invisible", "Errante", "Silencioso", "Salvaje", "Misterioso"
+]
 
-    sustantivos = [
-        "Sueño", "Destino", "Silencio", "Bosque", "Tiempo", "Mar", "Reino", "Secreto", "Camino", "Amanecer",
-        "Fuego", "Niebla", "Sombra", "Memoria", "Luz", "Corazón", "Invierno", "Trono", "Grito", "Ocaso",
-        "Puente", "Espejo", "Guerra", "Promesa", "Lamento", "Jardín", "Laberinto", "Relámpago"
-    ]
+SUSTANTIVOS = [
+    "Sueño", "Destino", "Silencio", "Bosque", "Tiempo", "Mar", "Reino", "Secreto", "Camino", "Amanecer",
+    "Fuego", "Niebla", "Sombra", "Memoria", "Luz", "Corazón", "Invierno", "Trono", "Grito", "Ocaso",
+    "Puente", "Espejo", "Guerra", "Promesa", "Lamento", "Jardín", "Laberinto", "Relámpago"
+]
 
-    conectores = ["del", "de la", "en", "hacia", "bajo", "sobre", "contra", "entre", "desde", "sin"]
-    prefijos = ["El", "La", "Los", "Las", "Un", "Una"]
+CONECTORES = ["del", "de la", "en", "hacia", "bajo", "sobre", "contra", "entre", "desde", "sin"]
+PREFIJOS = ["El", "La", "Los", "Las", "Un", "Una"]
+
+def generar_titulo_unico(tipo="libro"):
+    adjetivos, sustantivos, conectores, prefijos = ADJETIVOS, SUSTANTIVOS, CONECTORES, PREFIJOS
     nombres_propios = [fake.first_name(), fake.last_name(), fake.city(), fake.word().capitalize()]
 
     # Estructuras generales
@@ -95,6 +106,17 @@ def generar_titulo_unico(tipo="libro"):
     return f"{titulo} {random.randint(1, 999)}"
 
 
+# el registre es único por centro (restricción exemplar_registre_centre_uniq);
+# se lleva la cuenta de todos para no depender del centro elegido
+registros_usados = set()
+
+def generar_registro(prefijo):
+    while True:
+        registro = f"{prefijo}-{fake.bothify('####-####')}"
+        if registro not in registros_usados:
+            registros_usados.add(registro)
+            return registro
+
 
 def crear_roles_basicos():
     for nombre in ["usuari", "bibliotecari", "admin"]:
@@ -145,6 +167,31 @@ def timedelta_a_time(td):
     return time(horas, minutos, segundos)
 
 
+@contextmanager
+def _sin_signals():
+    """
+    Desconecta los receptores de biblioteca.signals mientras dura el bloque.
+    Afecta a todo el proceso (no solo a este hilo), así que solo sirve para
+    este comando: en el servidor otra petición se quedaría sin índices.
+    """
+    receptores = [
+        f for f in vars(signals).values()
+        if inspect.isfunction(f) and f.__module__ == signals.__name__
+    ]
+    senders = [None, Autor, Editorial, Exemplar, Prestec, Reserva, Usuari, TokenAcces, Cataleg.tags.through]
+    desconectados = []
+    for signal in (post_save, post_delete, pre_delete, m2m_changed):
+        for receptor in receptores:
+            for sender in senders:
+                if signal.disconnect(receptor, sender=sender):
+                    desconectados.append((signal, receptor, sender))
+    try:
+        yield
+    finally:
+        for signal, receptor, sender in desconectados:
+            signal.connect(receptor, sender=sender)
+
+
 def limpiar_db():
     """Opcional: Limpiar la base de datos existente (solo para desarrollo)"""
     print("Limpiando base de datos...")
@@ -156,9 +203,15 @@ def limpiar_db():
     except Exception as e:
         print("No se pudo ajustar las constraints:", e)
     
-    modelos = [Categoria, Pais, Llengua, Llibre, Exemplar, Usuari, Prestec, Reserva, Centre, Grup, Revista, CD, DVD, BR, Dispositiu]
-    for modelo in modelos:
-        modelo.objects.all().delete()
+    modelos = [Categoria, Pais, Llengua, Llibre, Exemplar, Usuari, Prestec, Reserva, Centre, Grup, Revista, CD, DVD, BR, Dispositiu, Autor, Editorial]
+    # sin signals se borra en bloque y no fila a fila; después se vacían
+    # el índice de búsqueda y la caché de la API
+    with _sin_signals():
+        for modelo in modelos:
+            modelo.objects.all().delete()
+    cerca.reindexar_tot()
+    cache_api.invalidar("llibres", "exemplars", "prestecs", "detalls", "categories")
+    facetes.invalidar()
     print("Base de datos limpiada")
 
 def crear_categorias():
@@ -276,7 +329,7 @@ def crear_autores_y_libros(centros):
             for _ in range(ejemplares_por_libro):
                 Exemplar.objects.create(
                     cataleg=libro,
-                    registre=f"REG-{fake.bothify('####-####')}",
+                    registre=generar_registro("REG"),
                     exclos_prestec=random.random() < 0.1,
                     baixa=random.random() < 0.05,
                     centre=random.choice(centros) 
@@ -332,7 +385,7 @@ def crear_autores_y_libros(centros):
             libro = random.choice(libros)
             Exemplar.objects.create(
                 cataleg=libro,
-                registre=f"REG-{fake.bothify('####-####')}",
+                registre=generar_registro("REG"),
                 exclos_prestec=random.random() < 0.1,
                 baixa=random.random() < 0.05,
                 centre=random.choice(centros) 
@@ -393,7 +446,7 @@ def crear_otros_materiales(centros):
         for _ in range(random.randint(1, 3)):
             Exemplar.objects.create(
                 cataleg=revista,
-                registre=f"REV-{fake.bothify('####-####')}",
+                registre=generar_registro("REV"),
                 exclos_prestec=True,
                 baixa=random.random() < 0.05,
                 centre=random.choice(centros) 
@@ -428,7 +481,7 @@ def crear_otros_materiales(centros):
             for _ in range(random.randint(1, 3)):
                 Exemplar.objects.create(
                     cataleg=cd,
-                    registre=f"CD-{fake.bothify('####-####')}",
+                    registre=generar_registro("CD"),
                     exclos_prestec=random.random() < 0.2,
                     baixa=random.random() < 0.05,
                     centre=random.choice(centros) 
@@ -464,7 +517,7 @@ def crear_otros_materiales(centros):
             for _ in range(random.randint(1, 4)):
                 Exemplar.objects.create(
                     cataleg=dvd,
-                    registre=f"DVD-{fake.bothify('####-####')}",
+                    registre=generar_registro("DVD"),
                     exclos_prestec=random.random() < 0.15,
                     baixa=random.random() < 0.05,
                     centre=random.choice(centros) 
@@ -498,7 +551,7 @@ def crear_otros_materiales(centros):
             for _ in range(random.randint(1, 3)):
                 Exemplar.objects.create(
                     cataleg=br,
-                    registre=f"BR-{fake.bothify('####-####')}",
+                    registre=generar_registro("BR"),
                     exclos_prestec=random.random() < 0.15,
                     baixa=random.random() < 0.05,
                     centre=random.choice(centros) 
@@ -532,7 +585,7 @@ def crear_otros_materiales(centros):
         for _ in range(random.randint(1, 2)):
             Exemplar.objects.create(
                 cataleg=dispositivo,
-                registre=f"DISP-{fake.bothify('####-####')}",
+                registre=generar_registro("DISP"),
                 exclos_prestec=random.random() < 0.3,
                 baixa=random.random() < 0.05,
                 centre=random.choice(centros) 
@@ -576,7 +629,6 @@ def crear_usuarios_y_prestamos(centros, ciclos):
             last_name=fake.last_name(),
             centre=random.choice(centros),
             grup=random.choice(ciclos),
-            auth_token=fake.md5()
         )
         usuarios.append(usuario)
     
@@ -612,19 +664,439 @@ def crear_usuarios_y_prestamos(centros, ciclos):
         if i % 50 == 0:
             print(f"Creados {i} préstamos...")
     
+    # Las reservas se hacen sobre el registro del catálogo y hacen cola
     for i in range(100):
         Reserva.objects.create(
             usuari=random.choice(usuarios),
-            exemplar=random.choice(ejemplares),
-            data=fake.date_between(start_date='-6m', end_date='today')
+            cataleg=random.choice(ejemplares).cataleg,
+            posicio=i + 1,
         )
+    # los ejemplares libres pasan a la primera reserva de su cola
+    reserves.actualitzar(reserves.assignar_pendents())
+
+# ============================================================
+# MODO MASIVO (--scale N)
+# ============================================================
+#
+# Genera N veces el volumen por defecto con bulk_create por lotes. Las filas
+# se generan en paralelo (multiprocessing.Pool) sin tocar la base de datos:
+# cada lote tiene su propio Random y su Faker sembrados a partir de
+# (--seed, tipo, número de lote), de modo que el resultado es el mismo con
+# cualquier número de procesos. Las claves foráneas se generan como índices
+# dentro de las listas de ids ya insertados y el proceso principal las
+# traduce e inserta los lotes en orden.
+#
+# Llibre, Revista, CD... heredan de Cataleg (herencia multitabla) y
+# bulk_create no las admite: se insertan con importacio.bulk_create_mti().
+#
+# bulk_create no lanza signals: al acabar se recalculan los contadores de
+# disponibilidad, se reconstruye el índice de búsqueda y se invalida la
+# caché de la API.
+
+ESCALA = {
+    "autores": 100,
+    "editoriales": 20,
+    "libros": 1000,
+    "revistas": 50,
+    "cds": 40,
+    "dvds": 40,
+    "brs": 30,
+    "dispositivos": 25,
+    "ejemplares": 5000,
+    "usuarios": 50,
+    "prestamos": 500,
+    "reservas": 100,
+}
+LOTE = 5000
+# fechas relativas a un día fijo para que la salida no dependa de hoy
+FECHA_REFERENCIA = date(2025, 1, 1)
+PASSWORD_USUARIOS = "1234"
+
+ESTILOS = ["Pop", "Rock", "Jazz", "Clásica", "Blues", "Hip-Hop", "Electrónica", "Reggaeton", "Salsa"]
+MARCAS = ["Apple", "Samsung", "HP", "Dell", "Lenovo", "Asus", "Acer", "Sony", "ACME"]
+MODELOS = ["Pro", "Max", "Air", "Plus", "Mini", "Ultra"]
+TIPOS_DISPOSITIVO = ["Laptop", "Tablet", "Smartphone", "Monitor", "Router", "Impresora", "Proyector"]
+
+
+def _fecha(rnd, max_dias, min_dias=0):
+    return FECHA_REFERENCIA - timedelta(days=rnd.randint(min_dias, max_dias))
+
+
+def _duracion(rnd, minimo, maximo):
+    return timedelta_a_time(timedelta(minutes=rnd.randint(minimo, maximo)))
+
+
+def _isbn(n):
+    # ISBN-13 válido y único a partir del número de fila
+    base = f"978{n:09d}"
+    control = (10 - sum(int(d) * (3 if i % 2 else 1) for i, d in enumerate(base)) % 10) % 10
+    return f"{base}{control}"
+
+
+def _titulo(rnd, f):
+    estructura = rnd.randrange(4)
+    if estructura == 0:
+        return f"{rnd.choice(PREFIJOS)} {rnd.choice(SUSTANTIVOS)} {rnd.choice(ADJETIVOS)}"
+    if estructura == 1:
+        return f"{rnd.choice(SUSTANTIVOS)} {rnd.choice(CONECTORES)} {rnd.choice(SUSTANTIVOS)}"
+    if estructura == 2:
+        return f"{rnd.choice(ADJETIVOS)} {rnd.choice(SUSTANTIVOS)} de {f.last_name()}"
+    return f"{rnd.choice(PREFIJOS)} {rnd.choice(SUSTANTIVOS)} {rnd.choice(CONECTORES)} {rnd.choice(SUSTANTIVOS)}"
+
+
+def _cataleg(rnd, f, tam, titulo, max_dias):
+    return {
+        "titol": titulo,
+        "autor_id": rnd.randrange(tam["autores"]),
+        "editorial_id": rnd.randrange(tam["editoriales"]),
+        "pais_id": rnd.randrange(tam["paises"]),
+        "llengua_id": rnd.randrange(tam["lenguas"]),
+        "data_edicio": _fecha(rnd, max_dias),
+        "lloc": f.city(),
+        "tags": rnd.sample(range(tam["categorias"]), min(tam["categorias"], rnd.randint(1, 3))),
+    }
+
+
+def _gen_autores(rnd, f, inicio, n, tam):
+    return [{"nom": f.name()} for _ in range(n)]
+
+
+def _gen_editoriales(rnd, f, inicio, n, tam):
+    return [{"nom": f.company()} for _ in range(n)]
+
+
+def _gen_libros(rnd, f, inicio, n, tam):
+    filas = []
+    for i in range(inicio, inicio + n):
+        titulo = _titulo(rnd, f)
+        fila = _cataleg(rnd, f, tam, titulo, 50 * 365)
+        fila.update({
+            "titol_original": titulo if rnd.random() < 0.3 else f.sentence(nb_words=3).replace('.', '').title(),
+            "CDU": f.numerify("###.##"),
+            "signatura": f"LB-{f.bothify('??###')}",
+            "resum": f.paragraph(nb_sentences=5),
+            "anotacions": f.paragraph(nb_sentences=2) if rnd.random() < 0.7 else None,
+            "mides": f"{rnd.randint(15, 30)}x{rnd.randint(20, 40)} cm",
+            "ISBN": _isbn(i),
+            "colleccio": f.word().title() if rnd.random() < 0.5 else None,
+            "numero": rnd.randint(1, 10) if rnd.random() < 0.3 else None,
+            "volums": rnd.randint(1, 5) if rnd.random() < 0.2 else None,
+            "pagines": rnd.randint(50, 800) if rnd.random() < 0.9 else None,
+            "thumbnail_url": f"https://picsum.photos/200/300?random={rnd.randint(1, 10000)}",
+        })
+        filas.append(fila)
+    return filas
+
+
+def _gen_revistas(rnd, f, inicio, n, tam):
+    temas = ["Ciencia", "Historia", "Moda", "Viajes", "Tecnología", "Deporte", "Cine", "Educación", "Música", "Economia"]
+    filas = []
+    for i in range(inicio, inicio + n):
+        fila = _cataleg(rnd, f, tam, f"{rnd.choice(temas)} Hoy", 10 * 365)
+        fila.update({
+            "autor_id": None,
+            "resum": f.paragraph(nb_sentences=3),
+            "ISSN": f"{i // 10000 % 10000:04d}-{i % 10000:04d}",
+            "numero": rnd.randint(1, 200),
+            "pagines": rnd.randint(30, 150),
+        })
+        filas.append(fila)
+    return filas
+
+
+def _gen_cds(rnd, f, inicio, n, tam):
+    filas = []
+    for _ in range(n):
+        fila = _cataleg(rnd, f, tam, _titulo(rnd, f), 20 * 365)
+        fila.update({
+            "discografica": f.company(),
+            "estil": rnd.choice(ESTILOS),
+            "duracio": _duracion(rnd, 30, 90),
+        })
+        filas.append(fila)
+    return filas
+
+
+def _gen_peliculas(max_dias, minimo, maximo):
+    def generar(rnd, f, inicio, n, tam):
+        filas = []
+        for _ in range(n):
+            fila = _cataleg(rnd, f, tam, _titulo(rnd, f), max_dias)
+            fila.update({
+                "productora": f.company(),
+                "duracio": _duracion(rnd, minimo, maximo),
+            })
+            filas.append(fila)
+        return filas
+    return generar
+
+
+def _gen_dispositivos(rnd, f, inicio, n, tam):
+    filas = []
+    for _ in range(n):
+        marca = rnd.choice(MARCAS)
+        fila = _cataleg(rnd, f, tam, f"{marca} {rnd.choice(TIPOS_DISPOSITIVO)}", 5 * 365)
+        fila.update({"autor_id": None, "marca": marca, "model": rnd.choice(MODELOS)})
+        filas.append(fila)
+    return filas
+
+
+def _gen_ejemplares(rnd, f, inicio, n, tam):
+    return [
+        {
+            "cataleg_id": rnd.randrange(tam["catalogo"]),
+            "registre": f"REG-{i:09d}",
+            "exclos_prestec": rnd.random() < 0.1,
+            "baixa": rnd.random() < 0.05,
+            "centre_id": rnd.randrange(tam["centros"]),
+        }
+        for i in range(inicio, inicio + n)
+    ]
+
+
+def _gen_usuarios(rnd, f, inicio, n, tam):
+    filas = []
+    for i in range(inicio, inicio + n):
+        username = f"{f.user_name()}{i}"
+        filas.append({
+            "username": username,
+            "email": f"{username}@{f.free_email_domain()}",
+            "first_name": f.first_name(),
+            "last_name": f.last_name(),
+            "centre_id": rnd.randrange(tam["centros"]),
+            "grup_id": rnd.randrange(tam["grupos"]),
+        })
+    return filas
+
+
+def _gen_prestamos(rnd, f, inicio, n, tam):
+    filas = []
+    for _ in range(n):
+        fecha_prestamo = _fecha(rnd, 365, 7)
+        filas.append({
+            "usuari_id": rnd.randrange(tam["usuarios"]),
+            "exemplar_id": rnd.randrange(tam["disponibles"]),
+            "data_prestec": fecha_prestamo,
+            "data_retorn": fecha_prestamo + timedelta(days=rnd.randint(1, (FECHA_REFERENCIA - fecha_prestamo).days)),
+            "anotacions": f.sentence() if rnd.random() < 0.3 else None,
+        })
+    return filas
+
+
+def _gen_reservas(rnd, f, inicio, n, tam):
+    # en espera; posprocesar() asigna los ejemplares libres a la primera de cada cola
+    return [
+        {"usuari_id": rnd.randrange(tam["usuarios"]), "cataleg_id": rnd.randrange(tam["catalogo"]), "posicio": inicio + i + 1}
+        for i in range(n)
+    ]
+
+
+GENERADORES = {
+    "autores": _gen_autores,
+    "editoriales": _gen_editoriales,
+    "libros": _gen_libros,
+    "revistas": _gen_revistas,
+    "cds": _gen_cds,
+    "dvds": _gen_peliculas(15 * 365, 60, 180),
+    "brs": _gen_peliculas(10 * 365, 80, 200),
+    "dispositivos": _gen_dispositivos,
+    "ejemplares": _gen_ejemplares,
+    "usuarios": _gen_usuarios,
+    "prestamos": _gen_prestamos,
+    "reservas": _gen_reservas,
+}
+
+MODELOS_MASIVOS = {
+    "autores": Autor,
+    "editoriales": Editorial,
+    "libros": Llibre,
+    "revistas": Revista,
+    "cds": CD,
+    "dvds": DVD,
+    "brs": BR,
+    "dispositivos": Dispositiu,
+    "ejemplares": Exemplar,
+    "usuarios": Usuari,
+    "prestamos": Prestec,
+    "reservas": Reserva,
+}
+
+_fakers = {}
+
+
+def _generar_lote(tarea):
+    """Se ejecuta en los procesos del pool: genera las filas de un lote."""
+    tipo, semilla, numero, inicio, n, tam = tarea
+    rnd = random.Random(f"{semilla}:{tipo}:{numero}")
+    f = _fakers.get("es_ES")
+    if f is None:
+        f = _fakers["es_ES"] = Faker("es_ES")
+    f.seed_instance(rnd.getrandbits(64))
+    return GENERADORES[tipo](rnd, f, inicio, n, tam)
+
+
+class GeneradorMasivo:
+    def __init__(self, escala, semilla, procesos, lote=LOTE, salida=print):
+        self.escala = escala
+        self.semilla = semilla
+        self.procesos = procesos
+        self.lote = lote
+        self.salida = salida
+        self.ids = {}
+
+    def tareas(self, tipo, tam):
+        total = ESCALA[tipo] * self.escala
+        for numero, inicio in enumerate(range(0, total, self.lote)):
+            yield tipo, self.semilla, numero, inicio, min(self.lote, total - inicio), tam
+
+    def traducir(self, filas):
+        for fila in filas:
+            for campo, ids in self.refs.items():
+                if fila.get(campo) is not None:
+                    fila[campo] = ids[fila[campo]]
+        return filas
+
+    def insertar(self, tipo, filas):
+        modelo = MODELOS_MASIVOS[tipo]
+        tags = [fila.pop("tags", ()) for fila in filas]
+        objetos = [modelo(**fila) for fila in filas]
+        if issubclass(modelo, Cataleg):
+            bulk_create_mti(modelo, objetos)
+            Through = Cataleg.tags.through
+            Through.objects.bulk_create([
+                Through(cataleg_id=obj.pk, categoria_id=self.ids["categorias"][i])
+                for obj, indices in zip(objetos, tags)
+                for i in indices
+            ])
+        elif modelo is Prestec:
+            self.insertar_prestamos(objetos)
+        else:
+            if modelo is Usuari:
+                for obj in objetos:
+                    obj.password = self.password
+            modelo.objects.bulk_create(objetos)
+
+    def insertar_prestamos(self, objetos):
+        """
+        data_prestec es auto_now_add: bulk_create la cambiaría por la fecha de
+        hoy. Se insertan en crudo (sin pre_save) con las fechas generadas y
+        un updated_at que tampoco depende del día en que se ejecuta.
+        """
+        for obj in objetos:
+            obj.updated_at = make_aware(datetime.combine(obj.data_retorn or obj.data_prestec, datetime.min.time()))
+        campos = [campo for campo in Prestec._meta.concrete_fields if not campo.primary_key]
+        lote = max(connection.ops.bulk_batch_size(campos, objetos), 1)
+        for i in range(0, len(objetos), lote):
+            Prestec._base_manager._insert(objetos[i:i + lote], fields=campos, raw=True)
+
+    def generar(self, pool, tipo, tam):
+        inicio = reloj.monotonic()
+        total = 0
+        for filas in pool.imap(_generar_lote, self.tareas(tipo, tam)):
+            with transaction.atomic():
+                self.insertar(tipo, self.traducir(filas))
+            total += len(filas)
+        segundos = reloj.monotonic() - inicio
+        self.salida(f" → {total} {tipo} en {segundos:.1f}s ({total / max(segundos, 1e-6):.0f} filas/s)")
+
+    def ids_de(self, qs):
+        return list(qs.order_by("pk").values_list("pk", flat=True))
+
+    def ejecutar(self):
+        self.password = make_password(PASSWORD_USUARIOS)
+        self.ids["categorias"] = self.ids_de(Categoria.objects.all())
+        self.ids["paises"] = self.ids_de(Pais.objects.all())
+        self.ids["lenguas"] = self.ids_de(Llengua.objects.all())
+        self.ids["centros"] = self.ids_de(Centre.objects.all())
+        self.ids["grupos"] = self.ids_de(Grup.objects.all())
+
+        # los procesos del pool no usan la base de datos: no heredan conexión
+        connections.close_all()
+        with multiprocessing.Pool(self.procesos) as pool:
+            self.refs = {}
+            self.generar(pool, "autores", {})
+            self.generar(pool, "editoriales", {})
+            self.ids["autores"] = self.ids_de(Autor.objects.all())
+            self.ids["editoriales"] = self.ids_de(Editorial.objects.all())
+
+            self.refs = {
+                "autor_id": self.ids["autores"],
+                "editorial_id": self.ids["editoriales"],
+                "pais_id": self.ids["paises"],
+                "llengua_id": self.ids["lenguas"],
+            }
+            tam = {clave: len(ids) for clave, ids in self.ids.items()}
+            for tipo in ("libros", "revistas", "cds", "dvds", "brs", "dispositivos"):
+                self.generar(pool, tipo, tam)
+
+            self.ids["catalogo"] = self.ids_de(Cataleg.objects.all())
+            self.refs = {"cataleg_id": self.ids["catalogo"], "centre_id": self.ids["centros"]}
+            self.generar(pool, "ejemplares", {"catalogo": len(self.ids["catalogo"]), "centros": len(self.ids["centros"])})
+
+            self.refs = {"centre_id": self.ids["centros"], "grup_id": self.ids["grupos"]}
+            self.generar(pool, "usuarios", {"centros": len(self.ids["centros"]), "grupos": len(self.ids["grupos"])})
+            usuarios = self.ids_de(Usuari.objects.filter(is_staff=False, is_superuser=False))
+            self.asignar_rol(usuarios)
+
+            disponibles = self.ids_de(Exemplar.objects.filter(baixa=False, exclos_prestec=False))
+            if not disponibles:
+                self.salida("⚠️ No hay ejemplares disponibles para crear préstamos.")
+            else:
+                self.refs = {"usuari_id": usuarios, "exemplar_id": disponibles}
+                tam = {"usuarios": len(usuarios), "disponibles": len(disponibles)}
+                self.generar(pool, "prestamos", tam)
+                self.refs = {"usuari_id": usuarios, "cataleg_id": self.ids["catalogo"]}
+                self.generar(pool, "reservas", {"usuarios": len(usuarios), "catalogo": len(self.ids["catalogo"])})
+
+        self.posprocesar()
+
+    def asignar_rol(self, usuarios):
+        rol, _ = Rol.objects.get_or_create(name="usuari")
+        Membre = Usuari.groups.through
+        for i in range(0, len(usuarios), self.lote):
+            Membre.objects.bulk_create(
+                [Membre(usuari_id=pk, group_id=rol.pk) for pk in usuarios[i:i + self.lote]],
+                ignore_conflicts=True,
+            )
+
+    def posprocesar(self):
+        inicio = reloj.monotonic()
+        reserves.assignar_pendents()
+        ids = self.ids["catalogo"]
+        for i in range(0, len(ids), 1000):
+            disponibilitat.recalcular(ids[i:i + 1000])
+        self.salida(f" → Contadores de disponibilidad recalculados en {reloj.monotonic() - inicio:.1f}s")
+
+        inicio = reloj.monotonic()
+        total = cerca.reindexar_tot()
+        self.salida(f" → Índice de búsqueda: {total} documentos en {reloj.monotonic() - inicio:.1f}s")
+
+        cache_api.invalidar("llibres", "exemplars", "prestecs", "detalls", "categories")
+        facetes.invalidar()
+
 
 class Command(BaseCommand):
     help = 'Genera datos de prueba en la base de datos'
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--scale", type=int, default=None,
+            help="Modo masivo: N veces el volumen por defecto con bulk_create en paralelo",
+        )
+        parser.add_argument("--seed", type=int, default=None, help="Semilla para obtener siempre los mismos datos")
+        parser.add_argument(
+            "--workers", type=int, default=os.cpu_count(),
+            help="Procesos que generan filas en el modo masivo",
+        )
+        parser.add_argument("--lote", type=int, default=LOTE, help="Filas por lote en el modo masivo")
+
     def handle(self, *args, **kwargs):
         self.stdout.write("=== INICIANDO GENERACIÓN DE DATOS DE PRUEBA ===")
         self.stdout.write("Este proceso puede tardar varios minutos...")
+
+        if kwargs["seed"] is not None:
+            random.seed(kwargs["seed"])
+            fake.seed_instance(kwargs["seed"])
         
         # Si deseas limpiar la base de datos, descomenta la siguiente línea:
         limpiar_db()
@@ -634,12 +1106,18 @@ class Command(BaseCommand):
 
         #  Crear centros antes que los libros
         centros, ciclos = crear_centros_y_ciclos()
-        # Pasar centros a las funciones que los necesitan
-        crear_autores_y_libros(centros)
-        crear_otros_materiales(centros) 
-
-        crear_usuarios_y_prestamos(centros, ciclos)
         crear_roles_basicos()
+
+        if kwargs["scale"]:
+            GeneradorMasivo(
+                kwargs["scale"], kwargs["seed"] or 0, kwargs["workers"], kwargs["lote"], self.stdout.write
+            ).ejecutar()
+        else:
+            # Pasar centros a las funciones que los necesitan
+            crear_autores_y_libros(centros)
+            crear_otros_materiales(centros) 
+
+            crear_usuarios_y_prestamos(centros, ciclos)
         crear_superuser()
         crear_bibliotecario()
         
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from biblioteca import importacio
+
+
+class Command(BaseCommand):
+    help = "Importa registres del catàleg des d'un fitxer MARC21, CSV o JSON lines"
+
+    def add_arguments(self, parser):
+        parser.add_argument("fitxer")
+        parser.add_argument(
+            "--format", choices=importacio.FORMATS,
+            help="Format del fitxer (per defecte, segons l'extensió)",
+        )
+        parser.add_argument("--lot", type=int, default=1000, help="Registres per lot")
+
+    def handle(self, *args, **options):
+        try:
+            format = options["format"] or importacio.format_de(options["fitxer"])
+        except ValueError as e:
+            raise CommandError(e)
+
+        def progres(processades, creades, errors):
+            self.stdout.write(f"  {processades} files, {creades} creades, {len(errors)} errors")
+
+        with open(options["fitxer"], "rb") as fitxer:
+            resum = importacio.importar_cataleg(fitxer, format, options["lot"], progres)
+
+        for error in resum["errors"]:
+            self.stderr.write(f"Fila {error['fila']}: {error['error']}")
+        self.stdout.write(
+            f"{resum['llegides']} files llegides, {resum['creades']} creades, "
+            f"{resum['duplicades']} duplicades, {len(resum['errors'])} errors "
+            f"en {resum['segons']}s ({resum['files_per_segon']} files/s)"
+        )
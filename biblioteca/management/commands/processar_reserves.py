@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from biblioteca import reserves
+
+
+class Command(BaseCommand):
+    help = "Caduca les reserves no recollides a temps i passa els exemplars al següent de la cua"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--lot", type=int, default=1000, help="Reserves per transacció")
+
+    def handle(self, *args, **options):
+        # pensat per executar-lo periòdicament (cron, systemd timer...)
+        n = reserves.caducar(mida_lot=options["lot"])
+        self.stdout.write(f"{n} reserva(es) caducades")
+        # exemplars lliures amb cua (p. ex. després de migrar o d'una càrrega massiva)
+        with transaction.atomic():
+            catalegs = reserves.assignar_pendents()
+            reserves.actualitzar(catalegs)
+        self.stdout.write(f"{len(catalegs)} registre(s) amb exemplars assignats a la cua")
@@ -0,0 +1,21 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand
+
+from biblioteca import venciments
+
+
+class Command(BaseCommand):
+    help = "Genera els avisos de préstecs vençuts: un resum per usuari"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--lot", type=int, default=1000, help="Préstecs per transacció")
+        parser.add_argument(
+            "--data", type=date.fromisoformat, default=None,
+            help="Dia de referència (AAAA-MM-DD); per defecte avui",
+        )
+
+    def handle(self, *args, **options):
+        # pensat per executar-lo un cop al dia (cron, systemd timer...)
+        prestecs, avisos = venciments.processar(options["data"], mida_lot=options["lot"])
+        self.stdout.write(f"{prestecs} préstec(s) vençut(s), {avisos} avís(os) nou(s)")
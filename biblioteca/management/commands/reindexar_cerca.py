@@ -0,0 +1,20 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from biblioteca import cerca
+
+
+class Command(BaseCommand):
+    help = "Reconstrueix l'índex de cerca del catàleg"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--lot", type=int, default=2000, help="Documents per lot")
+
+    def handle(self, *args, **options):
+        inici = time.monotonic()
+        total = cerca.reindexar_tot(mida_lot=options["lot"])
+        self.stdout.write(
+            f"Índex '{cerca.backend().nom}' reconstruït: {total} documents "
+            f"en {time.monotonic() - inici:.1f}s"
+        )
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+
+from biblioteca import disponibilitat
+from biblioteca.models import Cataleg
+
+
+class Command(BaseCommand):
+    help = "Comprova (i opcionalment repara) els comptadors de disponibilitat del catàleg"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--reparar", action="store_true", help="Corregeix els comptadors desquadrats")
+        parser.add_argument("--lot", type=int, default=1000, help="Catàlegs per lot")
+
+    def handle(self, *args, **options):
+        lot = options["lot"]
+        revisats = 0
+        desquadrats = 0
+        darrer = 0
+        while True:
+            ids = list(
+                Cataleg.objects.filter(pk__gt=darrer).order_by("pk")
+                .values_list("pk", flat=True)[:lot]
+            )
+            if not ids:
+                break
+            darrer = ids[-1]
+            revisats += len(ids)
+            errors = disponibilitat.derives(ids)
+            desquadrats += len(errors)
+            if errors and options["reparar"]:
+                disponibilitat.recalcular(errors)
+
+        accio = "reparats" if options["reparar"] else "desquadrats"
+        self.stdout.write(f"{revisats} catàlegs revisats, {desquadrats} {accio}")
@@ -0,0 +1,121 @@
+# Generated by Django 4.2.18 on 2026-10-18 12:47
+
+import re
+import unicodedata
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# Taula FTS5 per a la cerca (només SQLite; la resta de bases de dades fan
+# servir TermeCerca). Vegeu biblioteca/cerca.py.
+def crear_fts(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS biblioteca_cerca_fts USING fts5("
+        "titol, titol_original, resum, autor, editorial, isbn, "
+        "tokenize='unicode61 remove_diacritics 2')"
+    )
+
+
+# Omple l'índex amb el catàleg existent; si no, la cerca no troba res fins
+# que algú executa reindexar_cerca. Només amb els models històrics i una
+# còpia de les regles de biblioteca/cerca.py tal com eren en aquesta
+# migració: els canvis posteriors de cerca.py no la modifiquen. Si després
+# canvien les regles, cal tornar a executar manage.py reindexar_cerca.
+PESOS = {
+    "titol": 10.0,
+    "titol_original": 5.0,
+    "resum": 1.0,
+    "autor": 6.0,
+    "editorial": 2.0,
+    "isbn": 10.0,
+}
+COLUMNES = {
+    "titol": "titol",
+    "titol_original": "titol_original",
+    "resum": "resum",
+    "autor": "autor__nom",
+    "editorial": "editorial__nom",
+    "isbn": "llibre__ISBN",
+}
+PARAULA = re.compile(r"\w+")
+MIDA_LOT = 2000
+
+
+def normalitzar(text):
+    if not text:
+        return ""
+    text = unicodedata.normalize("NFKD", str(text))
+    return "".join(c for c in text if not unicodedata.combining(c)).lower()
+
+
+def omplir_index(apps, schema_editor):
+    Cataleg = apps.get_model('biblioteca', 'Cataleg')
+    TermeCerca = apps.get_model('biblioteca', 'TermeCerca')
+    connection = schema_editor.connection
+    backend = getattr(settings, 'CERCA_BACKEND', None) or ('fts5' if connection.vendor == 'sqlite' else 'termes')
+    max_terme = TermeCerca._meta.get_field('terme').max_length
+    camps = list(PESOS)
+    files = Cataleg.objects.order_by().values('id', *COLUMNES.values())
+    lot = []
+    for fila in files.iterator(chunk_size=MIDA_LOT):
+        doc = {camp: normalitzar(fila[columna]) for camp, columna in COLUMNES.items()}
+        if backend == 'fts5':
+            lot.append([fila['id']] + [doc[camp] for camp in camps])
+        else:
+            pesos = defaultdict(float)
+            for camp, pes in PESOS.items():
+                for token in PARAULA.findall(doc[camp]):
+                    pesos[token[:max_terme]] += pes
+            lot.extend(TermeCerca(terme=terme, cataleg_id=fila['id'], pes=pes) for terme, pes in pesos.items())
+        if len(lot) >= MIDA_LOT:
+            _desar(backend, TermeCerca, connection, camps, lot)
+            lot = []
+    if lot:
+        _desar(backend, TermeCerca, connection, camps, lot)
+
+
+def _desar(backend, TermeCerca, connection, camps, lot):
+    if backend != 'fts5':
+        TermeCerca.objects.bulk_create(lot)
+        return
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            f"INSERT INTO biblioteca_cerca_fts (rowid, {', '.join(camps)}) "
+            f"VALUES (%s, {', '.join(['%s'] * len(camps))})",
+            lot,
+        )
+
+
+def esborrar_fts(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute("DROP TABLE IF EXISTS biblioteca_cerca_fts")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('biblioteca', '0011_remove_llibre_editorial_remove_llibre_llengua_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TermeCerca',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('terme', models.CharField(max_length=64)),
+                ('pes', models.FloatField(default=0)),
+                ('cataleg', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='biblioteca.cataleg')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['terme', 'cataleg'], name='biblioteca__terme_85d181_idx')],
+            },
+        ),
+        migrations.RunPython(crear_fts, esborrar_fts),
+        migrations.RunPython(omplir_index, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,109 @@
+# Generated by Django 4.2.18 on 2026-10-18 12:50
+
+from django.db import migrations, models
+from django.db.models import Count, Exists, OuterRef, Q
+import django.db.models.deletion
+
+
+# Omple els comptadors amb les dades existents, per lots de catàlegs. Es fan
+# servir els models històrics i la regla de disponibilitat d'aquesta versió
+# (disponibilitat.py pot canviar amb migracions posteriors).
+def omplir_comptadors(apps, schema_editor):
+    Cataleg = apps.get_model('biblioteca', 'Cataleg')
+    Exemplar = apps.get_model('biblioteca', 'Exemplar')
+    Prestec = apps.get_model('biblioteca', 'Prestec')
+    Reserva = apps.get_model('biblioteca', 'Reserva')
+    DisponibilitatCentre = apps.get_model('biblioteca', 'DisponibilitatCentre')
+
+    en_prestec = Q(Exists(Prestec.objects.filter(exemplar=OuterRef('pk'), data_retorn__isnull=True)))
+    camps = ('exemplars', 'disponibles', 'prestec', 'reserves')
+    darrer = 0
+    while True:
+        ids = list(Cataleg.objects.filter(pk__gt=darrer).order_by('pk').values_list('pk', flat=True)[:1000])
+        if not ids:
+            return
+        darrer = ids[-1]
+        comptadors = {}
+        files = (
+            Exemplar.objects.filter(cataleg_id__in=ids).order_by()
+            .values('cataleg_id', 'centre_id')
+            .annotate(
+                exemplars=Count('pk'),
+                disponibles=Count('pk', filter=Q(baixa=False, exclos_prestec=False) & ~en_prestec),
+                prestec=Count('pk', filter=en_prestec),
+            )
+        )
+        for fila in files:
+            comptadors[fila['cataleg_id'], fila['centre_id']] = {
+                'exemplars': fila['exemplars'], 'disponibles': fila['disponibles'],
+                'prestec': fila['prestec'], 'reserves': 0,
+            }
+        reserves = (
+            Reserva.objects.filter(exemplar__cataleg_id__in=ids).order_by()
+            .values('exemplar__cataleg_id', 'exemplar__centre_id').annotate(n=Count('pk'))
+        )
+        for fila in reserves:
+            comptadors[fila['exemplar__cataleg_id'], fila['exemplar__centre_id']]['reserves'] = fila['n']
+
+        totals = {pk: dict.fromkeys(camps, 0) for pk in ids}
+        for (pk, _), valors in comptadors.items():
+            for camp in camps:
+                totals[pk][camp] += valors[camp]
+        Cataleg.objects.bulk_update(
+            [Cataleg(pk=pk, **{f'comptador_{camp}': n for camp, n in total.items()}) for pk, total in totals.items()],
+            [f'comptador_{camp}' for camp in camps],
+        )
+        DisponibilitatCentre.objects.bulk_create([
+            DisponibilitatCentre(cataleg_id=pk, centre_id=centre_id, **valors)
+            for (pk, centre_id), valors in comptadors.items()
+        ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('biblioteca', '0012_cerca'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cataleg',
+            name='comptador_disponibles',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='cataleg',
+            name='comptador_exemplars',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='cataleg',
+            name='comptador_prestec',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='cataleg',
+            name='comptador_reserves',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.CreateModel(
+            name='DisponibilitatCentre',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('exemplars', models.PositiveIntegerField(default=0)),
+                ('disponibles', models.PositiveIntegerField(default=0)),
+                ('prestec', models.PositiveIntegerField(default=0)),
+                ('reserves', models.PositiveIntegerField(default=0)),
+                ('cataleg', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='disponibilitat', to='biblioteca.cataleg')),
+                ('centre', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='biblioteca.centre')),
+            ],
+            options={
+                'verbose_name_plural': 'Disponibilitat per centre',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='disponibilitatcentre',
+            constraint=models.UniqueConstraint(fields=('cataleg', 'centre'), name='disponibilitat_cataleg_centre'),
+        ),
+        migrations.RunPython(omplir_comptadors, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 4.2.18 on 2026-10-18 12:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('biblioteca', '0013_comptadors_disponibilitat'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='exemplar',
+            index=models.Index(fields=['centre', 'baixa', 'exclos_prestec'], name='exemplar_centre_estat_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='exemplar',
+            index=models.Index(fields=['cataleg', 'centre'], name='exemplar_cataleg_centre_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='prestec',
+            index=models.Index(fields=['exemplar', 'data_retorn'], name='prestec_exemplar_retorn_idx'),
+        ),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 4.2.18 on 2026-10-18 12:57
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import hashlib
+from datetime import timedelta
+
+
+# Els tokens existents d'Usuari.auth_token passen a TokenAcces (hashejats)
+def copiar_tokens(apps, schema_editor):
+    Usuari = apps.get_model('biblioteca', 'Usuari')
+    TokenAcces = apps.get_model('biblioteca', 'TokenAcces')
+    expira = django.utils.timezone.now() + timedelta(days=7)
+    TokenAcces.objects.bulk_create([
+        TokenAcces(usuari_id=pk, hash=hashlib.sha256(token.encode()).hexdigest(), expira=expira)
+        for pk, token in Usuari.objects.exclude(auth_token__isnull=True).exclude(auth_token='')
+        .values_list('pk', 'auth_token')
+    ], ignore_conflicts=True, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('biblioteca', '0015_updated_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TokenAcces',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hash', models.CharField(max_length=64, unique=True)),
+                ('creat', models.DateTimeField(auto_now_add=True)),
+                ('expira', models.DateTimeField(db_index=True)),
+                ('revocat', models.BooleanField(default=False)),
+                ('usuari', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='tokens', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name_plural': "Tokens d'accés",
+            },
+        ),
+        migrations.RunPython(copiar_tokens, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='usuari',
+            name='auth_token',
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.18 on 2026-10-18 12:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('biblioteca', '0016_token_acces'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tokenacces',
+            name='llavor',
+            field=models.CharField(blank=True, default='', max_length=32),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 4.2.18 on 2026-10-18 13:03
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('biblioteca', '0017_token_llavor'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Tasca',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('tipus', models.CharField(max_length=50)),
+                ('estat', models.CharField(choices=[('pendent', 'Pendent'), ('en_curs', 'En curs'), ('completada', 'Completada'), ('fallida', 'Fallida')], default='pendent', max_length=20)),
+                ('treballador', models.CharField(blank=True, max_length=100)),
+                ('creat', models.DateTimeField(auto_now_add=True)),
+                ('inici', models.DateTimeField(blank=True, null=True)),
+                ('fi', models.DateTimeField(blank=True, null=True)),
+                ('processades', models.PositiveIntegerField(default=0)),
+                ('creades', models.PositiveIntegerField(default=0)),
+                ('errors', models.JSONField(blank=True, default=list)),
+                ('missatge', models.TextField(blank=True)),
+                ('document', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='biblioteca.documento')),
+            ],
+            options={
+                'verbose_name_plural': 'Tasques',
+                'indexes': [models.Index(fields=['estat', 'creat'], name='tasca_estat_creat_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 4.2.18 on 2026-10-18 13:28
+
+from django.db import migrations, models
+
+
+# Camí materialitzat de les categories existents, nivell per nivell
+def calcular_camins(apps, schema_editor):
+    Categoria = apps.get_model('biblioteca', 'Categoria')
+    files = list(Categoria.objects.values_list('pk', 'parent_id'))
+    fills = {}
+    for pk, parent_id in files:
+        fills.setdefault(parent_id, []).append(pk)
+
+    actualitzades = []
+    pendents = [(pk, '', 0) for pk in fills.get(None, [])]
+    while pendents:
+        pk, cami_parent, nivell = pendents.pop()
+        cami = f"{cami_parent}{pk:07d}."
+        actualitzades.append(Categoria(pk=pk, cami=cami, nivell=nivell))
+        pendents.extend((fill, cami, nivell + 1) for fill in fills.get(pk, []))
+    Categoria.objects.bulk_update(actualitzades, ['cami', 'nivell'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('biblioteca', '0018_tasques'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='categoria',
+            name='cami',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='categoria',
+            name='nivell',
+            field=models.PositiveSmallIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(calcular_camins, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.18 on 2026-10-18 13:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('biblioteca', '0019_cami_categories'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='prestec',
+            index=models.Index(fields=['usuari', 'data_prestec'], name='prestec_usuari_data_idx'),
+        ),
+    ]
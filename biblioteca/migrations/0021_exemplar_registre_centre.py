@@ -0,0 +1,52 @@
+# Generated by Django 4.2.18 on 2026-10-18 13:37
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+# Abans de la restricció es comprova que no hi hagi registres repetits dins
+# un centre (inclosos els buits: '' compta com un valor més, NULL no). Si n'hi
+# ha, la migració s'atura amb la llista i no toca res: s'han de corregir a
+# mà (o passar els buits a NULL) i tornar a migrar.
+MAX_LLISTATS = 50
+
+
+def comprovar_registres(apps, schema_editor):
+    Exemplar = apps.get_model('biblioteca', 'Exemplar')
+    repetits = (
+        Exemplar.objects.exclude(registre=None)
+        .values('registre', 'centre_id')
+        .annotate(n=Count('pk'))
+        .filter(n__gt=1)
+        .order_by('centre_id', 'registre')
+    )
+    files = []
+    for fila in repetits:
+        files.extend(
+            Exemplar.objects.filter(registre=fila['registre'], centre_id=fila['centre_id'])
+            .order_by('pk').values_list('pk', 'centre_id', 'registre')
+        )
+    if not files:
+        return
+    linies = [f"  exemplar {pk}: centre {centre}, registre {registre!r}" for pk, centre, registre in files]
+    if len(linies) > MAX_LLISTATS:
+        linies = linies[:MAX_LLISTATS] + [f"  ... i {len(linies) - MAX_LLISTATS} més"]
+    raise RuntimeError(
+        f"Hi ha {len(files)} exemplars amb el registre repetit dins el mateix centre. "
+        "Corregiu-los abans d'afegir exemplar_registre_centre_uniq:\n" + "\n".join(linies)
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('biblioteca', '0020_prestec_usuari_data'),
+    ]
+
+    operations = [
+        migrations.RunPython(comprovar_registres, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='exemplar',
+            constraint=models.UniqueConstraint(fields=('registre', 'centre'), name='exemplar_registre_centre_uniq'),
+        ),
+    ]
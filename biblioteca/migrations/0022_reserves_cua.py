@@ -0,0 +1,51 @@
+# Generated by Django 4.2.18 on 2026-10-18 13:43
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# Cua de reserves, en tres migracions: l'esquema (camps nous, cataleg encara
+# nullable), les dades (0022_reserves_cua_dades) i la restricció NOT NULL amb
+# els índexs (0022_reserves_cua_restriccio). Separades perquè PostgreSQL no
+# admet un ALTER TABLE amb les escriptures de la migració de dades pendents
+# dins la mateixa transacció.
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('biblioteca', '0021_exemplar_registre_centre'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='reserva',
+            name='assignada',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='reserva',
+            name='cataleg',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='biblioteca.cataleg'),
+        ),
+        migrations.AddField(
+            model_name='reserva',
+            name='estat',
+            field=models.CharField(choices=[('espera', 'En espera'), ('assignada', 'Exemplar assignat'), ('recollida', 'Recollida'), ('caducada', 'Caducada'), ('cancellada', 'Cancel·lada')], default='espera', max_length=12),
+        ),
+        migrations.AddField(
+            model_name='reserva',
+            name='expira',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='reserva',
+            name='posicio',
+            field=models.PositiveBigIntegerField(default=0, editable=False),
+        ),
+        migrations.AlterField(
+            model_name='reserva',
+            name='exemplar',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='biblioteca.exemplar'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+from django.db import migrations
+
+
+# Les reserves existents eren d'un exemplar concret: passen a la cua del seu
+# registre, en espera i per ordre de data. Per lots, sense carregar-les totes.
+MIDA_LOT = 1000
+
+
+def encuar_reserves(apps, schema_editor):
+    Reserva = apps.get_model('biblioteca', 'Reserva')
+    posicions = {}
+    lot = []
+    files = Reserva.objects.order_by('data', 'pk').values_list('pk', 'exemplar__cataleg_id')
+    for pk, cataleg_id in files.iterator(chunk_size=MIDA_LOT):
+        posicions[cataleg_id] = posicions.get(cataleg_id, 0) + 1
+        lot.append(Reserva(pk=pk, cataleg_id=cataleg_id, exemplar_id=None, posicio=posicions[cataleg_id]))
+        if len(lot) >= MIDA_LOT:
+            Reserva.objects.bulk_update(lot, ['cataleg', 'exemplar', 'posicio'])
+            lot = []
+    if lot:
+        Reserva.objects.bulk_update(lot, ['cataleg', 'exemplar', 'posicio'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('biblioteca', '0022_reserves_cua'),
+    ]
+
+    operations = [
+        migrations.RunPython(encuar_reserves, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,29 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('biblioteca', '0022_reserves_cua_dades'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='reserva',
+            name='cataleg',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='biblioteca.cataleg'),
+        ),
+        migrations.AddIndex(
+            model_name='reserva',
+            index=models.Index(fields=['cataleg', 'estat', 'posicio'], name='reserva_cua_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='reserva',
+            index=models.Index(fields=['estat', 'expira'], name='reserva_estat_expira_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='reserva',
+            index=models.Index(fields=['exemplar', 'estat'], name='reserva_exemplar_estat_idx'),
+        ),
+    ]
@@ -0,0 +1,93 @@
+# Generated by Django 4.2.18 on 2026-10-18 13:49
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+from datetime import timedelta
+
+
+# Els préstecs oberts d'abans no tenien venciment: reben els dies per
+# defecte a partir de la data de préstec. Un UPDATE per data (n'hi ha poques
+# de diferents) en lloc d'un per préstec.
+def venciment_oberts(apps, schema_editor):
+    Prestec = apps.get_model('biblioteca', 'Prestec')
+    dies = timedelta(days=getattr(settings, 'PRESTECS_DIES', 21))
+    oberts = Prestec.objects.filter(data_retorn__isnull=True, data_venciment__isnull=True)
+    for data in oberts.order_by().values_list('data_prestec', flat=True).distinct():
+        oberts.filter(data_prestec=data).update(data_venciment=data + dies)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('biblioteca', '0022_reserves_cua_restriccio'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Avis',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('tipus', models.CharField(choices=[('venciment', 'Préstecs vençuts')], max_length=20)),
+                ('data', models.DateField()),
+                ('creat', models.DateTimeField(auto_now_add=True)),
+                ('enviat', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'verbose_name_plural': 'Avisos',
+            },
+        ),
+        migrations.CreateModel(
+            name='PoliticaPrestec',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('tipus', models.CharField(blank=True, choices=[('llibre', 'Llibre'), ('revista', 'Revista'), ('cd', 'CD'), ('dvd', 'DVD'), ('br', 'BR'), ('dispositiu', 'Dispositiu')], default='', max_length=12)),
+                ('dies', models.PositiveIntegerField()),
+            ],
+            options={
+                'verbose_name_plural': 'Polítiques de préstec',
+            },
+        ),
+        migrations.AddField(
+            model_name='prestec',
+            name='darrer_avis',
+            field=models.DateField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='prestec',
+            name='data_venciment',
+            field=models.DateField(blank=True, null=True),
+        ),
+        migrations.RunPython(venciment_oberts, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='prestec',
+            index=models.Index(condition=models.Q(('data_retorn__isnull', True)), fields=['data_venciment', 'id'], name='prestec_obert_venciment_idx'),
+        ),
+        migrations.AddField(
+            model_name='politicaprestec',
+            name='grup',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='biblioteca.grup'),
+        ),
+        migrations.AddField(
+            model_name='avis',
+            name='prestecs',
+            field=models.ManyToManyField(blank=True, to='biblioteca.prestec'),
+        ),
+        migrations.AddField(
+            model_name='avis',
+            name='usuari',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddConstraint(
+            model_name='politicaprestec',
+            constraint=models.UniqueConstraint(fields=('grup', 'tipus'), name='politica_grup_tipus_uniq'),
+        ),
+        migrations.AddIndex(
+            model_name='avis',
+            index=models.Index(fields=['enviat', 'data'], name='avis_enviat_data_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='avis',
+            constraint=models.UniqueConstraint(fields=('usuari', 'tipus', 'data'), name='avis_usuari_tipus_data_uniq'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.18 on 2026-10-18 14:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('biblioteca', '0023_venciments'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='categoria',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, db_index=True),
+        ),
+    ]
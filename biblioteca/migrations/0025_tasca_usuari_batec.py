@@ -0,0 +1,30 @@
+# Generated by Django 4.2.18 on 2026-10-18 14:12
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('biblioteca', '0024_categoria_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tasca',
+            name='batec',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='tasca',
+            name='intents',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='tasca',
+            name='usuari',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='tasques', to=settings.AUTH_USER_MODEL),
+        ),
+    ]
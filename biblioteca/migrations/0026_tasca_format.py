@@ -0,0 +1,18 @@
+# Generated by Django 4.2.18 on 2026-10-18 14:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('biblioteca', '0025_tasca_usuari_batec'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tasca',
+            name='format',
+            field=models.CharField(blank=True, max_length=10),
+        ),
+    ]
@@ -1,14 +1,84 @@
-from django.db import models
+from django.core.exceptions import ValidationError
+from django.db import models, transaction
+from django.db.models import Count, Exists, F, OuterRef, Q, Value
+from django.db.models.functions import Cast, Concat, LPad, Substr
 from django.contrib.auth.models import AbstractUser, Group as Rol
 from django.utils.timezone import now
 from django.contrib.auth.hashers import make_password
 
 
+class CategoriaQuerySet(models.QuerySet):
+    def subarbre(self, categoria):
+        """La categoria i totes les seves descendents: un sol rang sobre cami."""
+        return self.filter(cami__gte=categoria.cami, cami__lt=Categoria.fi_subarbre(categoria.cami))
+
+    def completar_camins(self):
+        """Camí de les categories arrel creades amb bulk_create (no passen per save())."""
+        return self.filter(parent__isnull=True, cami='').update(cami=Concat(
+            LPad(Cast('pk', models.CharField()), Categoria.AMPLADA, Value('0')), Value('.'),
+        ))
+
+
 class Categoria(models.Model):
+    # camí materialitzat: pk de cada ancestre i el propi, amb amplada fixa
+    # ("0000003.0000012."). Ordenar per cami dona l'arbre en preordre i el
+    # subarbre d'una categoria és el rang [cami, fi_subarbre(cami)).
+    AMPLADA = 7
+
     class Meta:
         verbose_name_plural = "Categories"
+    objects = CategoriaQuerySet.as_manager()
+
     nom = models.CharField(max_length=100)
     parent = models.ForeignKey('self',on_delete=models.CASCADE,null=True,blank=True)
+    cami = models.CharField(max_length=255, blank=True, default='', editable=False, db_index=True)
+    nivell = models.PositiveSmallIntegerField(default=0, editable=False)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    @classmethod
+    def segment(cls, pk):
+        return f"{pk:0{cls.AMPLADA}d}."
+
+    @staticmethod
+    def fi_subarbre(cami):
+        # '/' és el caràcter just després de '.'
+        return cami[:-1] + '/'
+
+    def _cami_parent(self):
+        if self.parent_id is None:
+            return '', -1
+        return Categoria.objects.filter(pk=self.parent_id).values_list('cami', 'nivell').get()
+
+    def clean(self):
+        if self.pk and self.parent_id:
+            cami_parent, _ = self._cami_parent()
+            if self.segment(self.pk) in cami_parent:
+                raise ValidationError({'parent': "Una categoria no pot penjar de si mateixa ni d'una descendent."})
+
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            cami_parent, nivell_parent = self._cami_parent()
+            if self.pk and self.segment(self.pk) in cami_parent:
+                raise ValueError("Una categoria no pot penjar de si mateixa ni d'una descendent.")
+            super().save(*args, **kwargs)
+
+            cami = cami_parent + self.segment(self.pk)
+            nivell = nivell_parent + 1
+            anterior = Categoria.objects.filter(pk=self.pk).values_list('cami', 'nivell').get()
+            if anterior == (cami, nivell):
+                return
+            cami_anterior, nivell_anterior = anterior
+            if cami_anterior:
+                # moguda: el subarbre canvia de prefix i de nivell
+                Categoria.objects.filter(
+                    cami__gt=cami_anterior, cami__lt=self.fi_subarbre(cami_anterior),
+                ).update(
+                    cami=Concat(Value(cami), Substr('cami', len(cami_anterior) + 1)),
+                    nivell=F('nivell') + (nivell - nivell_anterior),
+                )
+            Categoria.objects.filter(pk=self.pk).update(cami=cami, nivell=nivell)
+            self.cami, self.nivell = cami, nivell
+
     def __str__(self):
         return self.nom
 
@@ -37,7 +107,45 @@ class Autor(models.Model):
 
 
 
+def prestec_obert(ref='pk'):
+    """Exists() d'un préstec sense retornar de l'exemplar referenciat per `ref`."""
+    return Exists(Prestec.objects.filter(exemplar=OuterRef(ref), data_retorn__isnull=True))
+
+
+def reserva_assignada(ref='pk'):
+    """Exists() d'una reserva que té l'exemplar guardat per a un usuari."""
+    return Exists(Reserva.objects.filter(exemplar=OuterRef(ref), estat=Reserva.ASSIGNADA))
+
+
+def comptadors_exemplars(prefix=''):
+    """
+    Expressions Count dels estats d'exemplar. Amb prefix='exemplar__' es
+    poden fer servir des de Cataleg; amb prefix='' sobre Exemplar.
+    """
+    camp = prefix[:-2] if prefix else 'pk'
+    en_prestec = Q(prestec_obert(camp))
+    return {
+        'n_exemplars': Count(camp),
+        'n_baixa': Count(camp, filter=Q(**{prefix + 'baixa': True})),
+        'n_prestec': Count(camp, filter=en_prestec),
+        'n_disponibles': Count(camp, filter=Q(**{
+            prefix + 'baixa': False, prefix + 'exclos_prestec': False,
+        }) & ~en_prestec & ~Q(reserva_assignada(camp))),
+    }
+
+
+class CatalegQuerySet(models.QuerySet):
+    def amb_exemplars(self):
+        """
+        Anota els comptadors d'exemplars de cada registre en una sola consulta:
+        n_exemplars, n_disponibles, n_prestec i n_baixa.
+        """
+        return self.annotate(**comptadors_exemplars('exemplar__'))
+
+
 class Cataleg(models.Model):
+    objects = CatalegQuerySet.as_manager()
+
     titol = models.CharField(max_length=200)
     titol_original = models.CharField(max_length=200, blank=True, null=True)
     autor = models.ForeignKey('Autor', on_delete=models.SET_NULL, null=True, blank=True)
@@ -52,9 +160,20 @@ class Cataleg(models.Model):
     pais = models.ForeignKey('Pais', on_delete=models.SET_NULL, null=True, blank=True)
     llengua = models.ForeignKey('Llengua', on_delete=models.SET_NULL, null=True, blank=True)
     tags = models.ManyToManyField('Categoria', blank=True)
+    # comptadors materialitzats (disponibilitat.py)
+    comptador_exemplars = models.PositiveIntegerField(default=0, editable=False)
+    comptador_disponibles = models.PositiveIntegerField(default=0, editable=False)
+    comptador_prestec = models.PositiveIntegerField(default=0, editable=False)
+    comptador_reserves = models.PositiveIntegerField(default=0, editable=False)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
 
     def exemplars_count(self):
-        return 0
+        # Aprofita l'anotació de amb_exemplars() si el registre ja la porta
+        if hasattr(self, 'n_exemplars'):
+            return self.n_exemplars
+        return Cataleg.objects.filter(pk=self.pk).amb_exemplars().values_list(
+            'n_exemplars', flat=True
+        ).first() or 0
 
 
     def __str__(self):
@@ -115,15 +234,70 @@ class Dispositiu(Cataleg):
     marca = models.CharField(max_length=100)
     model = models.CharField(max_length=100,null=True,blank=True)
 
+class ExemplarQuerySet(models.QuerySet):
+    def disponibles(self, disponible=True):
+        """
+        Exemplars que es poden prestar ara mateix (o els que no, amb False):
+        ni de baixa, ni exclosos, ni en préstec, ni guardats per una reserva.
+        """
+        q = Q(baixa=False, exclos_prestec=False) & ~Q(prestec_obert()) & ~Q(reserva_assignada())
+        return self.filter(q if disponible else ~q)
+
+
 class Exemplar(models.Model):
+    class Meta:
+        indexes = [
+            # llistats per centre filtrats per disponibilitat (API i admin)
+            models.Index(fields=['centre', 'baixa', 'exclos_prestec'], name='exemplar_centre_estat_idx'),
+            # exemplars d'un registre en un centre (ExemplarsInline)
+            models.Index(fields=['cataleg', 'centre'], name='exemplar_cataleg_centre_idx'),
+        ]
+        constraints = [
+            # el codi de barres identifica l'exemplar dins el centre; amb
+            # registre al davant, l'índex serveix també per cercar només pel codi
+            models.UniqueConstraint(fields=['registre', 'centre'], name='exemplar_registre_centre_uniq'),
+        ]
+    objects = ExemplarQuerySet.as_manager()
+
     cataleg = models.ForeignKey(Cataleg, on_delete=models.CASCADE)
     registre = models.CharField(max_length=100,null=True,blank=True)
     exclos_prestec = models.BooleanField(default=False)
     baixa = models.BooleanField(default=False)
     centre = models.ForeignKey('Centre', on_delete=models.PROTECT)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        # es recorda el catàleg original per recalcular també els
+        # comptadors del registre d'on surt l'exemplar si es mou, i el codi
+        # original per invalidar-ne la cache si canvia
+        instance = super().from_db(db, field_names, values)
+        instance._cataleg_original = instance.__dict__.get('cataleg_id')
+        instance._registre_original = instance.__dict__.get('registre')
+        return instance
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        # els signals de post_save ja han vist el catàleg original
+        self._cataleg_original = self.cataleg_id
+        self._registre_original = self.registre
+
     def __str__(self):
         return "REG:{} - {}".format(self.registre,self.cataleg.titol)
 
+class DisponibilitatCentre(models.Model):
+    class Meta:
+        verbose_name_plural = "Disponibilitat per centre"
+        constraints = [
+            models.UniqueConstraint(fields=['cataleg', 'centre'], name='disponibilitat_cataleg_centre'),
+        ]
+    cataleg = models.ForeignKey(Cataleg, on_delete=models.CASCADE, related_name='disponibilitat')
+    centre = models.ForeignKey('Centre', on_delete=models.CASCADE)
+    exemplars = models.PositiveIntegerField(default=0)
+    disponibles = models.PositiveIntegerField(default=0)
+    prestec = models.PositiveIntegerField(default=0)
+    reserves = models.PositiveIntegerField(default=0)
+
 class Imatge(models.Model):
     cataleg = models.ForeignKey(Cataleg, on_delete=models.CASCADE)
     imatge = models.ImageField(upload_to='imatges/')
@@ -147,7 +321,6 @@ class Usuari(AbstractUser):
     centre = models.ForeignKey(Centre,on_delete=models.SET_NULL,null=True,blank=True)
     grup = models.ForeignKey(Grup,on_delete=models.SET_NULL,null=True,blank=True)
     imatge = models.ImageField(upload_to='usuaris/',null=True,blank=True)
-    auth_token = models.CharField(max_length=32,blank=True,null=True)
     telefon = models.CharField(max_length=20,blank=True,null=True)
     def save(self, *args, **kwargs):
         is_new = self.pk is None
@@ -161,24 +334,138 @@ class Usuari(AbstractUser):
     def __str__(self):
         return self.username
 
+class TokenAcces(models.Model):
+    """
+    Token Bearer de l'API. Se'n guarda el hash (sha256), amb índex únic, i
+    una llavor aleatòria a partir de la qual, amb SECRET_KEY, es pot tornar
+    a donar el mateix token al client (vegeu tokens.py).
+    """
+    class Meta:
+        verbose_name_plural = "Tokens d'accés"
+    usuari = models.ForeignKey(Usuari, on_delete=models.CASCADE, related_name='tokens')
+    hash = models.CharField(max_length=64, unique=True)
+    # el token en clar es deriva de la llavor amb SECRET_KEY (HMAC)
+    llavor = models.CharField(max_length=32, blank=True, default='')
+    creat = models.DateTimeField(auto_now_add=True)
+    expira = models.DateTimeField(db_index=True)
+    revocat = models.BooleanField(default=False)
+
+    def __str__(self):
+        return f"{self.usuari} ({self.hash[:8]}…)"
+
 class Reserva(models.Model):
+    # Cua de reserves d'un registre del catàleg (reserves.py). Les reserves
+    # en espera s'ordenen per posicio; quan un exemplar queda lliure s'assigna
+    # a la primera, que el té guardat fins a expira.
+    ESPERA = 'espera'
+    ASSIGNADA = 'assignada'
+    RECOLLIDA = 'recollida'
+    CADUCADA = 'caducada'
+    CANCELLADA = 'cancellada'
+    ESTATS = (
+        (ESPERA, 'En espera'),
+        (ASSIGNADA, 'Exemplar assignat'),
+        (RECOLLIDA, 'Recollida'),
+        (CADUCADA, 'Caducada'),
+        (CANCELLADA, 'Cancel·lada'),
+    )
+    ACTIVES = (ESPERA, ASSIGNADA)
+
     class Meta:
         verbose_name_plural = "Reserves"
+        indexes = [
+            # primera de la cua d'un registre
+            models.Index(fields=['cataleg', 'estat', 'posicio'], name='reserva_cua_idx'),
+            # reserves assignades que han caducat (processar_reserves)
+            models.Index(fields=['estat', 'expira'], name='reserva_estat_expira_idx'),
+            # exemplar guardat (reserva_assignada)
+            models.Index(fields=['exemplar', 'estat'], name='reserva_exemplar_estat_idx'),
+        ]
     usuari = models.ForeignKey(Usuari, on_delete=models.CASCADE)
-    exemplar = models.ForeignKey(Exemplar, on_delete=models.CASCADE)
+    cataleg = models.ForeignKey(Cataleg, on_delete=models.CASCADE)
+    exemplar = models.ForeignKey(Exemplar, on_delete=models.CASCADE, null=True, blank=True)
     data = models.DateField(auto_now_add=True)
+    estat = models.CharField(max_length=12, choices=ESTATS, default=ESPERA)
+    posicio = models.PositiveBigIntegerField(default=0, editable=False)
+    assignada = models.DateTimeField(null=True, blank=True)
+    expira = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.usuari} - {self.cataleg_id} ({self.estat})"
+
+class PoliticaPrestec(models.Model):
+    """
+    Dies de préstec per grup d'usuaris i tipus de material (venciments.py).
+    Un camp buit val per a tots; mana la política més específica.
+    """
+    TIPUS = (
+        ('llibre', 'Llibre'),
+        ('revista', 'Revista'),
+        ('cd', 'CD'),
+        ('dvd', 'DVD'),
+        ('br', 'BR'),
+        ('dispositiu', 'Dispositiu'),
+    )
+    class Meta:
+        verbose_name_plural = "Polítiques de préstec"
+        constraints = [
+            models.UniqueConstraint(fields=['grup', 'tipus'], name='politica_grup_tipus_uniq'),
+        ]
+    grup = models.ForeignKey(Grup, on_delete=models.CASCADE, null=True, blank=True)
+    tipus = models.CharField(max_length=12, choices=TIPUS, blank=True, default='')
+    dies = models.PositiveIntegerField()
+
+    def __str__(self):
+        return f"{self.grup or 'Tots'} / {self.get_tipus_display() or 'Tot'}: {self.dies} dies"
 
 class Prestec(models.Model):
     class Meta:
         verbose_name_plural = "Préstecs"
+        indexes = [
+            # préstec obert d'un exemplar (prestec_obert)
+            models.Index(fields=['exemplar', 'data_retorn'], name='prestec_exemplar_retorn_idx'),
+            # historial d'un usuari per data (/api/prestecs)
+            models.Index(fields=['usuari', 'data_prestec'], name='prestec_usuari_data_idx'),
+            # préstecs oberts vençuts (processar_venciments); l'historial retornat no hi entra
+            models.Index(
+                fields=['data_venciment', 'id'], condition=Q(data_retorn__isnull=True),
+                name='prestec_obert_venciment_idx',
+            ),
+        ]
     usuari = models.ForeignKey(Usuari, on_delete=models.CASCADE)
     exemplar = models.ForeignKey(Exemplar, on_delete=models.CASCADE)
     data_prestec = models.DateField(auto_now_add=True)
     data_retorn = models.DateField(null=True, blank=True)
+    data_venciment = models.DateField(null=True, blank=True)
+    darrer_avis = models.DateField(null=True, blank=True, editable=False)
     anotacions = models.TextField(blank=True,null=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
     def __str__(self):
         return str(self.exemplar)
 
+class Avis(models.Model):
+    """
+    Avís per a un usuari: un resum per usuari, tipus i dia amb tots els
+    préstecs afectats. enviat queda buit fins que s'envia.
+    """
+    VENCIMENT = 'venciment'
+    TIPUS = ((VENCIMENT, 'Préstecs vençuts'),)
+    class Meta:
+        verbose_name_plural = "Avisos"
+        constraints = [
+            models.UniqueConstraint(fields=['usuari', 'tipus', 'data'], name='avis_usuari_tipus_data_uniq'),
+        ]
+        indexes = [models.Index(fields=['enviat', 'data'], name='avis_enviat_data_idx')]
+    usuari = models.ForeignKey(Usuari, on_delete=models.CASCADE)
+    tipus = models.CharField(max_length=20, choices=TIPUS)
+    data = models.DateField()
+    prestecs = models.ManyToManyField(Prestec, blank=True)
+    creat = models.DateTimeField(auto_now_add=True)
+    enviat = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.usuari} - {self.get_tipus_display()} ({self.data})"
+
 class Peticio(models.Model):
     class Meta:
         verbose_name_plural = "Peticions"
@@ -208,3 +495,58 @@ class Log(models.Model):
 class Documento(models.Model):
     archivo = models.FileField(upload_to="documentos/")
     fecha_subida = models.DateTimeField(auto_now_add=True)
+
+
+# Cua de tasques en segon pla (vegeu tasques.py)
+class Tasca(models.Model):
+    PENDENT = 'pendent'
+    EN_CURS = 'en_curs'
+    COMPLETADA = 'completada'
+    FALLIDA = 'fallida'
+    ESTATS = [
+        (PENDENT, 'Pendent'),
+        (EN_CURS, 'En curs'),
+        (COMPLETADA, 'Completada'),
+        (FALLIDA, 'Fallida'),
+    ]
+    class Meta:
+        verbose_name_plural = "Tasques"
+        indexes = [models.Index(fields=['estat', 'creat'], name='tasca_estat_creat_idx')]
+    tipus = models.CharField(max_length=50)
+    # qui l'ha encuada: només ell la pot consultar a /api/jobs/{id}
+    usuari = models.ForeignKey(Usuari, on_delete=models.CASCADE, null=True, blank=True, related_name='tasques')
+    document = models.ForeignKey(Documento, on_delete=models.SET_NULL, null=True, blank=True)
+    # format del document (importacio.FORMATS): el nom desat pot no dir-lo
+    format = models.CharField(max_length=10, blank=True)
+    estat = models.CharField(max_length=20, choices=ESTATS, default=PENDENT)
+    treballador = models.CharField(max_length=100, blank=True)
+    # el treballador el renova a cada lot; si passa TASQUES_TERMINI sense
+    # renovar-lo, la tasca es pot tornar a reclamar (tasques.py)
+    batec = models.DateTimeField(null=True, blank=True)
+    intents = models.PositiveSmallIntegerField(default=0)
+    creat = models.DateTimeField(auto_now_add=True)
+    inici = models.DateTimeField(null=True, blank=True)
+    fi = models.DateTimeField(null=True, blank=True)
+    processades = models.PositiveIntegerField(default=0)
+    creades = models.PositiveIntegerField(default=0)
+    errors = models.JSONField(default=list, blank=True)
+    missatge = models.TextField(blank=True)
+
+    def files_per_segon(self):
+        if self.inici is None:
+            return None
+        segons = ((self.fi or now()) - self.inici).total_seconds()
+        return round(self.processades / segons, 1) if segons > 0 else None
+
+    def __str__(self):
+        return f"{self.tipus} #{self.pk} ({self.estat})"
+
+
+# Índex de cerca del catàleg (backend portable, vegeu cerca.py)
+class TermeCerca(models.Model):
+    MAX_TERME = 64
+    class Meta:
+        indexes = [models.Index(fields=['terme', 'cataleg'])]
+    terme = models.CharField(max_length=MAX_TERME)
+    cataleg = models.ForeignKey(Cataleg, on_delete=models.CASCADE, related_name='+')
+    pes = models.FloatField(default=0)
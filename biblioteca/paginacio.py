@@ -0,0 +1,109 @@
+import base64
+import json
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+
+
+# Paginació per cursor (keyset)
+#
+# En lloc d'OFFSET, cada pàgina es demana a partir dels valors de la darrera
+# fila retornada, de manera que el cost no creix amb el número de pàgina.
+# El cursor és opac pel client: JSON codificat en base64 url-safe.
+
+
+def mida_pagina(limit=None):
+    per_defecte = getattr(settings, "API_PAGE_SIZE", 50)
+    maxim = getattr(settings, "API_MAX_PAGE_SIZE", 500)
+    if not limit or limit < 1:
+        return per_defecte
+    return min(limit, maxim)
+
+
+def codificar_cursor(valors):
+    dades = json.dumps(valors, default=str, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(dades).decode().rstrip("=")
+
+
+def decodificar_cursor(cursor):
+    try:
+        farciment = "=" * (-len(cursor) % 4)
+        valors = json.loads(base64.urlsafe_b64decode(cursor + farciment))
+    except (ValueError, TypeError):
+        raise ValueError("Cursor invàlid")
+    if not isinstance(valors, dict):
+        raise ValueError("Cursor invàlid")
+    return valors
+
+
+def _filtre_keyset(ordre, valors):
+    # (a, b) > (va, vb)  =>  a > va OR (a = va AND b > vb)
+    filtre = Q()
+    iguals = Q()
+    for camp in ordre:
+        nom = camp.lstrip("-")
+        # només escalars: una llista o un objecte farien petar el filtre
+        if nom not in valors or not isinstance(valors[nom], (str, int, float)):
+            raise ValueError("Cursor invàlid")
+        lookup = "lt" if camp.startswith("-") else "gt"
+        filtre |= iguals & Q(**{f"{nom}__{lookup}": valors[nom]})
+        iguals &= Q(**{nom: valors[nom]})
+    return filtre
+
+
+def paginar_keyset(qs, ordre=("pk",), cursor=None, limit=None):
+    """
+    Retorna (files, seguent_cursor) per a la pàgina demanada.
+    L'últim camp d'`ordre` ha de ser únic (normalment la pk).
+    """
+    limit = mida_pagina(limit)
+    qs = qs.order_by(*ordre)
+    if cursor:
+        try:
+            qs = qs.filter(_filtre_keyset(ordre, decodificar_cursor(cursor)))
+        except (TypeError, ValidationError):
+            # valor que no encaixa amb el tipus de la columna ("abc" per a una data...)
+            raise ValueError("Cursor invàlid")
+
+    files = list(qs[:limit + 1])
+    seguent = None
+    if len(files) > limit:
+        files = files[:limit]
+        darrera = files[-1]
+        seguent = codificar_cursor({
+            camp.lstrip("-"): _valor(darrera, camp.lstrip("-")) for camp in ordre
+        })
+    return files, seguent
+
+
+def _valor(fila, camp):
+    if isinstance(fila, dict):
+        return fila[camp]
+    return getattr(fila, camp)
+
+
+def paginar_ids(qs, ids, cursor=None, limit=None):
+    """
+    Com paginar_keyset, però en l'ordre de la llista ids (p. ex. el rànquing
+    d'una cerca). El cursor és la posició a ids de la primera fila de la
+    pàgina següent; els ids que qs exclou se salten.
+    """
+    limit = mida_pagina(limit)
+    inici = 0
+    if cursor:
+        inici = decodificar_cursor(cursor).get("posicio")
+        if type(inici) is not int or inici < 0:
+            raise ValueError("Cursor invàlid")
+    files = []
+    i = inici
+    while len(files) <= limit and i < len(ids):
+        tros = ids[i:i + limit + 1]
+        per_pk = {fila.pk: fila for fila in qs.filter(pk__in=tros)}
+        files.extend((i + j, per_pk[pk]) for j, pk in enumerate(tros) if pk in per_pk)
+        i += len(tros)
+    seguent = None
+    if len(files) > limit:
+        seguent = codificar_cursor({"posicio": files[limit][0]})
+        files = files[:limit]
+    return [fila for _, fila in files], seguent
@@ -0,0 +1,342 @@
+import random
+import time
+from datetime import date
+
+from django.conf import settings
+from django.db import OperationalError, connection, transaction
+from django.utils import timezone
+
+from . import cache_api, disponibilitat, reserves, venciments
+from .models import Cataleg, Exemplar, Prestec, Reserva, Usuari
+
+
+# Préstecs i retorns
+#
+# Cada operació és una transacció que primer bloqueja la fila de l'exemplar
+# i després comprova si es pot prestar o retornar, de manera que dues
+# peticions sobre el mateix exemplar queden serialitzades i no hi pot haver
+# dos préstecs oberts alhora.
+#
+# El bloqueig és un UPDATE de l'exemplar: a MySQL i PostgreSQL bloqueja la
+# fila fins al final de la transacció, i a SQLite agafa el lock d'escriptura
+# abans de llegir res. Els conflictes de bloqueig (interbloquejos a MySQL,
+# "database is locked" a SQLite) es reintenten uns quants cops.
+#
+# Els comptadors de disponibilitat i la cache de l'API s'actualitzen amb els
+# signals de Prestec, dins la mateixa transacció.
+#
+# Un exemplar guardat per una reserva (reserves.py) només es pot prestar a
+# qui l'ha reservat; prestar-lo tanca la reserva i retornar-lo l'assigna a la
+# primera de la cua.
+
+
+class PrestecError(Exception):
+    """L'operació no es pot fer; el missatge es pot mostrar a l'usuari."""
+
+
+class NoDisponible(PrestecError):
+    pass
+
+
+def _reintentar(operacio):
+    if connection.in_atomic_block:
+        # dins d'una transacció externa no es pot reintentar només aquest tros
+        return operacio()
+    intents = getattr(settings, "PRESTECS_REINTENTS", 5)
+    for intent in range(intents):
+        try:
+            return operacio()
+        except OperationalError:
+            if intent == intents - 1:
+                raise
+            time.sleep(random.uniform(0, 0.01 * 2 ** intent))
+
+
+def _bloquejar(exemplar_id):
+    if not Exemplar.objects.filter(pk=exemplar_id).update(updated_at=timezone.now()):
+        raise Exemplar.DoesNotExist(f"Exemplar {exemplar_id} no trobat")
+    return Exemplar.objects.only("baixa", "exclos_prestec", "cataleg_id").get(pk=exemplar_id)
+
+
+def _prestec_obert(exemplar_id):
+    return Prestec.objects.filter(exemplar_id=exemplar_id, data_retorn__isnull=True).first()
+
+
+def prestar(usuari_id, exemplar_id, data_prestec=None, anotacions=""):
+    """
+    Crea el préstec de l'exemplar a l'usuari. Llança Usuari.DoesNotExist,
+    Exemplar.DoesNotExist o NoDisponible.
+    """
+    if not Usuari.objects.filter(pk=usuari_id, is_active=True).exists():
+        raise Usuari.DoesNotExist(f"Usuari {usuari_id} no trobat")
+
+    def operacio():
+        with transaction.atomic():
+            exemplar = _bloquejar(exemplar_id)
+            if exemplar.baixa or exemplar.exclos_prestec:
+                raise NoDisponible("L'exemplar no es pot prestar")
+            if _prestec_obert(exemplar_id) is not None:
+                raise NoDisponible("L'exemplar ja està en préstec")
+            if reserves.guardat_per([exemplar_id]).get(exemplar_id, usuari_id) != usuari_id:
+                raise NoDisponible("L'exemplar està reservat per a un altre usuari")
+            if reserves.recollir([(usuari_id, exemplar.cataleg_id, exemplar_id)]):
+                reserves.actualitzar([exemplar.cataleg_id])
+            prestec = Prestec(
+                usuari_id=usuari_id, exemplar=exemplar, anotacions=anotacions or "", data_prestec=data_prestec,
+            )
+            venciments.assignar([prestec])
+            prestec.save()
+            if data_prestec and data_prestec != prestec.data_prestec:
+                # data_prestec és auto_now_add: una data anterior s'ha de desar a part
+                prestec.data_prestec = data_prestec
+                prestec.save(update_fields=["data_prestec"])
+            return prestec
+
+    return _reintentar(operacio)
+
+
+def retornar(exemplar_id, data_retorn=None):
+    """Tanca el préstec obert de l'exemplar. Llança Exemplar.DoesNotExist o PrestecError."""
+    def operacio():
+        with transaction.atomic():
+            exemplar = _bloquejar(exemplar_id)
+            prestec = _prestec_obert(exemplar_id)
+            if prestec is None:
+                raise PrestecError("L'exemplar no està en préstec")
+            prestec.data_retorn = data_retorn or date.today()
+            prestec.save(update_fields=["data_retorn", "updated_at"])
+            if reserves.assignar([exemplar_id]):
+                reserves.actualitzar([exemplar.cataleg_id])
+            return prestec
+
+    return _reintentar(operacio)
+
+
+# Préstecs i retorns per lots (taulells que escanegen una pila d'exemplars)
+#
+# Tot el lot és una sola transacció: un UPDATE bloqueja tots els exemplars,
+# unes quantes consultes IN validen usuaris, exemplars i préstecs oberts, i
+# els préstecs es creen o es tanquen en bloc. Com que bulk_create i update()
+# no llancen signals, els comptadors i la cache s'actualitzen aquí.
+# Cada element té el seu resultat: un error en un no atura els altres.
+
+
+def _resoldre_exemplars(elements):
+    """Omple element["exemplar"] a partir del registre quan cal; retorna {index: error}."""
+    registres = {e["registre"] for e in elements if not e.get("exemplar") and e.get("registre")}
+    per_registre = {}
+    for pk, registre in Exemplar.objects.filter(registre__in=registres).values_list("pk", "registre"):
+        per_registre.setdefault(registre, []).append(pk)
+    errors = {}
+    for i, element in enumerate(elements):
+        if element.get("exemplar"):
+            continue
+        trobats = per_registre.get(element.get("registre"), [])
+        if len(trobats) == 1:
+            element["exemplar"] = trobats[0]
+        elif trobats:
+            errors[i] = f"Registre ambigu: {element['registre']}"
+        else:
+            errors[i] = "Exemplar no trobat"
+    return errors
+
+
+def _bloquejar_lot(exemplar_ids):
+    Exemplar.objects.filter(pk__in=exemplar_ids).update(updated_at=timezone.now())
+    return {
+        fila["pk"]: fila
+        for fila in Exemplar.objects.filter(pk__in=exemplar_ids).values("pk", "registre", "baixa", "exclos_prestec", "cataleg_id")
+    }
+
+
+def _despres_del_lot(exemplars, usernames, amb_reserves=()):
+    """amb_reserves: catàlegs on el lot ha canviat reserves."""
+    cataleg_ids = {e["cataleg_id"] for e in exemplars}
+    disponibilitat.recalcular(cataleg_ids)
+    grups = {"llibres", "exemplars"}
+    grups.update(f"llibre:{pk}" for pk in cataleg_ids)
+    grups.update(f"registre:{e['registre']}" for e in exemplars)
+    grups.update(f"prestecs:{username}" for username in usernames)
+    grups.update(reserves.grups(amb_reserves))
+    cache_api.invalidar_en_commit(*grups)
+
+
+def prestar_lot(elements, anotacions=""):
+    """
+    elements: [{"usuari": id, "exemplar": id}] o amb "registre" en lloc
+    d'"exemplar". Retorna un resultat per element, en el mateix ordre:
+    {"exemplar", "ok", "prestec"} o {"exemplar", "ok": False, "error"}.
+    """
+    def operacio():
+        lot = [dict(e) for e in elements]
+        with transaction.atomic():
+            errors = _resoldre_exemplars(lot)
+            exemplar_ids = {e["exemplar"] for i, e in enumerate(lot) if i not in errors}
+            exemplars = _bloquejar_lot(exemplar_ids)
+            oberts = set(
+                Prestec.objects.filter(exemplar_id__in=exemplar_ids, data_retorn__isnull=True)
+                .values_list("exemplar_id", flat=True)
+            )
+            usuaris = dict(
+                Usuari.objects.filter(pk__in={e.get("usuari") for e in lot}, is_active=True)
+                .values_list("pk", "username")
+            )
+            guardats = reserves.guardat_per(exemplar_ids)
+
+            nous = {}
+            for i, element in enumerate(lot):
+                if i in errors:
+                    continue
+                exemplar = exemplars.get(element["exemplar"])
+                if element.get("usuari") not in usuaris:
+                    errors[i] = "Usuari no trobat"
+                elif exemplar is None:
+                    errors[i] = "Exemplar no trobat"
+                elif exemplar["baixa"] or exemplar["exclos_prestec"]:
+                    errors[i] = "L'exemplar no es pot prestar"
+                elif exemplar["pk"] in oberts:
+                    errors[i] = "L'exemplar ja està en préstec"
+                elif guardats.get(exemplar["pk"], element["usuari"]) != element["usuari"]:
+                    errors[i] = "L'exemplar està reservat per a un altre usuari"
+                else:
+                    # el mateix exemplar dues vegades al lot: només el primer
+                    oberts.add(exemplar["pk"])
+                    nous[i] = Prestec(usuari_id=element["usuari"], exemplar_id=exemplar["pk"], anotacions=anotacions)
+
+            recollides = reserves.recollir([
+                (p.usuari_id, exemplars[p.exemplar_id]["cataleg_id"], p.exemplar_id) for p in nous.values()
+            ])
+            venciments.assignar(nous.values())
+            creats = Prestec.objects.bulk_create(nous.values())
+            if any(p.pk is None for p in creats):
+                # MySQL no retorna les pk de bulk_create
+                ids = dict(
+                    Prestec.objects.filter(
+                        exemplar_id__in=[p.exemplar_id for p in creats], data_retorn__isnull=True,
+                    ).values_list("exemplar_id", "pk")
+                )
+                for prestec in creats:
+                    prestec.pk = ids[prestec.exemplar_id]
+            _despres_del_lot(
+                [exemplars[p.exemplar_id] for p in creats],
+                {usuaris[p.usuari_id] for p in creats},
+                recollides,
+            )
+        return [
+            {"exemplar": element.get("exemplar"), "ok": True, "prestec": nous[i].pk}
+            if i in nous else
+            {"exemplar": element.get("exemplar"), "ok": False, "error": errors[i]}
+            for i, element in enumerate(lot)
+        ]
+
+    return _reintentar(operacio)
+
+
+def retornar_lot(elements, data_retorn=None):
+    """
+    elements: [{"exemplar": id}] o [{"registre": codi}]. Tanca el préstec
+    obert de cada exemplar; retorna un resultat per element com prestar_lot.
+    """
+    def operacio():
+        lot = [dict(e) for e in elements]
+        with transaction.atomic():
+            errors = _resoldre_exemplars(lot)
+            exemplar_ids = {e["exemplar"] for i, e in enumerate(lot) if i not in errors}
+            exemplars = _bloquejar_lot(exemplar_ids)
+            oberts = {
+                exemplar_id: (pk, username)
+                for pk, exemplar_id, username in Prestec.objects.filter(
+                    exemplar_id__in=exemplar_ids, data_retorn__isnull=True,
+                ).values_list("pk", "exemplar_id", "usuari__username")
+            }
+
+            tancats = {}
+            for i, element in enumerate(lot):
+                if i in errors:
+                    continue
+                if element["exemplar"] not in exemplars:
+                    errors[i] = "Exemplar no trobat"
+                elif element["exemplar"] not in oberts:
+                    errors[i] = "L'exemplar no està en préstec"
+                else:
+                    tancats[i] = oberts.pop(element["exemplar"])
+
+            Prestec.objects.filter(pk__in=[pk for pk, _ in tancats.values()]).update(
+                data_retorn=data_retorn or date.today(), updated_at=timezone.now(),
+            )
+            retornats = [lot[i]["exemplar"] for i in tancats]
+            assignades = reserves.assignar(retornats)
+            _despres_del_lot(
+                [exemplars[pk] for pk in retornats],
+                {username for _, username in tancats.values()},
+                {exemplars[pk]["cataleg_id"] for pk in assignades.values()},
+            )
+        return [
+            {"exemplar": element.get("exemplar"), "ok": True, "prestec": tancats[i][0]}
+            if i in tancats else
+            {"exemplar": element.get("exemplar"), "ok": False, "error": errors[i]}
+            for i, element in enumerate(lot)
+        ]
+
+    return _reintentar(operacio)
+
+
+# Reserves (la cua és a reserves.py)
+
+
+def reservar(usuari_id, cataleg_id):
+    """
+    Posa l'usuari a la cua del registre. Si hi ha un exemplar disponible, la
+    reserva l'agafa de seguida. Llança Usuari.DoesNotExist,
+    Cataleg.DoesNotExist o PrestecError.
+    """
+    if not Usuari.objects.filter(pk=usuari_id, is_active=True).exists():
+        raise Usuari.DoesNotExist(f"Usuari {usuari_id} no trobat")
+
+    def operacio():
+        with transaction.atomic():
+            # bloqueja el registre: les posicions de la cua no es repeteixen
+            if not Cataleg.objects.filter(pk=cataleg_id).update(updated_at=timezone.now()):
+                raise Cataleg.DoesNotExist(f"Catàleg {cataleg_id} no trobat")
+            if Reserva.objects.filter(usuari_id=usuari_id, cataleg_id=cataleg_id, estat__in=Reserva.ACTIVES).exists():
+                raise PrestecError("Ja tens una reserva activa d'aquest registre")
+            if Prestec.objects.filter(
+                usuari_id=usuari_id, exemplar__cataleg_id=cataleg_id, data_retorn__isnull=True,
+            ).exists():
+                raise PrestecError("Ja tens un exemplar d'aquest registre en préstec")
+            reserva = Reserva.objects.create(
+                usuari_id=usuari_id, cataleg_id=cataleg_id, posicio=reserves.seguent_posicio(cataleg_id),
+            )
+            if reserves.assignar_registre(cataleg_id):
+                reserves.actualitzar([cataleg_id])
+                reserva.refresh_from_db()
+            return reserva
+
+    return _reintentar(operacio)
+
+
+def cancellar_reserva(reserva_id, usuari_id):
+    """
+    Cancel·la la reserva activa de l'usuari; si tenia un exemplar guardat,
+    passa al següent de la cua. Llança Reserva.DoesNotExist.
+    """
+    def operacio():
+        with transaction.atomic():
+            cataleg_id = (
+                Reserva.objects.filter(pk=reserva_id, usuari_id=usuari_id, estat__in=Reserva.ACTIVES)
+                .values_list("cataleg_id", flat=True).first()
+            )
+            if cataleg_id is None:
+                raise Reserva.DoesNotExist(f"Reserva {reserva_id} no trobada")
+            Cataleg.objects.filter(pk=cataleg_id).update(updated_at=timezone.now())
+            reserva = Reserva.objects.get(pk=reserva_id)
+            if reserva.estat not in Reserva.ACTIVES:
+                raise Reserva.DoesNotExist(f"Reserva {reserva_id} no trobada")
+            guardat = reserva.exemplar_id if reserva.estat == Reserva.ASSIGNADA else None
+            reserva.estat = Reserva.CANCELLADA
+            reserva.save(update_fields=["estat"])
+            if guardat and reserves.assignar([guardat]):
+                reserves.actualitzar([cataleg_id])
+            return reserva
+
+    return _reintentar(operacio)
@@ -0,0 +1,180 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from . import cache_api, disponibilitat
+from .models import Exemplar, Reserva
+
+
+# Cua de reserves
+#
+# Les reserves es fan sobre un registre del catàleg, no sobre un exemplar.
+# Les que esperen s'ordenen per posicio dins del registre i l'índex
+# (cataleg, estat, posicio) dona la primera de la cua amb una sola cerca.
+# Quan un exemplar queda lliure (retorn, reserva caducada o cancel·lada)
+# s'assigna a la primera reserva en espera, que el té guardat fins a
+# `expira`; mentrestant l'exemplar no compta com a disponible.
+#
+# Aquestes funcions s'executen dins la transacció de qui les crida
+# (prestecs.py, processar_reserves) i canvien les reserves amb update(),
+# sense signals: qui les crida recalcula els comptadors amb actualitzar().
+
+
+def termini():
+    return timedelta(hours=getattr(settings, "RESERVES_TERMINI_RECOLLIDA", 72))
+
+
+def seguent_posicio(cataleg_id):
+    ultima = (
+        Reserva.objects.filter(cataleg_id=cataleg_id, estat=Reserva.ESPERA)
+        .order_by("-posicio").values_list("posicio", flat=True).first()
+    )
+    return (ultima or 0) + 1
+
+
+def lloc_a_la_cua(reserva):
+    """1 per a la primera reserva en espera del registre."""
+    return Reserva.objects.filter(
+        cataleg_id=reserva.cataleg_id, estat=Reserva.ESPERA, posicio__lt=reserva.posicio,
+    ).count() + 1
+
+
+def assignar(exemplar_ids):
+    """
+    Assigna cada exemplar disponible de la llista a la primera reserva en
+    espera del seu registre. Retorna les reserves assignades {pk: exemplar_id}.
+    """
+    ara = timezone.now()
+    assignades = {}
+    lliures = (
+        Exemplar.objects.filter(pk__in=exemplar_ids).disponibles()
+        .order_by("pk").values_list("pk", "cataleg_id")
+    )
+    for exemplar_id, cataleg_id in lliures:
+        while True:
+            primera = (
+                Reserva.objects.filter(cataleg_id=cataleg_id, estat=Reserva.ESPERA)
+                .order_by("posicio").values_list("pk", flat=True).first()
+            )
+            if primera is None:
+                break
+            # UPDATE condicional: si una altra transacció ja l'ha assignada, la següent
+            if Reserva.objects.filter(pk=primera, estat=Reserva.ESPERA).update(
+                estat=Reserva.ASSIGNADA, exemplar_id=exemplar_id, assignada=ara, expira=ara + termini(),
+            ):
+                assignades[primera] = exemplar_id
+                break
+    return assignades
+
+
+def assignar_registre(cataleg_id):
+    """Assigna els exemplars disponibles del registre a les reserves en espera."""
+    return assignar(Exemplar.objects.filter(cataleg_id=cataleg_id).disponibles().values_list("pk", flat=True))
+
+
+def assignar_pendents(mida_lot=1000):
+    """
+    Per a càrregues massives: assigna els exemplars disponibles dels registres
+    que tenen reserves en espera, per lots de mida_lot registres. Retorna els
+    catàlegs on ha assignat.
+    """
+    catalegs = set()
+    ultim = 0
+    while True:
+        lot = list(
+            Reserva.objects.filter(estat=Reserva.ESPERA, cataleg_id__gt=ultim)
+            .order_by("cataleg_id").values_list("cataleg_id", flat=True).distinct()[:mida_lot]
+        )
+        if not lot:
+            return catalegs
+        ultim = lot[-1]
+        assignades = assignar(
+            Exemplar.objects.filter(cataleg_id__in=lot).disponibles().values_list("pk", flat=True)
+        )
+        catalegs.update(
+            Exemplar.objects.filter(pk__in=assignades.values()).values_list("cataleg_id", flat=True)
+        )
+
+
+def guardat_per(exemplar_ids):
+    """{exemplar_id: usuari_id} dels exemplars guardats per una reserva."""
+    return dict(
+        Reserva.objects.filter(exemplar_id__in=exemplar_ids, estat=Reserva.ASSIGNADA)
+        .values_list("exemplar_id", "usuari_id")
+    )
+
+
+def recollir(prestecs):
+    """
+    Marca com a recollides les reserves actives que queden cobertes pels
+    préstecs [(usuari_id, cataleg_id, exemplar_id)]. Si la reserva guardava
+    un altre exemplar, aquest passa a la següent de la cua. Retorna els
+    catàlegs on han canviat reserves.
+    """
+    if not prestecs:
+        return set()
+    usuaris = {usuari_id for usuari_id, _, _ in prestecs}
+    catalegs = {cataleg_id for _, cataleg_id, _ in prestecs}
+    coberts = {(usuari_id, cataleg_id) for usuari_id, cataleg_id, _ in prestecs}
+    reserves = [
+        (pk, cataleg_id, exemplar_id, estat)
+        for pk, usuari_id, cataleg_id, exemplar_id, estat in Reserva.objects.filter(
+            usuari_id__in=usuaris, cataleg_id__in=catalegs, estat__in=Reserva.ACTIVES,
+        ).values_list("pk", "usuari_id", "cataleg_id", "exemplar_id", "estat")
+        if (usuari_id, cataleg_id) in coberts
+    ]
+    if not reserves:
+        return set()
+    Reserva.objects.filter(pk__in=[r[0] for r in reserves]).update(estat=Reserva.RECOLLIDA)
+    prestats = {exemplar_id for _, _, exemplar_id in prestecs}
+    # l'exemplar que guardava la reserva no és el que s'emporta: queda lliure
+    # (assignar() només agafa els que encara són disponibles)
+    assignar([
+        exemplar_id for _, _, exemplar_id, estat in reserves
+        if estat == Reserva.ASSIGNADA and exemplar_id not in prestats
+    ])
+    return {cataleg_id for _, cataleg_id, _, _ in reserves}
+
+
+def caducar(ara=None, mida_lot=1000):
+    """
+    Caduca les reserves assignades que no s'han recollit a temps i passa els
+    exemplars a la següent de la cua, per lots. Retorna quantes n'ha caducat.
+    """
+    ara = ara or timezone.now()
+    total = 0
+    while True:
+        with transaction.atomic():
+            lot = list(
+                Reserva.objects.filter(estat=Reserva.ASSIGNADA, expira__lt=ara)
+                .order_by("expira").values_list("pk", "exemplar_id", "cataleg_id")[:mida_lot]
+            )
+            if not lot:
+                return total
+            Reserva.objects.filter(pk__in=[pk for pk, _, _ in lot], estat=Reserva.ASSIGNADA).update(
+                estat=Reserva.CADUCADA,
+            )
+            exemplar_ids = [exemplar_id for _, exemplar_id, _ in lot]
+            assignar(exemplar_ids)
+            actualitzar({cataleg_id for _, _, cataleg_id in lot})
+        total += len(lot)
+
+
+def grups(cataleg_ids):
+    """Grups de cache_api que depenen de les reserves d'aquests catàlegs."""
+    if not cataleg_ids:
+        return set()
+    # l'escaneig de qualsevol exemplar del registre mostra quantes reserves hi ha
+    registres = Exemplar.objects.filter(cataleg_id__in=cataleg_ids).values_list("registre", flat=True)
+    resultat = {"llibres", "exemplars"}
+    resultat.update(f"llibre:{pk}" for pk in cataleg_ids)
+    resultat.update(f"registre:{registre}" for registre in registres)
+    return resultat
+
+
+def actualitzar(cataleg_ids):
+    """Comptadors i cache després de canviar reserves amb update()."""
+    disponibilitat.recalcular(cataleg_ids)
+    cache_api.invalidar_en_commit(*grups(cataleg_ids))
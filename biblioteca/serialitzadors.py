@@ -0,0 +1,234 @@
+from django.db.models import Count, FilteredRelation, OuterRef, Q, Subquery
+
+from .models import Exemplar, Reserva
+from .paginacio import paginar_keyset
+
+
+# Consulta i serialització d'exemplars
+#
+# Un Cataleg pot ser Llibre, Revista, CD, DVD, BR o Dispositiu (herència
+# multi-taula). En lloc de carregar objectes i provar hasattr() per cada fila,
+# es fa una sola consulta .values() amb LEFT JOIN a totes les taules filles
+# i el tipus es dedueix de quina clau de subtipus no és nul·la. Les files es
+# converteixen directament a dicts amb la forma dels esquemes de sortida.
+#
+# consultar_exemplars() és el punt d'entrada comú de tots els endpoints
+# d'exemplars: filtres, paginació per cursor i projecció de camps (només es
+# demanen les columnes i JOINs que calen per als camps sol·licitats).
+
+# columnes comunes de CatalegOut
+CATALEG = {
+    "id": "cataleg_id",
+    "titol": "cataleg__titol",
+    "autor": "cataleg__autor__nom",
+}
+
+# tipus -> (relació del subtipus, columnes pròpies de l'esquema de sortida)
+SUBTIPUS = {
+    "llibre": ("llibre", {
+        "ISBN": "cataleg__llibre__ISBN",
+        "editorial": "cataleg__editorial__nom",
+        "thumbnail_url": "cataleg__llibre__thumbnail_url",
+        "comptador_exemplars": "cataleg__comptador_exemplars",
+        "comptador_disponibles": "cataleg__comptador_disponibles",
+    }),
+    "revista": ("revista", {
+        "ISSN": "cataleg__revista__ISSN",
+        "editorial": "cataleg__editorial__nom",
+        "numero": "cataleg__revista__numero",
+    }),
+    "cd": ("cd", {
+        "discografica": "cataleg__cd__discografica",
+        "estil": "cataleg__cd__estil",
+        "duracio": "cataleg__cd__duracio",
+    }),
+    "dvd": ("dvd", {
+        "productora": "cataleg__dvd__productora",
+        "duracio": "cataleg__dvd__duracio",
+    }),
+    "br": ("br", {
+        "productora": "cataleg__br__productora",
+        "duracio": "cataleg__br__duracio",
+    }),
+    "dispositiu": ("dispositiu", {
+        "marca": "cataleg__dispositiu__marca",
+        "model": "cataleg__dispositiu__model",
+    }),
+}
+
+EXEMPLAR = {
+    "id": "id",
+    "registre": "registre",
+    "exclos_prestec": "exclos_prestec",
+    "baixa": "baixa",
+}
+
+# clau del subtipus per saber si la fila filla existeix
+_CLAUS = [(tipus, f"cataleg__{rel}__cataleg_ptr_id") for tipus, (rel, _) in SUBTIPUS.items()]
+
+
+# camps de primer nivell d'ExemplarOut que es poden demanar amb ?fields=
+CAMPS = ("id", "registre", "exclos_prestec", "baixa", "cataleg", "tipus", "centre")
+
+
+def camps_valids(fields=None):
+    """Converteix 'id,registre,...' en una tupla de camps coneguts."""
+    if not fields:
+        return CAMPS
+    camps = tuple(c.strip() for c in fields.split(",") if c.strip())
+    desconeguts = set(camps) - set(CAMPS)
+    if desconeguts:
+        raise ValueError(f"Camps desconeguts: {', '.join(sorted(desconeguts))}")
+    return camps
+
+
+def columnes_exemplar(camps=CAMPS):
+    columnes = ["id"] + [EXEMPLAR[c] for c in EXEMPLAR if c in camps]
+    if "centre" in camps:
+        columnes += ["centre_id", "centre__nom"]
+    if "cataleg" in camps or "tipus" in camps:
+        columnes += [clau for _, clau in _CLAUS]
+    if "cataleg" in camps:
+        columnes += CATALEG.values()
+        for _, subcamps in SUBTIPUS.values():
+            columnes += subcamps.values()
+    return list(dict.fromkeys(columnes))
+
+
+def tipus_de(fila):
+    for tipus, clau in _CLAUS:
+        if fila[clau] is not None:
+            return tipus
+    return "indefinit"
+
+
+def exemplar_dict(fila, camps=CAMPS):
+    resultat = {camp: fila[columna] for camp, columna in EXEMPLAR.items() if camp in camps}
+    if "cataleg" in camps or "tipus" in camps:
+        tipus = tipus_de(fila)
+        if "cataleg" in camps:
+            cataleg = {camp: fila[columna] for camp, columna in CATALEG.items()}
+            if tipus in SUBTIPUS:
+                for camp, columna in SUBTIPUS[tipus][1].items():
+                    cataleg[camp] = fila[columna]
+            resultat["cataleg"] = cataleg
+        if "tipus" in camps:
+            resultat["tipus"] = tipus
+    if "centre" in camps:
+        resultat["centre"] = {"id": fila["centre_id"], "nom": fila["centre__nom"]}
+    return resultat
+
+
+def filtrar_exemplars(qs=None, cataleg=None, centre=None, disponible=None, tipus=None):
+    if qs is None:
+        qs = Exemplar.objects.all()
+    if cataleg is not None:
+        qs = qs.filter(cataleg_id=cataleg)
+    if centre is not None:
+        qs = qs.filter(centre_id=centre)
+    if disponible is not None:
+        qs = qs.disponibles(disponible)
+    if tipus is not None:
+        if tipus == "indefinit":
+            qs = qs.filter(**{f"cataleg__{rel}__isnull": True for rel, _ in SUBTIPUS.values()})
+        elif tipus in SUBTIPUS:
+            qs = qs.filter(**{f"cataleg__{SUBTIPUS[tipus][0]}__isnull": False})
+        else:
+            raise ValueError(f"Tipus desconegut: {tipus}")
+    return qs
+
+
+def serialitzar_exemplars(qs=None, camps=CAMPS):
+    """Llista de dicts amb la forma d'ExemplarOut per al queryset donat."""
+    if qs is None:
+        qs = Exemplar.objects.all()
+    return [exemplar_dict(fila, camps) for fila in qs.values(*columnes_exemplar(camps))]
+
+
+def consultar_exemplars(cataleg=None, centre=None, disponible=None, tipus=None,
+                        fields=None, cursor=None, limit=None):
+    """
+    Filtra, projecta i serialitza exemplars.
+    Retorna (files, seguent_cursor). Només es pagina si es demana cursor o
+    limit; si no, seguent_cursor és None.
+    Llança ValueError si algun paràmetre no és vàlid.
+    """
+    camps = camps_valids(fields)
+    qs = filtrar_exemplars(
+        cataleg=cataleg, centre=centre, disponible=disponible, tipus=tipus
+    ).values(*columnes_exemplar(camps))
+    if cursor or limit is not None:
+        files, seguent = paginar_keyset(qs, ("id",), cursor, limit)
+    else:
+        files, seguent = qs.order_by("id"), None
+    return [exemplar_dict(fila, camps) for fila in files], seguent
+
+
+# Escaneig al taulell: exemplar pel codi de barres (registre), amb catàleg,
+# préstec obert i reserves en una sola consulta. L'índex únic
+# (registre, centre) resol el codi; el préstec obert és un LEFT JOIN filtrat
+# (n'hi ha com a molt un) i les reserves, subconsultes correlacionades.
+
+PRESTEC_OBERT = {
+    "id": "obert__id",
+    "usuari": "obert__usuari__username",
+    "data_prestec": "obert__data_prestec",
+}
+
+
+def _reserva(camp):
+    # la reserva que té l'exemplar guardat (n'hi ha com a molt una)
+    qs = Reserva.objects.filter(exemplar=OuterRef("pk"), estat=Reserva.ASSIGNADA).order_by()
+    return Subquery(qs.values(camp)[:1])
+
+
+_plantilla_escaneig = None
+
+
+def _plantilla():
+    # Resoldre els JOINs de totes les columnes és la part cara de construir
+    # la consulta; es fa una vegada per procés i cada escaneig només hi
+    # afegeix el filtre pel codi.
+    global _plantilla_escaneig
+    if _plantilla_escaneig is None:
+        n_reserves = (
+            Reserva.objects.filter(cataleg=OuterRef("cataleg_id"), estat__in=Reserva.ACTIVES).order_by()
+            .values("cataleg").annotate(n=Count("pk")).values("n")
+        )
+        columnes = columnes_exemplar() + list(PRESTEC_OBERT.values()) + [
+            "reserva_id", "reserva_usuari", "reserva_data", "reserva_expira", "n_reserves",
+        ]
+        _plantilla_escaneig = Exemplar.objects.annotate(
+            obert=FilteredRelation("prestec", condition=Q(prestec__data_retorn__isnull=True)),
+            reserva_id=_reserva("pk"),
+            reserva_usuari=_reserva("usuari__username"),
+            reserva_data=_reserva("data"),
+            reserva_expira=_reserva("expira"),
+            n_reserves=Subquery(n_reserves),
+        ).values(*columnes).order_by("pk")
+    return _plantilla_escaneig
+
+
+def escanejar(registre, centre=None, limit=2):
+    """
+    Exemplars amb aquest registre (al centre indicat, si cal), amb la forma
+    d'ExemplarOut més disponible, prestec, reserva (la que el té guardat) i
+    reserves (les actives del registre).
+    """
+    qs = _plantilla().filter(registre=registre)
+    if centre is not None:
+        qs = qs.filter(centre_id=centre)
+    resultat = []
+    for fila in qs[:limit]:
+        prestec = {camp: fila[columna] for camp, columna in PRESTEC_OBERT.items()}
+        resultat.append({
+            "exemplar": exemplar_dict(fila),
+            "disponible": not (fila["baixa"] or fila["exclos_prestec"] or prestec["id"] or fila["reserva_id"]),
+            "prestec": prestec if prestec["id"] else None,
+            "reserva": {
+                "id": fila["reserva_id"], "usuari": fila["reserva_usuari"], "data": fila["reserva_data"],
+                "expira": fila["reserva_expira"],
+            } if fila["reserva_id"] else None,
+            "reserves": fila["n_reserves"] or 0,
+        })
+    return resultat
@@ -0,0 +1,268 @@
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_save, post_delete, pre_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .models import (
+    Cataleg, Autor, Categoria, Editorial, Exemplar, Llengua, Pais, Prestec, Reserva, Centre, Usuari,
+    TokenAcces,
+)
+from . import cerca, autocompletar, disponibilitat, cache_api, facetes, tokens
+
+
+# Manteniment de l'índex de cerca
+#
+# post_save d'un subtipus (Llibre, Revista...) arriba amb sender=subtipus,
+# per això no es filtra per sender i es comprova la instància.
+
+@receiver(post_save)
+def indexar_cataleg(sender, instance, raw=False, **kwargs):
+    if raw or not isinstance(instance, Cataleg):
+        return
+    pk = instance.pk
+    transaction.on_commit(lambda: cerca.indexar([pk]))
+
+
+@receiver(post_delete)
+def desindexar_cataleg(sender, instance, **kwargs):
+    if not isinstance(instance, Cataleg):
+        return
+    pk = instance.pk
+    transaction.on_commit(lambda: cerca.desindexar([pk]))
+
+
+@receiver(post_save, sender=Autor)
+@receiver(post_save, sender=Editorial)
+def reindexar_per_nom(sender, instance, raw=False, created=False, **kwargs):
+    if raw or created:
+        return
+    ids = list(instance.cataleg_set.values_list("pk", flat=True))
+    transaction.on_commit(lambda: cerca.indexar(ids))
+
+
+@receiver(pre_delete, sender=Autor)
+@receiver(pre_delete, sender=Editorial)
+def recordar_cataleg(sender, instance, **kwargs):
+    # SET_NULL no llança post_save als catàlegs afectats
+    instance._cerca_ids = list(instance.cataleg_set.values_list("pk", flat=True))
+
+
+@receiver(post_delete, sender=Autor)
+@receiver(post_delete, sender=Editorial)
+def reindexar_sense_nom(sender, instance, **kwargs):
+    ids = getattr(instance, "_cerca_ids", [])
+    transaction.on_commit(lambda: cerca.indexar(ids))
+
+
+# Manteniment dels índexs d'autocompletat (autocompletar.py)
+
+# Els canvis s'apliquen en fer commit: un rollback no hi deixa entrades.
+
+def _index_autocompletar(instance):
+    if isinstance(instance, Cataleg):
+        return autocompletar.titols, instance.titol
+    if isinstance(instance, Autor):
+        return autocompletar.autors, instance.nom
+    if isinstance(instance, Editorial):
+        return autocompletar.editorials, instance.nom
+    return None, None
+
+
+@receiver(post_save)
+def autocompletar_desar(sender, instance, raw=False, **kwargs):
+    index, nom = _index_autocompletar(instance)
+    if raw or index is None:
+        return
+    pk = instance.pk
+    transaction.on_commit(lambda: index.actualitzar(pk, nom))
+
+
+@receiver(post_delete)
+def autocompletar_esborrar(sender, instance, **kwargs):
+    index, _ = _index_autocompletar(instance)
+    if index is None:
+        return
+    pk = instance.pk
+    transaction.on_commit(lambda: index.treure(pk))
+
+
+# Índex de facetes (facetes.py)
+
+@receiver(post_save)
+@receiver(post_delete)
+def facetes_cataleg(sender, instance, raw=False, created=False, **kwargs):
+    if raw:
+        return
+    if isinstance(instance, Cataleg):
+        pk = instance.pk
+        transaction.on_commit(lambda: facetes.index.actualitzar([pk]))
+    elif isinstance(instance, (Categoria, Llengua, Pais)) and not created:
+        # camins de categoria o valors que desapareixen: es reconstrueix
+        transaction.on_commit(facetes.invalidar)
+
+
+@receiver(post_delete, sender=Editorial)
+def facetes_sense_editorial(sender, instance, **kwargs):
+    # SET_NULL no llança post_save als catàlegs afectats (recordar_cataleg)
+    ids = getattr(instance, "_cerca_ids", [])
+    transaction.on_commit(lambda: facetes.index.actualitzar(ids))
+
+
+@receiver(m2m_changed, sender=Cataleg.tags.through)
+def facetes_tags(sender, instance, action, reverse, pk_set, **kwargs):
+    if not action.startswith("post_"):
+        return
+    if not reverse:
+        ids = [instance.pk]
+    elif pk_set is not None:
+        ids = list(pk_set)
+    else:
+        # categoria.cataleg_set.clear(): no se sap quins registres eren
+        transaction.on_commit(facetes.invalidar)
+        return
+    transaction.on_commit(lambda: facetes.index.actualitzar(ids))
+
+
+# Comptadors de disponibilitat (disponibilitat.py). Es recalculen dins la
+# mateixa transacció que l'escriptura que els ha canviat.
+
+@receiver(post_save, sender=Exemplar)
+@receiver(post_delete, sender=Exemplar)
+def disponibilitat_exemplar(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    original = getattr(instance, "_cataleg_original", None)
+    disponibilitat.recalcular([instance.cataleg_id, original])
+
+
+@receiver(post_save, sender=Prestec)
+@receiver(post_delete, sender=Prestec)
+def disponibilitat_moviment(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    disponibilitat.recalcular([disponibilitat.cataleg_de_exemplar(instance.exemplar_id)])
+
+
+@receiver(post_save, sender=Reserva)
+@receiver(post_delete, sender=Reserva)
+def disponibilitat_reserva(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    disponibilitat.recalcular([instance.cataleg_id])
+
+
+# Invalidació de la cache de respostes (cache_api.py)
+
+@receiver(post_save)
+@receiver(post_delete)
+def cache_cataleg(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    if isinstance(instance, Cataleg):
+        # el títol també surt a l'historial de préstecs i a l'escaneig
+        cache_api.invalidar_en_commit("llibres", "exemplars", "prestecs", "detalls", f"llibre:{instance.pk}")
+    elif isinstance(instance, Exemplar):
+        grups = {"llibres", "exemplars", f"llibre:{instance.cataleg_id}", f"registre:{instance.registre}"}
+        original = getattr(instance, "_cataleg_original", None)
+        if original:
+            grups.add(f"llibre:{original}")
+        registre_original = getattr(instance, "_registre_original", None)
+        if registre_original:
+            grups.add(f"registre:{registre_original}")
+        cache_api.invalidar_en_commit(*grups)
+    elif isinstance(instance, Prestec):
+        # canvien els comptadors de disponibilitat del catàleg i l'escaneig de l'exemplar
+        cataleg_id, registre = (
+            Exemplar.objects.filter(pk=instance.exemplar_id).values_list("cataleg_id", "registre").first()
+            or (None, None)
+        )
+        username = Usuari.objects.filter(pk=instance.usuari_id).values_list("username", flat=True).first()
+        cache_api.invalidar_en_commit(
+            "llibres", "exemplars", f"llibre:{cataleg_id}", f"registre:{registre}", f"prestecs:{username}",
+        )
+    elif isinstance(instance, Reserva):
+        # l'escaneig de qualsevol exemplar del registre mostra quantes reserves hi ha
+        registres = Exemplar.objects.filter(cataleg_id=instance.cataleg_id).values_list("registre", flat=True)
+        cache_api.invalidar_en_commit(
+            "llibres", "exemplars", "reserves", f"llibre:{instance.cataleg_id}",
+            *(f"registre:{registre}" for registre in registres),
+        )
+    elif isinstance(instance, (Autor, Editorial)):
+        cache_api.invalidar_en_commit("llibres", "exemplars", "detalls")
+    elif isinstance(instance, Centre):
+        cache_api.invalidar_en_commit("exemplars", "detalls")
+    elif isinstance(instance, Categoria):
+        # l'arbre i els filtres ?categoria= de /llibres
+        cache_api.invalidar_en_commit("categories", "llibres")
+
+
+@receiver(m2m_changed, sender=Cataleg.tags.through)
+def cache_tags(sender, instance, action, reverse, pk_set, **kwargs):
+    # ll.tags.add(cat) o cat.cataleg_set.add(ll) no passen per post_save
+    if not action.startswith("post_"):
+        return
+    grups = {"llibres", "categories"}
+    if not reverse:
+        grups.add(f"llibre:{instance.pk}")
+    elif pk_set is not None:
+        grups.update(f"llibre:{pk}" for pk in pk_set)
+    else:
+        # categoria.cataleg_set.clear(): no se sap quins registres eren
+        grups.add("detalls")
+    cache_api.invalidar_en_commit(*grups)
+
+
+# Validadors HTTP (cache_api.marca)
+#
+# L'ETag i el Last-Modified surten de Cataleg.updated_at, que ja canvia amb
+# els exemplars, préstecs i reserves (disponibilitat.recalcular). Els canvis
+# que es veuen a les respostes del catàleg sense desar el registre (tags,
+# noms d'autor, editorial, llengua, país o centre) el toquen aquí.
+
+def _tocar(catalegs):
+    catalegs.update(updated_at=timezone.now())
+
+
+@receiver(m2m_changed, sender=Cataleg.tags.through)
+def marca_tags(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == "pre_clear":
+        # després del clear() ja no se sap quins registres eren
+        _tocar(Cataleg.objects.filter(tags=instance) if reverse else Cataleg.objects.filter(pk=instance.pk))
+    elif action in ("post_add", "post_remove"):
+        _tocar(Cataleg.objects.filter(pk__in=pk_set) if reverse else Cataleg.objects.filter(pk=instance.pk))
+
+
+@receiver(post_save)
+@receiver(pre_delete)
+def marca_referencies(sender, instance, raw=False, created=False, **kwargs):
+    if raw or created:
+        return
+    if isinstance(instance, Autor):
+        _tocar(Cataleg.objects.filter(autor=instance))
+    elif isinstance(instance, Editorial):
+        _tocar(Cataleg.objects.filter(editorial=instance))
+    elif isinstance(instance, Llengua):
+        _tocar(Cataleg.objects.filter(llengua=instance))
+    elif isinstance(instance, Pais):
+        _tocar(Cataleg.objects.filter(pais=instance))
+    elif isinstance(instance, Centre):
+        _tocar(Cataleg.objects.filter(exemplar__centre=instance))
+
+
+# Tokens revocats o esborrats (p. ex. des de l'admin) surten de la cache
+
+@receiver(post_save, sender=TokenAcces)
+@receiver(post_delete, sender=TokenAcces)
+def token_canviat(sender, instance, **kwargs):
+    tokens.cache.esborrar([instance.hash])
+
+
+@receiver(post_save, sender=Usuari)
+def usuari_desactivat(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    if not instance.is_active:
+        tokens.revocar(usuari=instance)
+    else:
+        # is_staff i la resta de camps es tornen a llegir a la propera petició
+        tokens.oblidar_usuari(instance)
@@ -0,0 +1,36 @@
+// Omple el datalist dels widgets d'autor i editorial sota demanda
+// (vegeu LookupWidget a biblioteca/admin.py).
+(function () {
+    var temporitzadors = {};
+
+    function carrega(input) {
+        var datalist = document.getElementById(input.getAttribute('list'));
+        var q = input.value.trim();
+        if (!datalist) {
+            return;
+        }
+        if (q.length < 2) {
+            datalist.innerHTML = '';
+            return;
+        }
+        fetch(input.dataset.lookupUrl + '?q=' + encodeURIComponent(q), {credentials: 'same-origin'})
+            .then(function (resposta) { return resposta.json(); })
+            .then(function (dades) {
+                datalist.innerHTML = '';
+                (dades.results || []).forEach(function (item) {
+                    var opcio = document.createElement('option');
+                    opcio.value = item.nom;
+                    datalist.appendChild(opcio);
+                });
+            });
+    }
+
+    document.addEventListener('input', function (ev) {
+        var input = ev.target;
+        if (!input.dataset || !input.dataset.lookupUrl) {
+            return;
+        }
+        clearTimeout(temporitzadors[input.id]);
+        temporitzadors[input.id] = setTimeout(function () { carrega(input); }, 200);
+    });
+})();
@@ -0,0 +1,187 @@
+import logging
+import os
+import socket
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import F, Q
+from django.utils import timezone
+
+from . import importacio
+from .models import Tasca
+
+
+# Tasques en segon pla
+#
+# La cua és la taula Tasca: la petició hi desa una fila pendent (amb el
+# fitxer a Documento) i respon de seguida amb l'id. El worker
+# (manage.py executar_tasques) reclama les tasques pendents per ordre
+# d'arribada amb un UPDATE condicional sobre l'estat, de manera que dos
+# workers no poden agafar la mateixa tasca sense dependre de
+# SELECT ... FOR UPDATE SKIP LOCKED. Mentre s'executa, la tasca va desant
+# el progrés (files processades, creades, errors) perquè el client el pugui
+# consultar a /api/jobs/{id}.
+#
+# Cada desada de progrés renova el batec de la tasca. Si un worker cau a
+# mitja tasca, passat TASQUES_TERMINI sense batec un altre la torna a
+# reclamar i continua on ho havia deixat: les importacions desen el progrés
+# dins la transacció de cada lot, així que les files processades són
+# exactament les que ja són a la base de dades. A la TASQUES_MAX_INTENTS-ena
+# es dona per fallida. Totes les
+# escriptures del worker són condicionals al seu nom: si li han pres la
+# tasca, ho deixa córrer sense trepitjar el nou treballador. En acabar
+# s'esborra el fitxer pujat.
+
+logger = logging.getLogger(__name__)
+
+TIPUS = {}
+
+
+def tipus(nom):
+    """Registra la funció que executa les tasques d'aquest tipus."""
+    def registrar(funcio):
+        TIPUS[nom] = funcio
+        return funcio
+    return registrar
+
+
+def _continuant(tasca, progres):
+    """Suma al progrés de l'intent actual el que ja havien desat els anteriors."""
+    processades, creades, errors = tasca.processades, tasca.creades, list(tasca.errors)
+
+    def continuar(p, c, e):
+        progres(processades + p, creades + c, errors + e)
+    return continuar
+
+
+def _mida_lot():
+    # files per lot (i per desada de progrés); per defecte, les de cada importació
+    mida = getattr(settings, "TASQUES_MIDA_LOT", None)
+    return {"mida_lot": mida} if mida else {}
+
+
+@tipus("importar_usuaris")
+def _importar_usuaris(tasca, progres):
+    with tasca.document.archivo.open("rb") as fitxer:
+        importacio.importar_usuaris(
+            fitxer, progres=_continuant(tasca, progres), inici=tasca.processades, **_mida_lot(),
+        )
+
+
+@tipus("importar_cataleg")
+def _importar_cataleg(tasca, progres):
+    # les tasques encuades abans que Tasca tingués format el treuen del nom
+    format = tasca.format or importacio.format_de(tasca.document.archivo.name)
+    with tasca.document.archivo.open("rb") as fitxer:
+        importacio.importar_cataleg(
+            fitxer, format, progres=_continuant(tasca, progres), inici=tasca.processades, **_mida_lot(),
+        )
+
+
+class TascaPerduda(Exception):
+    """Un altre treballador ha reclamat la tasca (se'ns havia acabat el termini)."""
+
+
+def encuar(nom, document=None, usuari=None, format=""):
+    if nom not in TIPUS:
+        raise ValueError(f"Tipus de tasca desconegut: {nom}")
+    return Tasca.objects.create(tipus=nom, document=document, usuari=usuari, format=format)
+
+
+def nom_treballador():
+    return f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+
+
+def _reclamables(ara):
+    # pendents, o en curs d'un treballador que fa massa que no dona senyals
+    termini = timedelta(seconds=getattr(settings, "TASQUES_TERMINI", 300))
+    return Q(estat=Tasca.PENDENT) | Q(estat=Tasca.EN_CURS, batec__lt=ara - termini)
+
+
+def reclamar(treballador):
+    """Passa a en curs la tasca reclamable més antiga i la retorna, o None."""
+    while True:
+        ara = timezone.now()
+        pk = (
+            Tasca.objects.filter(_reclamables(ara))
+            .order_by("creat", "pk")
+            .values_list("pk", flat=True)
+            .first()
+        )
+        if pk is None:
+            return None
+        reclamada = Tasca.objects.filter(_reclamables(ara), pk=pk).update(
+            # el progrés de l'intent anterior es conserva: s'hi continua
+            estat=Tasca.EN_CURS, treballador=treballador, inici=ara, batec=ara, intents=F("intents") + 1,
+        )
+        if not reclamada:
+            # un altre worker se l'ha quedat: prova amb la següent
+            continue
+        tasca = Tasca.objects.select_related("document").get(pk=pk)
+        if tasca.intents <= getattr(settings, "TASQUES_MAX_INTENTS", 3):
+            return tasca
+        _acabar(tasca, Tasca.FALLIDA, f"S'ha interromput {tasca.intents - 1} vegades sense acabar")
+
+
+def _acabar(tasca, estat, missatge=""):
+    """Desa l'estat final i esborra el fitxer pujat. False si ja no és nostra."""
+    tasca.estat, tasca.missatge, tasca.fi = estat, missatge, timezone.now()
+    if not Tasca.objects.filter(pk=tasca.pk, treballador=tasca.treballador, estat=Tasca.EN_CURS).update(
+        estat=tasca.estat, missatge=tasca.missatge, fi=tasca.fi,
+    ):
+        return False
+    document = tasca.document
+    if document is not None:
+        document.archivo.delete(save=False)
+        document.delete()
+        tasca.document = None
+    return True
+
+
+def executar(tasca):
+    def progres(processades, creades, errors):
+        tasca.processades = processades
+        tasca.creades = creades
+        tasca.errors = errors
+        tasca.batec = timezone.now()
+        if not Tasca.objects.filter(pk=tasca.pk, treballador=tasca.treballador, estat=Tasca.EN_CURS).update(
+            processades=processades, creades=creades, errors=errors, batec=tasca.batec,
+        ):
+            raise TascaPerduda(tasca.pk)
+
+    try:
+        TIPUS[tasca.tipus](tasca, progres)
+    except TascaPerduda:
+        logger.warning("La tasca %s l'ha reclamada un altre treballador", tasca.pk)
+    except Exception as e:
+        logger.exception("La tasca %s ha fallat", tasca.pk)
+        _acabar(tasca, Tasca.FALLIDA, str(e))
+    else:
+        _acabar(tasca, Tasca.COMPLETADA)
+    return tasca
+
+
+def bucle(una_vegada=False, interval=1.0):
+    """
+    Executa tasques fins que no en queden (una_vegada) o indefinidament,
+    esperant interval segons quan la cua és buida. Retorna quantes n'ha fet.
+    """
+    treballador = nom_treballador()
+    fetes = 0
+    try:
+        while True:
+            tasca = reclamar(treballador)
+            if tasca is None:
+                if una_vegada:
+                    return fetes
+                time.sleep(interval)
+                continue
+            executar(tasca)
+            fetes += 1
+    finally:
+        # cada fil o procés té la seva connexió
+        if not connection.in_atomic_block:
+            connection.close()
@@ -1,3 +1,1766 @@
-from django.test import TestCase
+import contextlib
+import io
+import json
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from base64 import b64encode
+from datetime import date, timedelta
 
-# Create your tests here.
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import IntegrityError, connection, connections, transaction
+from django.db.migrations.executor import MigrationExecutor
+from django.db.models import F
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from unittest import mock, skipUnless
+
+from . import (
+    autocompletar, cache_api, cerca, disponibilitat, facetes, importacio, prestecs, reserves, tasques, tokens,
+    venciments,
+)
+from .models import (
+    Autor, Avis, Cataleg, Categoria, Centre, DisponibilitatCentre, Dispositiu, Documento, Editorial, Exemplar, Grup, Llengua, Llibre, PoliticaPrestec,
+    Prestec, Reserva, Revista, Tasca, TokenAcces, Usuari,
+)
+from .management.commands import generar_datos
+from .serialitzadors import filtrar_exemplars
+
+
+@skipUnless(connection.vendor == 'sqlite', "EXPLAIN QUERY PLAN de SQLite")
+class ExemplarIndexosTest(TestCase):
+    """Les consultes d'exemplars per centre fan servir els índexs compostos."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.centre = Centre.objects.create(nom="Centre")
+        cls.llibre = Llibre.objects.create(titol="Llibre")
+        Exemplar.objects.bulk_create([
+            Exemplar(cataleg=cls.llibre, centre=cls.centre, registre=str(i))
+            for i in range(20)
+        ])
+
+    def assertFaServirIndex(self, qs, index):
+        pla = qs.explain()
+        self.assertIn(index, pla)
+
+    def test_centre_disponible(self):
+        qs = filtrar_exemplars(centre=self.centre.pk, disponible=True)
+        self.assertFaServirIndex(qs, 'exemplar_centre_estat_idx')
+        self.assertFaServirIndex(qs, 'prestec_exemplar_retorn_idx')
+
+    def test_centre_estat(self):
+        qs = Exemplar.objects.filter(centre=self.centre, baixa=False, exclos_prestec=False)
+        self.assertFaServirIndex(qs, 'exemplar_centre_estat_idx')
+
+    def test_cataleg_centre(self):
+        qs = filtrar_exemplars(cataleg=self.llibre.pk, centre=self.centre.pk)
+        self.assertFaServirIndex(qs, 'exemplar_cataleg_centre_idx')
+
+    def test_api_filtres(self):
+        resposta = self.client.get('/api/exemplars', {
+            'centre': self.centre.pk, 'disponible': 'true', 'tipus': 'llibre', 'fields': 'id',
+        })
+        self.assertEqual(resposta.status_code, 200)
+        self.assertEqual(len(resposta.json()), 20)
+
+
+class TokenTest(TestCase):
+    """Tokens Bearer: reaprofitament, caducitat, revocació i cache amb TTL."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.usuari = Usuari.objects.create_user(username="lector", password="secret")
+
+    def setUp(self):
+        tokens.credencials.buidar()
+
+    def demanar_token(self, password="secret"):
+        return self.client.get(
+            '/api/token', HTTP_AUTHORIZATION='Basic ' + b64encode(f"lector:{password}".encode()).decode()
+        )
+
+    def test_reaprofita_token(self):
+        primer = self.demanar_token().json()
+        with self.assertNumQueries(2):
+            segon = self.demanar_token().json()
+        self.assertEqual(primer, segon)
+        self.assertEqual(TokenAcces.objects.filter(usuari=self.usuari).count(), 1)
+        self.assertEqual(tokens.resoldre(primer["token"]), self.usuari)
+
+    def test_rota_a_prop_de_caducar(self):
+        primer = self.demanar_token().json()["token"]
+        TokenAcces.objects.update(expira=timezone.now() + timedelta(minutes=5))
+        segon = self.demanar_token().json()["token"]
+        self.assertNotEqual(primer, segon)
+        self.assertEqual(TokenAcces.objects.filter(usuari=self.usuari).count(), 1)
+        self.assertIsNone(tokens.resoldre(primer))
+
+    def test_canvi_de_contrasenya(self):
+        self.assertEqual(self.demanar_token().status_code, 200)
+        self.usuari.set_password("nova")
+        self.usuari.save()
+        self.assertEqual(self.demanar_token().status_code, 401)
+
+    def reserves(self, token):
+        return self.client.get('/api/reserves', HTTP_AUTHORIZATION=f'Bearer {token}').status_code
+
+    def test_nomes_es_guarda_el_hash(self):
+        token = self.demanar_token().json()["token"]
+        fila = TokenAcces.objects.get()
+        self.assertNotEqual(fila.hash, token)
+        self.assertEqual(fila.hash, tokens.hash_token(token))
+        self.assertFalse(TokenAcces.objects.filter(hash=token).exists())
+
+    def test_caducat(self):
+        token = self.demanar_token().json()["token"]
+        self.assertEqual(self.reserves(token), 200)
+        TokenAcces.objects.update(expira=timezone.now() - timedelta(seconds=1))
+        # update() no passa pels signals: la cache encara el recorda fins al TTL
+        self.assertEqual(self.reserves(token), 200)
+        tokens.cache.buidar()
+        self.assertEqual(self.reserves(token), 401)
+
+    @override_settings(API_TOKEN_CACHE_TTL=60)
+    def test_la_cache_no_allarga_la_vida(self):
+        token = self.demanar_token().json()["token"]
+        TokenAcces.objects.update(expira=timezone.now() + timedelta(seconds=1))
+        tokens.cache.buidar()
+        self.assertEqual(tokens.resoldre(token), self.usuari)
+        with self.assertNumQueries(0):
+            self.assertEqual(tokens.resoldre(token), self.usuari)
+        time.sleep(1.1)
+        self.assertIsNone(tokens.resoldre(token))
+
+    def test_revocar(self):
+        token = self.demanar_token().json()["token"]
+        self.assertEqual(self.reserves(token), 200)
+        resposta = self.client.post('/api/token/revocar', HTTP_AUTHORIZATION=f'Bearer {token}')
+        self.assertEqual(resposta.status_code, 200)
+        self.assertEqual(self.reserves(token), 401)
+        # el següent /token no reaprofita el revocat
+        nou = self.demanar_token().json()["token"]
+        self.assertNotEqual(nou, token)
+        self.assertEqual(self.reserves(nou), 200)
+
+    def test_desar_o_esborrar_la_fila_invalida_la_cache(self):
+        token = self.demanar_token().json()["token"]
+        self.assertEqual(tokens.resoldre(token), self.usuari)
+        fila = TokenAcces.objects.get()
+        fila.revocat = True
+        fila.save()
+        self.assertIsNone(tokens.resoldre(token))
+
+        token = self.demanar_token().json()["token"]
+        self.assertEqual(tokens.resoldre(token), self.usuari)
+        TokenAcces.objects.get(revocat=False).delete()
+        self.assertIsNone(tokens.resoldre(token))
+
+    def test_usuari_desactivat(self):
+        token = self.demanar_token().json()["token"]
+        self.assertEqual(tokens.resoldre(token), self.usuari)
+        self.usuari.is_active = False
+        self.usuari.save()
+        self.assertIsNone(tokens.resoldre(token))
+
+    def test_canvis_de_l_usuari(self):
+        token = self.demanar_token().json()["token"]
+        primer = tokens.resoldre(token)
+        self.assertFalse(primer.is_staff)
+        # cada petició té la seva instància
+        primer.is_staff = True
+        self.assertFalse(tokens.resoldre(token).is_staff)
+        self.assertIsNot(tokens.resoldre(token), tokens.resoldre(token))
+        self.usuari.is_staff = True
+        self.usuari.save()
+        self.assertTrue(tokens.resoldre(token).is_staff)
+
+
+class ImportacioUsuarisTest(TestCase):
+    """Importació massiva d'usuaris per /api/subir-documento/."""
+
+    CAPCALERA = "nom,cognom1,cognom2,email,telefon,centre,grup\n"
+
+    def pujar(self, files):
+        fitxer = SimpleUploadedFile("usuaris.csv", (self.CAPCALERA + files).encode())
+        return self.client.post('/api/subir-documento/', {'archivo': fitxer})
+
+    def test_importa_i_descarta(self):
+        Usuari.objects.create_user(username="ja@existeix.cat", password="x")
+        resposta = self.pujar(
+            "Anna,Puig,Vila,Anna@Exemple.cat,600000000,Centre A,1r\n"
+            "Pere,Puig,Vila,pere@exemple.cat,600000001,Centre B,1r\n"
+            "Pere,Puig,Vila,pere@exemple.cat,600000001,Centre B,1r\n"
+            "Joan,Puig,Vila,ja@existeix.cat,600000002,Centre A,1r\n"
+            "Marta,Puig,Vila,marta@exemple.cat,123,Centre A,1r\n"
+        )
+        self.assertEqual(resposta.status_code, 200)
+        dades = resposta.json()
+        self.assertEqual(dades["usuarios_creados"], 2)
+        self.assertEqual(len(dades["errores"]), 3)
+
+        anna = Usuari.objects.get(username="anna@exemple.cat")
+        self.assertEqual(anna.centre.nom, "Centre A")
+        self.assertTrue(anna.check_password("1234"))
+        self.assertTrue(anna.groups.filter(name="usuari").exists())
+        self.assertEqual(Centre.objects.count(), 2)
+        self.assertEqual(Grup.objects.count(), 1)
+
+    @override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+    def test_asincron(self):
+        fitxer = SimpleUploadedFile(
+            "usuaris.csv",
+            (self.CAPCALERA + "Anna,Puig,Vila,anna@exemple.cat,600000000,Centre A,1r\n"
+             "Pere,Puig,Vila,pere,600000001,Centre A,1r\n").encode(),
+        )
+        url = '/api/subir-documento/?asincron=true'
+        self.assertEqual(self.client.post(url, {'archivo': fitxer}).status_code, 401)
+        fitxer.seek(0)
+        personal = Usuari.objects.create_user(username="personal", password="x")
+        bearer = {"HTTP_AUTHORIZATION": f"Bearer {tokens.emetre(personal)}"}
+        resposta = self.client.post(url, {'archivo': fitxer}, **bearer)
+        self.assertEqual(resposta.status_code, 202)
+        job = resposta.json()["job"]
+        self.assertEqual(self.client.get(f'/api/jobs/{job}', **bearer).json()["estat"], Tasca.PENDENT)
+        document = Tasca.objects.get(pk=job).document
+        self.assertTrue(document.archivo.storage.exists(document.archivo.name))
+
+        self.assertEqual(tasques.bucle(una_vegada=True), 1)
+        dades = self.client.get(f'/api/jobs/{job}', **bearer).json()
+        self.assertEqual(dades["estat"], Tasca.COMPLETADA)
+        self.assertEqual((dades["processades"], dades["creades"]), (2, 1))
+        self.assertEqual(dades["errors"][0]["error"], "Email vacío o inválido")
+        self.assertTrue(Usuari.objects.filter(username="anna@exemple.cat").exists())
+        # el fitxer pujat no es queda al servidor
+        self.assertFalse(Documento.objects.exists())
+        self.assertFalse(document.archivo.storage.exists(document.archivo.name))
+
+        # els errors porten dades personals: només els veu qui ha encuat la tasca
+        self.assertEqual(self.client.get(f'/api/jobs/{job}').status_code, 401)
+        altre = Usuari.objects.create_user(username="altre", password="x")
+        resposta = self.client.get(f'/api/jobs/{job}', HTTP_AUTHORIZATION=f"Bearer {tokens.emetre(altre)}")
+        self.assertEqual(resposta.status_code, 404)
+
+
+def registre_marc(lider_tipus, control, camps):
+    """Registre MARC21 (ISO 2709) mínim per a les proves."""
+    directori, dades = b"", b""
+    for etiqueta, valor in [("008", control)] + camps:
+        if isinstance(valor, dict):
+            valor = "  " + "".join(f"\x1f{codi}{text}" for codi, text in valor.items())
+        camp = valor.encode() + b"\x1e"
+        directori += f"{etiqueta}{len(camp):04d}{len(dades):05d}".encode()
+        dades += camp
+    base = 24 + len(directori) + 1
+    llargada = base + len(dades) + 1
+    lider = f"{llargada:05d}n{lider_tipus} a22{base:05d}   4500".encode()
+    return lider + directori + b"\x1e" + dades + b"\x1d"
+
+
+class ImportacioCatalegTest(TestCase):
+    """importar_cataleg: formats, resolució de noms i duplicats."""
+
+    def test_csv(self):
+        Llibre.objects.create(titol="Ja hi és", ISBN="9788412345678")
+        autor = Autor.objects.create(nom="Mercè Rodoreda")
+        fitxer = io.BytesIO(
+            "titol,autor,editorial,ISBN,ISSN,data_edicio,tags\n"
+            "La plaça del Diamant,Mercè Rodoreda,Club Editor,978-84-12345-67-8,,1962,Novel·la\n"
+            "Mirall trencat,Mercè Rodoreda,Club Editor,9788473291002,,1974,Novel·la|Clàssics\n"
+            "Mirall trencat,Mercè Rodoreda,Club Editor,978-84-7329-100-2,,1974,\n"
+            "Sàpiens,,,,1695-2235,2020-05-01,\n"
+            ",Sense títol,,,,,\n".encode()
+        )
+        resum = importacio.importar_cataleg(fitxer, "csv")
+        self.assertEqual((resum["llegides"], resum["creades"], resum["duplicades"]), (5, 2, 2))
+        self.assertEqual(resum["errors"], [{"fila": 5, "error": "Falta el títol"}])
+
+        llibre = Llibre.objects.get(ISBN="9788473291002")
+        self.assertEqual(llibre.autor, autor)
+        self.assertEqual(llibre.editorial.nom, "Club Editor")
+        self.assertEqual(llibre.data_edicio.year, 1974)
+        self.assertEqual(sorted(llibre.tags.values_list("nom", flat=True)), ["Clàssics", "Novel·la"])
+        self.assertEqual(Editorial.objects.count(), 1)
+        self.assertEqual(Revista.objects.get().ISSN, "16952235")
+        self.assertEqual(cerca.cercar("mirall"), [llibre.pk])
+
+    def test_marc(self):
+        control = "000000s1962    sp            000 0 cat d"
+        fitxer = io.BytesIO(
+            registre_marc("am", control, [
+                ("020", {"a": "9788473291002 (rústica)"}),
+                ("100", {"a": "Rodoreda, Mercè,"}),
+                ("245", {"a": "La plaça del Diamant /", "c": "Mercè Rodoreda."}),
+                ("264", {"a": "Barcelona :", "b": "Club Editor,", "c": "1962."}),
+                ("300", {"a": "253 p. ;"}),
+                ("650", {"a": "Novel·la catalana."}),
+            ])
+            + registre_marc("as", control, [
+                ("022", {"a": "1695-2235"}),
+                ("245", {"a": "Sàpiens."}),
+            ])
+        )
+        resum = importacio.importar_cataleg(fitxer, "marc")
+        self.assertEqual(resum["creades"], 2)
+        llibre = Llibre.objects.get()
+        self.assertEqual(
+            (llibre.titol, llibre.ISBN, llibre.autor.nom, llibre.lloc, llibre.pagines),
+            ("La plaça del Diamant", "9788473291002", "Rodoreda, Mercè", "Barcelona", 253),
+        )
+        self.assertEqual((llibre.pais.nom, llibre.llengua.nom), ("España", "Catalán"))
+        self.assertEqual(Revista.objects.get().titol, "Sàpiens")
+
+    def test_tornar_a_pujar(self):
+        dades = (
+            "titol,autor,data_edicio,ISBN,tipus\n"
+            "Canigó,Jacint Verdaguer,1886,,\n"
+            "Canigó,Jacint Verdaguer,1901,,\n"
+            "L'Atlàntida,Jacint Verdaguer,1877,9788400000002,\n"
+            "Sàpiens,,2020,,revista\n"
+            "Canigó,Jacint Verdaguer,1886,,\n".encode()
+        )
+        resum = importacio.importar_cataleg(io.BytesIO(dades), "csv")
+        self.assertEqual((resum["creades"], resum["duplicades"]), (4, 1))
+        self.assertEqual(resum["omeses"], [
+            {"fila": 5, "motiu": "Ja hi ha un registre amb el mateix títol, autor i data d'edició"},
+        ])
+
+        # el mateix fitxer una altra vegada (o una tasca que es torna a executar)
+        resum = importacio.importar_cataleg(io.BytesIO(dades), "csv")
+        self.assertEqual((resum["creades"], resum["duplicades"]), (0, 5))
+        self.assertEqual([o["fila"] for o in resum["omeses"]], [1, 2, 3, 4, 5])
+        self.assertEqual(resum["omeses"][2]["motiu"], "ISBN 9788400000002 repetit")
+        self.assertEqual(Cataleg.objects.count(), 4)
+
+    def test_bulk_create_mti_sense_pks_retornades(self):
+        # com MySQL: bulk_create no omple les pk dels pares
+        Revista.objects.create(titol="Anterior")
+        llibres = [Llibre(titol=f"Llibre {i}", ISBN=f"97884000000{i:02d}") for i in range(5)]
+        with mock.patch.object(type(connection.features), "can_return_rows_from_bulk_insert", False):
+            importacio.bulk_create_mti(Llibre, llibres)
+        self.assertNotIn(None, [llibre.pk for llibre in llibres])
+        self.assertEqual(
+            [(ll.pk, ll.titol, ll.ISBN) for ll in llibres],
+            list(Llibre.objects.order_by("pk").values_list("pk", "titol", "ISBN")),
+        )
+        self.assertEqual(Cataleg.objects.count(), 6)
+
+    def test_asincron_fa_servir_el_format_demanat(self):
+        personal = Usuari.objects.create_user(username="personal", password="x", is_staff=True)
+        bearer = {"HTTP_AUTHORIZATION": f"Bearer {tokens.emetre(personal)}"}
+        # el nom no diu el format: només el sap ?format=
+        fitxer = SimpleUploadedFile("exportacio.txt", "titol,ISBN\nCanigó,9788400000001\n".encode())
+        resposta = self.client.post('/api/cataleg/importar?format=csv&asincron=true', {'archivo': fitxer}, **bearer)
+        self.assertEqual(resposta.status_code, 202)
+        self.assertEqual(Tasca.objects.get().format, "csv")
+        self.assertEqual(tasques.bucle(una_vegada=True), 1)
+        self.assertEqual(Tasca.objects.values_list("estat", "creades").get(), (Tasca.COMPLETADA, 1))
+        self.assertTrue(Llibre.objects.filter(titol="Canigó").exists())
+
+
+class CategoriaArbreTest(TestCase):
+    """Camí materialitzat de Categoria: moviments de subarbres i filtres."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.ficcio = Categoria.objects.create(nom="Ficció")
+        cls.novella = Categoria.objects.create(nom="Novel·la", parent=cls.ficcio)
+        cls.negra = Categoria.objects.create(nom="Novel·la negra", parent=cls.novella)
+        cls.assaig = Categoria.objects.create(nom="Assaig")
+        cls.llibre = Llibre.objects.create(titol="Crim")
+        cls.llibre.tags.add(cls.negra)
+        Llibre.objects.create(titol="Sense categoria")
+
+    def setUp(self):
+        # les dades de cada prova es desfan, la cache de respostes no
+        cache_api.invalidar("llibres", "categories")
+
+    def test_moure_subarbre(self):
+        self.novella.parent = self.assaig
+        self.novella.save()
+        self.negra.refresh_from_db()
+        self.assertEqual(self.negra.nivell, 2)
+        self.assertTrue(self.negra.cami.startswith(self.assaig.cami))
+        self.assertEqual(
+            list(Categoria.objects.subarbre(self.assaig).order_by("cami")),
+            [self.assaig, self.novella, self.negra],
+        )
+        self.assertEqual(list(Categoria.objects.subarbre(self.ficcio)), [self.ficcio])
+
+        self.assaig.parent = self.negra
+        with self.assertRaises(ValueError):
+            self.assaig.save()
+
+    def test_api(self):
+        # una per l'ETag (cache_api.marca) i una per l'arbre
+        with self.assertNumQueries(2):
+            arbre = self.client.get("/api/categories").json()
+        self.assertEqual([c["nom"] for c in arbre], ["Ficció", "Assaig"])
+        self.assertEqual(arbre[0]["fills"][0]["fills"][0]["nom"], "Novel·la negra")
+
+        titols = lambda categoria: [
+            l["titol"] for l in self.client.get(f"/api/llibres?categoria={categoria.pk}").json()
+        ]
+        self.assertEqual(titols(self.ficcio), ["Crim"])
+        self.assertEqual(titols(self.assaig), [])
+        self.assertEqual(self.client.get("/api/llibres?categoria=999").status_code, 404)
+
+
+class FacetesTest(TestCase):
+    """Recomptes de facetes des de l'índex en memòria i manteniment per signals."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.catala = Llengua.objects.create(nom="Català")
+        cls.angles = Llengua.objects.create(nom="Anglès")
+        cls.ficcio = Categoria.objects.create(nom="Ficció")
+        cls.novella = Categoria.objects.create(nom="Novel·la", parent=cls.ficcio)
+        cls.llibre = Llibre.objects.create(titol="Mirall trencat", llengua=cls.catala, data_edicio="1974-01-01")
+        cls.llibre.tags.add(cls.novella)
+        Llibre.objects.create(titol="Solitud", llengua=cls.catala, data_edicio="1905-01-01")
+        Revista.objects.create(titol="Sàpiens", llengua=cls.catala)
+        Llibre.objects.create(titol="Ulysses", llengua=cls.angles)
+        cerca.reindexar_tot()
+
+    def setUp(self):
+        facetes.invalidar()
+
+    def recomptes(self, url="/api/cataleg/facets", **params):
+        dades = self.client.get(url, params).json()
+        return dades["total"], {
+            faceta: {v["nom"]: v["n"] for v in valors} for faceta, valors in dades["facetes"].items()
+        }
+
+    def test_recomptes(self):
+        total, recomptes = self.recomptes()
+        self.assertEqual(total, 4)
+        self.assertEqual(recomptes["llengua"], {"Català": 3, "Anglès": 1})
+        self.assertEqual(recomptes["tipus"], {"llibre": 3, "revista": 1})
+        self.assertEqual(recomptes["categoria"], {"Ficció": 1, "Novel·la": 1})
+        self.assertEqual(recomptes["decada"], {"1900s": 1, "1970s": 1})
+
+        # la faceta filtrada es compta sense el seu propi filtre
+        total, recomptes = self.recomptes(llengua=self.catala.pk, tipus="llibre")
+        self.assertEqual(total, 2)
+        self.assertEqual(recomptes["llengua"], {"Català": 2, "Anglès": 1})
+        self.assertEqual(recomptes["tipus"], {"llibre": 2, "revista": 1})
+
+        total, _ = self.recomptes(categoria=self.ficcio.pk, search="mirall")
+        self.assertEqual(total, 1)
+
+    def test_signals(self):
+        self.recomptes()
+        with self.captureOnCommitCallbacks(execute=True):
+            nou = Llibre.objects.create(titol="Ara", llengua=self.angles)
+            nou.tags.add(self.ficcio)
+            self.llibre.llengua = self.angles
+            self.llibre.save()
+
+        # sense reconstruir l'índex: l'ETag (catàleg i categories) i els noms
+        # de llengües i categories
+        with self.assertNumQueries(4):
+            total, recomptes = self.recomptes()
+        self.assertEqual(total, 5)
+        self.assertEqual(recomptes["llengua"], {"Català": 2, "Anglès": 3})
+        self.assertEqual(recomptes["categoria"], {"Ficció": 2, "Novel·la": 1})
+
+    def test_altre_proces(self):
+        # un altre procés amb la seva còpia de l'índex
+        altre = facetes.IndexFacetes()
+        self.assertEqual(altre.comptar({})[0], 4)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.llibre.llengua = self.angles
+            self.llibre.save()
+            # un pk llunyà no fa créixer la memòria de cada valor
+            Llibre.objects.create(pk=2 ** 30, titol="Lluny", llengua=self.angles)
+
+        with mock.patch.object(altre, "_reconstruir", wraps=altre._reconstruir) as reconstruir:
+            total, recomptes = altre.comptar({"llengua": self.angles.pk})
+            reconstruir.assert_not_called()
+        self.assertEqual(total, 3)
+        self.assertEqual(dict(recomptes["llengua"]), {self.catala.pk: 2, self.angles.pk: 3})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Llibre.objects.filter(pk=2 ** 30).delete()
+        with mock.patch.object(altre, "_reconstruir", wraps=altre._reconstruir) as reconstruir:
+            self.assertEqual(altre.comptar({})[0], 4)
+            reconstruir.assert_not_called()
+
+    def test_bitsets_i_conjunts(self):
+        # el resultat no depèn de si cada valor és un bitset o un frozenset
+        consultes = [
+            ({}, None),
+            ({"llengua": self.catala.pk}, None),
+            ({"llengua": self.catala.pk, "tipus": "llibre"}, None),
+            ({"categoria": self.ficcio.pk}, None),
+            ({"llengua": self.angles.pk}, [self.llibre.pk, 10 ** 9]),
+        ]
+
+        def comptar(index):
+            return [index.comptar(filtres, ids) for filtres, ids in consultes]
+
+        esperat = comptar(facetes.IndexFacetes())
+        indexos = {}
+        for dens in (2, 10 ** 6):
+            with mock.patch.object(facetes, "DENS", dens):
+                indexos[dens] = facetes.IndexFacetes()
+                self.assertEqual(comptar(indexos[dens]), esperat)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.llibre.llengua = self.angles
+            self.llibre.save()
+            Revista.objects.create(titol="Time", llengua=self.angles)
+        esperat = comptar(facetes.IndexFacetes())
+        for dens, index in indexos.items():
+            with mock.patch.object(facetes, "DENS", dens), \
+                    mock.patch.object(index, "_reconstruir", wraps=index._reconstruir) as reconstruir:
+                self.assertEqual(comptar(index), esperat)
+                reconstruir.assert_not_called()
+
+    def test_reconstrueix_si_cal(self):
+        altre = facetes.IndexFacetes()
+        altre.comptar({})
+        with self.captureOnCommitCallbacks(execute=True):
+            self.llibre.llengua = self.angles
+            self.llibre.save()
+        # el canvi ha sortit de la cache: no es pot aplicar sol
+        cache_api._cache().delete(facetes._clau_canvi(facetes._seq()))
+        with mock.patch.object(altre, "_reconstruir", wraps=altre._reconstruir) as reconstruir:
+            self.assertEqual(dict(altre.comptar({})[1]["llengua"]), {self.catala.pk: 2, self.angles.pk: 2})
+            reconstruir.assert_called_once()
+
+        # passat FACETES_TTL, encara que no hi hagi canvis
+        with override_settings(FACETES_TTL=60), \
+                mock.patch.object(altre, "_reconstruir", wraps=altre._reconstruir) as reconstruir:
+            altre.comptar({})
+            reconstruir.assert_not_called()
+            altre._construit -= 61
+            altre.comptar({})
+            reconstruir.assert_called_once()
+
+
+class HistorialPrestecsTest(TestCase):
+    """/api/prestecs: consultes constants, filtres d'estat i paginació per cursor."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.usuari = Usuari.objects.create_user(username="lectora", password="x")
+        centre = Centre.objects.create(nom="Centre")
+        llibre = Llibre.objects.create(titol="Llibre")
+        exemplars = Exemplar.objects.bulk_create([
+            Exemplar(cataleg=llibre, centre=centre, registre=str(i)) for i in range(30)
+        ])
+        prestecs = Prestec.objects.bulk_create([
+            Prestec(usuari=cls.usuari, exemplar=exemplar) for exemplar in exemplars
+        ])
+        # data_prestec és auto_now_add: es reparteixen en 10 dies
+        for i, prestec in enumerate(prestecs):
+            Prestec.objects.filter(pk=prestec.pk).update(
+                data_prestec=timezone.localdate() - timedelta(days=i % 10),
+                data_retorn=timezone.localdate() if i % 3 else None,
+            )
+
+    def test_consultes_constants(self):
+        for limit in (3, 30):
+            # dues per l'ETag (cache_api.marca) i una per la pàgina
+            with self.assertNumQueries(3):
+                resposta = self.client.get("/api/prestecs", {"username": "lectora", "limit": limit})
+            self.assertEqual(len(resposta.json()["results"]), limit)
+        with self.assertNumQueries(3):
+            files = self.client.get("/api/prestecs", {"username": "lectora"}).json()
+        self.assertEqual(len(files), 30)
+        self.assertEqual(files[0]["exemplar_titol"], "Llibre")
+
+    def test_cursor_i_estat(self):
+        vistos, cursor = [], None
+        while True:
+            params = {"username": "lectora", "limit": 7, "estat": "actius"}
+            if cursor:
+                params["cursor"] = cursor
+            pagina = self.client.get("/api/prestecs", params).json()
+            vistos += pagina["results"]
+            cursor = pagina["next"]
+            if not cursor:
+                break
+        self.assertEqual(len(vistos), 10)
+        self.assertTrue(all(p["data_retorn"] is None for p in vistos))
+        ordre = [(p["data_prestec"], p["id"]) for p in vistos]
+        self.assertEqual(ordre, sorted(ordre, reverse=True))
+        self.assertEqual(
+            self.client.get("/api/prestecs", {"username": "lectora", "estat": "perduts"}).status_code, 400,
+        )
+
+
+@override_settings(PRESTECS_REINTENTS=50)
+class PrestecsConcurrentsTest(TransactionTestCase):
+    """Préstecs simultanis del mateix exemplar: només un pot guanyar."""
+
+    def setUp(self):
+        centre = Centre.objects.create(nom="Centre")
+        llibre = Llibre.objects.create(titol="Llibre")
+        self.exemplar = Exemplar.objects.create(cataleg=llibre, centre=centre, registre="1")
+        self.usuaris = [
+            Usuari.objects.create_user(username=f"u{i}", password="x") for i in range(8)
+        ]
+
+    def prestar(self, usuari):
+        try:
+            prestecs.prestar(usuari.pk, self.exemplar.pk)
+            return "prestat"
+        except prestecs.NoDisponible:
+            return "no disponible"
+        finally:
+            connections.close_all()
+
+    def test_sense_prestecs_dobles(self):
+        for ronda in range(3):
+            with ThreadPoolExecutor(max_workers=len(self.usuaris)) as pool:
+                resultats = list(pool.map(self.prestar, self.usuaris))
+            self.assertEqual(resultats.count("prestat"), 1)
+            self.assertEqual(resultats.count("no disponible"), len(self.usuaris) - 1)
+            self.assertEqual(Prestec.objects.filter(data_retorn__isnull=True).count(), 1)
+            prestecs.retornar(self.exemplar.pk)
+
+        self.assertEqual(Prestec.objects.count(), 3)
+        with self.assertRaises(prestecs.PrestecError):
+            prestecs.retornar(self.exemplar.pk)
+        comptadors = Llibre.objects.values_list("comptador_disponibles", "comptador_prestec").get()
+        self.assertEqual(comptadors, (1, 0))
+
+    def test_api(self):
+        resposta = self.client.post(
+            "/api/crear_prestec", {"usuari": self.usuaris[0].pk, "exemplar": self.exemplar.pk},
+            content_type="application/json",
+        )
+        self.assertEqual(resposta.status_code, 200)
+        resposta = self.client.post(
+            "/api/crear_prestec", {"usuari": self.usuaris[1].pk, "exemplar": self.exemplar.pk},
+            content_type="application/json",
+        )
+        self.assertEqual(resposta.status_code, 409)
+        resposta = self.client.post(
+            "/api/retornar_prestec", {"exemplar": self.exemplar.pk}, content_type="application/json",
+        )
+        self.assertEqual(resposta.status_code, 200)
+
+
+class PrestecsLotTest(TestCase):
+    """/api/prestecs/batch: validació en bloc i resultat per element."""
+
+    @classmethod
+    def setUpTestData(cls):
+        centre = Centre.objects.create(nom="Centre")
+        cls.llibre = Llibre.objects.create(titol="Llibre")
+        cls.exemplars = Exemplar.objects.bulk_create([
+            Exemplar(cataleg=cls.llibre, centre=centre, registre=f"R{i}", baixa=(i == 4)) for i in range(30)
+        ])
+        cls.usuari = Usuari.objects.create_user(username="lectora", password="x")
+
+    def post(self, url, dades):
+        return self.client.post(url, dades, content_type="application/json").json()
+
+    def test_prestar_i_retornar(self):
+        Prestec.objects.create(usuari=self.usuari, exemplar=self.exemplars[3])
+        elements = [{"usuari": self.usuari.pk, "exemplar": e.pk} for e in self.exemplars[:3]] + [
+            {"usuari": self.usuari.pk, "registre": "R3"},
+            {"usuari": self.usuari.pk, "registre": "R4"},
+            {"usuari": self.usuari.pk, "registre": "R5"},
+            {"usuari": self.usuari.pk, "registre": "R5"},
+            {"usuari": self.usuari.pk, "registre": "no-hi-és"},
+            {"usuari": 999, "exemplar": self.exemplars[6].pk},
+        ]
+        resposta = self.post("/api/prestecs/batch", {"prestecs": elements})
+        self.assertEqual((resposta["fets"], resposta["errors"]), (4, 5))
+        self.assertEqual(
+            [r["error"] for r in resposta["results"][3:]],
+            [
+                "L'exemplar ja està en préstec", "L'exemplar no es pot prestar", None,
+                "L'exemplar ja està en préstec", "Exemplar no trobat", "Usuari no trobat",
+            ],
+        )
+        self.assertEqual(Prestec.objects.filter(data_retorn__isnull=True).count(), 5)
+        self.assertEqual(Llibre.objects.get().comptador_prestec, 5)
+
+        resposta = self.post("/api/prestecs/batch/retorn", {
+            "retorns": [{"registre": "R0"}, {"exemplar": self.exemplars[3].pk}, {"registre": "R7"}],
+        })
+        self.assertEqual([r["ok"] for r in resposta["results"]], [True, True, False])
+        self.assertEqual(Llibre.objects.get().comptador_prestec, 3)
+
+    def test_consultes_per_lot(self):
+        # el nombre de consultes no depèn de la mida del lot
+        consultes = []
+        for exemplars in (self.exemplars[5:6], self.exemplars[6:8], self.exemplars[10:30]):
+            elements = [{"usuari": self.usuari.pk, "registre": e.registre} for e in exemplars]
+            with CaptureQueriesContext(connection) as capturades:
+                resposta = self.post("/api/prestecs/batch", {"prestecs": elements})
+            self.assertEqual(resposta["fets"], len(exemplars))
+            consultes.append(len(capturades))
+        # el primer lot crea la fila de DisponibilitatCentre; els altres la substitueixen
+        self.assertEqual(consultes[1], consultes[2])
+
+
+class EscaneigRegistreTest(TestCase):
+    """/api/exemplars/by-registre: una consulta, cache calenta i invalidació."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.centre = Centre.objects.create(nom="Centre")
+        cls.llibre = Llibre.objects.create(titol="Llibre")
+        cls.exemplar = Exemplar.objects.create(cataleg=cls.llibre, centre=cls.centre, registre="REG-1")
+        cls.lectora = Usuari.objects.create_user(username="lectora", password="x")
+        cls.lector = Usuari.objects.create_user(username="lector", password="x")
+
+    def setUp(self):
+        # les dades de cada prova es desfan, la cache de respostes no
+        cache_api.invalidar("registre:REG-1")
+
+    def test_escaneig(self):
+        # l'exemplar és lliure: la reserva el guarda de seguida
+        prestecs.reservar(self.lector.pk, self.llibre.pk)
+        # dues per l'ETag (cache_api.marca) i una per l'escaneig
+        with self.assertNumQueries(3):
+            dades = self.client.get("/api/exemplars/by-registre/REG-1").json()
+        self.assertEqual(dades["exemplar"]["cataleg"]["titol"], "Llibre")
+        self.assertEqual((dades["disponible"], dades["prestec"], dades["reserves"]), (False, None, 1))
+        self.assertEqual(dades["reserva"]["usuari"], "lector")
+        with self.assertNumQueries(0):
+            self.client.get("/api/exemplars/by-registre/REG-1")
+
+        # el préstec a qui l'ha reservat tanca la reserva i invalida la resposta guardada
+        with self.captureOnCommitCallbacks(execute=True):
+            prestecs.prestar(self.lector.pk, self.exemplar.pk)
+        dades = self.client.get("/api/exemplars/by-registre/REG-1").json()
+        self.assertEqual((dades["disponible"], dades["reserva"], dades["reserves"]), (False, None, 0))
+        self.assertEqual(dades["prestec"]["usuari"], "lector")
+
+    def test_unic_per_centre(self):
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Exemplar.objects.create(cataleg=self.llibre, centre=self.centre, registre="REG-1")
+        self.client.get("/api/exemplars/by-registre/REG-1")
+        altre = Centre.objects.create(nom="Altre")
+        with self.captureOnCommitCallbacks(execute=True):
+            Exemplar.objects.create(cataleg=self.llibre, centre=altre, registre="REG-1")
+        self.assertEqual(self.client.get("/api/exemplars/by-registre/REG-1").status_code, 409)
+        dades = self.client.get(f"/api/exemplars/by-registre/REG-1?centre={altre.pk}").json()
+        self.assertEqual(dades["exemplar"]["centre"]["nom"], "Altre")
+        self.assertEqual(self.client.get("/api/exemplars/by-registre/REG-2").status_code, 404)
+
+
+class ReservesCuaTest(TestCase):
+    """Cua de reserves per registre: ordre d'arribada, assignació i caducitat."""
+
+    @classmethod
+    def setUpTestData(cls):
+        centre = Centre.objects.create(nom="Centre")
+        cls.llibre = Llibre.objects.create(titol="Llibre")
+        cls.exemplar = Exemplar.objects.create(cataleg=cls.llibre, centre=centre, registre="C1")
+        cls.lectors = [Usuari.objects.create_user(username=f"lector{i}", password="x") for i in range(4)]
+
+    def ids(self, estat):
+        return list(
+            Reserva.objects.filter(estat=estat).order_by("posicio").values_list("usuari_id", flat=True)
+        )
+
+    def test_cua_fifo(self):
+        prestecs.prestar(self.lectors[0].pk, self.exemplar.pk)
+        for lector in self.lectors[1:]:
+            prestecs.reservar(lector.pk, self.llibre.pk)
+        with self.assertRaises(prestecs.PrestecError):
+            prestecs.reservar(self.lectors[1].pk, self.llibre.pk)
+        self.assertEqual(self.ids(Reserva.ESPERA), [l.pk for l in self.lectors[1:]])
+
+        # el retorn el guarda per a la primera de la cua i ningú més se'l pot endur
+        prestecs.retornar(self.exemplar.pk)
+        reserva = Reserva.objects.get(estat=Reserva.ASSIGNADA)
+        self.assertEqual((reserva.usuari_id, reserva.exemplar_id), (self.lectors[1].pk, self.exemplar.pk))
+        self.assertFalse(Exemplar.objects.filter(pk=self.exemplar.pk).disponibles().exists())
+        with self.assertRaises(prestecs.NoDisponible):
+            prestecs.prestar(self.lectors[2].pk, self.exemplar.pk)
+        resultat = prestecs.prestar_lot([{"usuari": self.lectors[3].pk, "exemplar": self.exemplar.pk}])
+        self.assertFalse(resultat[0]["ok"])
+
+        prestecs.prestar(self.lectors[1].pk, self.exemplar.pk)
+        self.assertEqual(Reserva.objects.get(pk=reserva.pk).estat, Reserva.RECOLLIDA)
+        prestecs.retornar_lot([{"exemplar": self.exemplar.pk}])
+        self.assertEqual(self.ids(Reserva.ASSIGNADA), [self.lectors[2].pk])
+        self.llibre.refresh_from_db()
+        self.assertEqual((self.llibre.comptador_disponibles, self.llibre.comptador_reserves), (0, 2))
+
+    def test_caducitat(self):
+        for lector in self.lectors[:3]:
+            prestecs.reservar(lector.pk, self.llibre.pk)
+        self.assertEqual(self.ids(Reserva.ASSIGNADA), [self.lectors[0].pk])
+
+        # la reserva no recollida caduca i l'exemplar passa a la següent
+        Reserva.objects.filter(estat=Reserva.ASSIGNADA).update(expira=timezone.now() - timedelta(hours=1))
+        self.assertEqual(reserves.caducar(), 1)
+        self.assertEqual(self.ids(Reserva.CADUCADA), [self.lectors[0].pk])
+        self.assertEqual(self.ids(Reserva.ASSIGNADA), [self.lectors[1].pk])
+        self.assertEqual(reserves.caducar(), 0)
+
+        # cancel·lar-la també
+        reserva = Reserva.objects.get(estat=Reserva.ASSIGNADA)
+        prestecs.cancellar_reserva(reserva.pk, self.lectors[1].pk)
+        self.assertEqual(self.ids(Reserva.ASSIGNADA), [self.lectors[2].pk])
+
+    def test_api(self):
+        prestecs.prestar(self.lectors[0].pk, self.exemplar.pk)
+        token = tokens.emetre(self.lectors[1])
+        capcalera = {"HTTP_AUTHORIZATION": f"Bearer {token}"}
+        resposta = self.client.post(
+            "/api/reserves", {"cataleg": self.llibre.pk}, content_type="application/json", **capcalera,
+        ).json()
+        self.assertEqual((resposta["estat"], resposta["lloc"]), (Reserva.ESPERA, 1))
+        self.assertEqual(len(self.client.get("/api/reserves", **capcalera).json()), 1)
+        self.assertEqual(self.client.delete(f"/api/reserves/{resposta['id']}", **capcalera).status_code, 200)
+        self.assertEqual(self.client.get("/api/reserves", **capcalera).json(), [])
+        self.assertEqual(self.client.get("/api/reserves").status_code, 401)
+
+    def test_assignar_pendents_per_lots(self):
+        centre = Centre.objects.get()
+        altre = Llibre.objects.create(titol="Altre")
+        Exemplar.objects.create(cataleg=altre, centre=centre, registre="C2")
+        # reserves en espera tot i haver-hi exemplars lliures (com a generar_datos)
+        Reserva.objects.bulk_create([
+            Reserva(usuari=lector, cataleg=llibre, posicio=i + 1)
+            for llibre in (self.llibre, altre) for i, lector in enumerate(self.lectors[:2])
+        ])
+        self.assertEqual(reserves.assignar_pendents(mida_lot=1), {self.llibre.pk, altre.pk})
+        self.assertEqual(
+            sorted(Reserva.objects.filter(estat=Reserva.ASSIGNADA).values_list("cataleg_id", "usuari_id")),
+            sorted([(self.llibre.pk, self.lectors[0].pk), (altre.pk, self.lectors[0].pk)]),
+        )
+
+    def test_admin(self):
+        admin = Usuari.objects.create_superuser(username="admin", password="x")
+        self.client.force_login(admin)
+        for lector in self.lectors[:3]:
+            prestecs.reservar(lector.pk, self.llibre.pk)
+        primera = Reserva.objects.get(estat=Reserva.ASSIGNADA)
+
+        # l'estat i l'exemplar no es poden editar al formulari
+        url = f"/admin/biblioteca/reserva/{primera.pk}/change/"
+        self.client.post(url, {"estat": Reserva.RECOLLIDA, "exemplar": ""})
+        primera.refresh_from_db()
+        self.assertEqual((primera.estat, primera.exemplar_id), (Reserva.ASSIGNADA, self.exemplar.pk))
+
+        # les transicions passen per la cua: l'exemplar va a la següent
+        changelist = "/admin/biblioteca/reserva/"
+        self.client.post(changelist, {"action": "cancellar", "_selected_action": [primera.pk]})
+        self.assertEqual(self.ids(Reserva.CANCELLADA), [self.lectors[0].pk])
+        self.assertEqual(self.ids(Reserva.ASSIGNADA), [self.lectors[1].pk])
+        segona = Reserva.objects.get(estat=Reserva.ASSIGNADA)
+        self.client.post(changelist, {"action": "caducar", "_selected_action": [segona.pk]})
+        self.assertEqual(self.ids(Reserva.CADUCADA), [self.lectors[1].pk])
+        self.assertEqual(self.ids(Reserva.ASSIGNADA), [self.lectors[2].pk])
+
+
+class VencimentsTest(TestCase):
+    """Dies de préstec per política i avisos de venciment agrupats per usuari."""
+
+    @classmethod
+    def setUpTestData(cls):
+        centre = Centre.objects.create(nom="Centre")
+        cls.alumnes = Grup.objects.create(nom="Alumnes")
+        cls.llibre = Llibre.objects.create(titol="Llibre")
+        cls.revista = Revista.objects.create(titol="Revista")
+        cls.exemplars = Exemplar.objects.bulk_create(
+            [Exemplar(cataleg=cls.llibre, centre=centre, registre=f"V{i}") for i in range(5)]
+            + [Exemplar(cataleg=cls.revista, centre=centre, registre=f"VR{i}") for i in range(2)]
+        )
+        cls.alumne = Usuari.objects.create_user(username="alumne", password="x", grup=cls.alumnes)
+        cls.lectora = Usuari.objects.create_user(username="lectora", password="x")
+        PoliticaPrestec.objects.create(dies=30)
+        PoliticaPrestec.objects.create(tipus="revista", dies=7)
+        PoliticaPrestec.objects.create(grup=cls.alumnes, dies=14)
+
+    def test_politiques(self):
+        inici = date(2025, 1, 1)
+        casos = [
+            (self.lectora, self.exemplars[0], 30),
+            (self.lectora, self.exemplars[5], 7),
+            # la del grup mana sobre la del tipus
+            (self.alumne, self.exemplars[6], 14),
+        ]
+        for usuari, exemplar, dies in casos:
+            prestec = prestecs.prestar(usuari.pk, exemplar.pk, data_prestec=inici)
+            self.assertEqual(prestec.data_venciment, inici + timedelta(days=dies))
+        resultat = prestecs.prestar_lot([{"usuari": self.alumne.pk, "exemplar": self.exemplars[1].pk}])
+        prestec = Prestec.objects.get(pk=resultat[0]["prestec"])
+        self.assertEqual(prestec.data_venciment, prestec.data_prestec + timedelta(days=14))
+
+    def test_un_avis_per_usuari(self):
+        avui = date(2025, 3, 1)
+        for i, exemplar in enumerate(self.exemplars[:4]):
+            usuari = self.alumne if i < 3 else self.lectora
+            prestecs.prestar(usuari.pk, exemplar.pk, data_prestec=date(2025, 1, 1) + timedelta(days=i))
+        prestecs.retornar(self.exemplars[2].pk)
+        prestecs.prestar(self.lectora.pk, self.exemplars[4].pk, data_prestec=avui)
+
+        # lots d'un préstec: els de l'alumne queden repartits però van al mateix avís
+        self.assertEqual(venciments.processar(avui, mida_lot=1), (3, 2))
+        avisos = {a.usuari_id: a for a in Avis.objects.filter(data=avui)}
+        self.assertEqual(avisos[self.alumne.pk].prestecs.count(), 2)
+        self.assertEqual(avisos[self.lectora.pk].prestecs.count(), 1)
+
+        # no es repeteix fins passats PRESTECS_DIES_ENTRE_AVISOS
+        self.assertEqual(venciments.processar(avui), (0, 0))
+        self.assertEqual(venciments.processar(avui + timedelta(days=3)), (0, 0))
+        self.assertEqual(venciments.processar(avui + timedelta(days=7)), (3, 2))
+
+    @skipUnless(connection.vendor == 'sqlite', "EXPLAIN QUERY PLAN de SQLite")
+    def test_index_parcial(self):
+        qs = venciments.vencuts(date(2025, 3, 1)).order_by("data_venciment", "pk")
+        self.assertIn("prestec_obert_venciment_idx", qs.explain())
+
+
+class PaginacioLlibresTest(TestCase):
+    """/api/llibres: paginació per cursor i NDJSON."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.llibres = [Llibre.objects.create(titol=f"Llibre {i}") for i in range(5)]
+
+    def setUp(self):
+        cache_api.invalidar("llibres")
+
+    def test_recorre_totes_les_pagines(self):
+        vistos = []
+        cursor = None
+        for _ in range(10):
+            url = "/api/llibres?limit=2" + (f"&cursor={cursor}" if cursor else "")
+            pagina = self.client.get(url).json()
+            vistos += [llibre["id"] for llibre in pagina["results"]]
+            cursor = pagina["next"]
+            if not cursor:
+                break
+        self.assertEqual(vistos, [llibre.pk for llibre in self.llibres])
+
+    def test_cursor_invalid(self):
+        # base64 de {"pk": [1]}, de "[1]" i d'un text qualsevol
+        for cursor in ("eyJwayI6WzFdfQ", "WzFd", "no-és-un-cursor"):
+            resposta = self.client.get(f"/api/llibres?limit=2&cursor={cursor}")
+            self.assertEqual(resposta.status_code, 400, cursor)
+
+    def test_cerca_paginada_per_rellevancia(self):
+        # el títol pesa més que l'autor: els de l'autora surten darrere
+        autora = Autor.objects.create(nom="Ventura")
+        for i in range(3):
+            Llibre.objects.create(titol=f"Altre {i}", autor=autora)
+        for i in range(2):
+            Llibre.objects.create(titol=f"Ventura {i}")
+        cerca.reindexar_tot()
+        cache_api.invalidar("llibres")
+        sencera = [llibre["id"] for llibre in self.client.get("/api/llibres?search=ventura").json()]
+        self.assertEqual(len(sencera), 5)
+        self.assertNotEqual(sencera, sorted(sencera))
+
+        vistos, cursor = [], None
+        for _ in range(10):
+            url = "/api/llibres?search=ventura&limit=2" + (f"&cursor={cursor}" if cursor else "")
+            pagina = self.client.get(url).json()
+            vistos += [llibre["id"] for llibre in pagina["results"]]
+            cursor = pagina["next"]
+            if not cursor:
+                break
+        self.assertEqual(vistos, sencera)
+        # un cursor de pk no serveix per a la cerca
+        self.assertEqual(self.client.get("/api/llibres?search=ventura&limit=2&cursor=eyJwayI6MX0").status_code, 400)
+
+    def test_ndjson(self):
+        resposta = self.client.get("/api/llibres?stream=true")
+        self.assertEqual(resposta["Content-Type"], "application/x-ndjson")
+        linies = b"".join(resposta.streaming_content).decode().splitlines()
+        self.assertEqual([json.loads(l)["titol"] for l in linies], [f"Llibre {i}" for i in range(5)])
+
+
+class CercaTest(TestCase):
+    """cerca.cercar amb els dos backends: paraules, prefix, tipus i límit."""
+
+    @classmethod
+    def setUpTestData(cls):
+        autora = Autor.objects.create(nom="Mercè Rodoreda")
+        cls.diamant = Llibre.objects.create(titol="La plaça del Diamant", autor=autora)
+        cls.mirall = Llibre.objects.create(titol="Mirall trencat", autor=autora)
+        cls.revista = Revista.objects.create(titol="Rodoreda i el Diamant")
+        cls.altres = [Llibre.objects.create(titol=f"Diamant {i}") for i in range(3)]
+
+    def backends(self):
+        backends = [cerca.TermesBackend()]
+        if connection.vendor == "sqlite":
+            backends.append(cerca.Fts5Backend())
+        return backends
+
+    def test_cercar(self):
+        anterior = cerca._backend
+        self.addCleanup(setattr, cerca, "_backend", anterior)
+        for backend in self.backends():
+            cerca._backend = backend
+            backend.buidar()
+            backend.indexar(cerca.documents())
+            with self.subTest(backend=backend.nom):
+                self.assertEqual(set(cerca.cercar("rodoreda diam")), {self.diamant.pk, self.revista.pk})
+                self.assertEqual(set(cerca.cercar("RODORÉDA")), {self.diamant.pk, self.mirall.pk, self.revista.pk})
+                self.assertEqual(cerca.cercar("mirall trenc"), [self.mirall.pk])
+                self.assertEqual(cerca.cercar("inexistent diamant"), [])
+                # una sola lletra no es busca com a prefix
+                self.assertEqual(cerca.cercar("m"), [])
+                # el límit s'aplica després de restringir als llibres
+                llibres = cerca.cercar("diamant", limit=4, model=Llibre)
+                self.assertEqual(len(llibres), 4)
+                self.assertNotIn(self.revista.pk, llibres)
+
+    def test_termes_una_consulta(self):
+        backend = cerca.TermesBackend()
+        backend.indexar(cerca.documents())
+        with self.assertNumQueries(1):
+            self.assertEqual(backend.cercar(["rodoreda", "d"], 10), [self.diamant.pk, self.revista.pk])
+
+
+class AutocompletarTest(TestCase):
+    """Índexs de prefix: endpoint, canvis en fer commit i reconstrucció única."""
+
+    def test_autocomplete(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            autora = Autor.objects.create(nom="Mercè Rodoreda")
+        autocompletar.autors.reconstruir()
+        dades = self.client.get("/api/autocomplete?q=rodo&tipus=autor").json()
+        self.assertEqual(dades["autor"], [{"id": autora.pk, "nom": "Mercè Rodoreda"}])
+        self.assertEqual(self.client.get("/api/autocomplete?q=x&tipus=res").status_code, 400)
+
+        # un rollback no hi deixa entrades; un commit sí
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertRaises(IntegrityError), transaction.atomic():
+                Autor.objects.create(nom="Fantasma")
+                raise IntegrityError
+            Autor.objects.create(nom="Fabra")
+        self.assertEqual(autocompletar.autors.cercar("fa"), [
+            {"id": Autor.objects.get(nom="Fabra").pk, "nom": "Fabra"},
+        ])
+
+    def test_reconstruccio_unica(self):
+        carregues = []
+        index = None
+
+        def carregar():
+            carregues.append(1)
+            if len(carregues) > 1:
+                # un canvi que arriba mentre es carrega no es perd
+                index.actualitzar(99, "Nou")
+                time.sleep(0.05)
+            return [(1, "Vell")]
+
+        index = autocompletar.IndexPrefix(carregar)
+        index.reconstruir()
+        index._construit -= 3600
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            resultats = list(pool.map(lambda _: index.cercar("vell"), range(8)))
+        self.assertEqual(len(carregues), 2)
+        self.assertTrue(all(r == [{"id": 1, "nom": "Vell"}] for r in resultats))
+        self.assertEqual(index.cercar("nou"), [{"id": 99, "nom": "Nou"}])
+
+
+class AdminLookupTest(TestCase):
+    """Widgets d'autor i editorial de l'admin: lookup_view i nom inicial."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = Usuari.objects.create_superuser(username="admin", password="x")
+        cls.autors = Autor.objects.bulk_create([Autor(nom=f"Rodoreda {i:02d}") for i in range(25)])
+
+    def setUp(self):
+        self.client.force_login(self.admin)
+        autocompletar.autors.reconstruir()
+
+    def test_lookup_paginat(self):
+        url = "/admin/biblioteca/llibre/lookup/autor/"
+        primera = self.client.get(url, {"q": "rodo"}).json()
+        self.assertEqual((len(primera["results"]), primera["next"]), (20, 2))
+        segona = self.client.get(url, {"q": "rodo", "page": 2}).json()
+        self.assertEqual((len(segona["results"]), segona["next"]), (5, None))
+        self.assertEqual(segona["results"][-1]["nom"], "Rodoreda 24")
+        self.assertEqual(self.client.get("/admin/biblioteca/llibre/lookup/titol/").status_code, 404)
+        self.client.logout()
+        self.assertEqual(self.client.get(url, {"q": "rodo"}).status_code, 302)
+
+    def test_nom_inicial_sense_carregar_l_index(self):
+        from .admin import AutorWidget
+        autor = self.autors[3]
+        with self.assertNumQueries(0):
+            self.assertEqual(AutorWidget().format_value(autor.pk), "Rodoreda 03")
+        # índex fred: una consulta per pk i l'índex continua sense carregar
+        index = autocompletar.autors
+        self.addCleanup(setattr, index, "_construit", index._construit)
+        index._construit = 0
+        with self.assertNumQueries(1):
+            self.assertEqual(AutorWidget().format_value(autor.pk), "Rodoreda 03")
+        self.assertIsNone(index.nom(autor.pk))
+
+
+class LlibreChangelistTest(TestCase):
+    """Llistat de llibres de l'admin: comptadors anotats i ordenables."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = Usuari.objects.create_superuser(username="admin", password="x")
+        centre = Centre.objects.create(nom="Centre")
+        lectora = Usuari.objects.create_user(username="lectora", password="x")
+        cls.llibres = [Llibre.objects.create(titol=f"Llibre {i}") for i in range(3)]
+        for i, llibre in enumerate(cls.llibres):
+            # Llibre 0: 3 exemplars (1 de baixa, 1 en préstec); Llibre 1: 2; Llibre 2: 1
+            exemplars = Exemplar.objects.bulk_create([
+                Exemplar(cataleg=llibre, centre=centre, registre=f"{i}-{j}", baixa=(i == 0 and j == 2))
+                for j in range(3 - i)
+            ])
+            if i == 0:
+                Prestec.objects.create(usuari=lectora, exemplar=exemplars[0])
+
+    def setUp(self):
+        self.client.force_login(self.admin)
+
+    def files(self, **params):
+        resposta = self.client.get("/admin/biblioteca/llibre/", params)
+        self.assertEqual(resposta.status_code, 200)
+        return [
+            (ll.titol, ll.n_exemplars, ll.n_disponibles, ll.n_prestec, ll.n_baixa)
+            for ll in resposta.context["cl"].result_list
+        ]
+
+    def test_comptadors(self):
+        self.assertEqual(sorted(self.files()), [
+            ("Llibre 0", 3, 1, 1, 1), ("Llibre 1", 2, 2, 0, 0), ("Llibre 2", 1, 1, 0, 0),
+        ])
+
+    def test_ordenable(self):
+        # o=4 és num_exemplars dins list_display
+        self.assertEqual([f[0] for f in self.files(o="4")], ["Llibre 2", "Llibre 1", "Llibre 0"])
+        self.assertEqual([f[0] for f in self.files(o="-4")], ["Llibre 0", "Llibre 1", "Llibre 2"])
+
+    def test_consultes_independents_de_les_files(self):
+        with CaptureQueriesContext(connection) as poques:
+            self.files()
+        centre = Centre.objects.get()
+        for i in range(10):
+            llibre = Llibre.objects.create(titol=f"Més {i}")
+            Exemplar.objects.create(cataleg=llibre, centre=centre, registre=f"M{i}")
+        with CaptureQueriesContext(connection) as moltes:
+            self.files()
+        self.assertEqual(len(poques), len(moltes))
+
+
+class ExemplarsApiTest(TestCase):
+    """/api/exemplars: files polimòrfiques, consulta compartida i ?fields=."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.centre = Centre.objects.create(nom="Centre")
+        autor = Autor.objects.create(nom="Mercè Rodoreda")
+        editorial = Editorial.objects.create(nom="Club Editor")
+        cls.llibre = Llibre.objects.create(titol="La plaça del Diamant", autor=autor, editorial=editorial, ISBN="978-84-7329")
+        cls.revista = Revista.objects.create(titol="Serra d'Or", ISSN="0037-2501", numero=7)
+        cls.dispositiu = Dispositiu.objects.create(titol="Lector", marca="Kobo")
+        cls.cataleg = Cataleg.objects.create(titol="Sense tipus")
+        cls.exemplars = Exemplar.objects.bulk_create([
+            Exemplar(cataleg=c, centre=cls.centre, registre=f"E{i}")
+            for i, c in enumerate([cls.llibre, cls.llibre, cls.revista, cls.dispositiu, cls.cataleg])
+        ])
+
+    def setUp(self):
+        cache_api.invalidar("exemplars")
+
+    def get(self, url, **params):
+        resposta = self.client.get(url, params)
+        self.assertEqual(resposta.status_code, 200)
+        return resposta.json()
+
+    def test_polimorfic(self):
+        # una per l'ETag (cache_api.marca) i una per les files
+        with self.assertNumQueries(2):
+            files = self.get("/api/exemplars")
+        self.assertEqual([f["tipus"] for f in files], ["llibre", "llibre", "revista", "dispositiu", "indefinit"])
+        llibre, revista, dispositiu, cataleg = files[0]["cataleg"], files[2]["cataleg"], files[3]["cataleg"], files[4]["cataleg"]
+        self.assertEqual(
+            (llibre["titol"], llibre["autor"], llibre["editorial"], llibre["ISBN"]),
+            ("La plaça del Diamant", "Mercè Rodoreda", "Club Editor", "978-84-7329"),
+        )
+        self.assertEqual((revista["ISSN"], revista["numero"]), ("0037-2501", 7))
+        self.assertNotIn("ISBN", revista)
+        self.assertEqual((dispositiu["marca"], dispositiu["model"]), ("Kobo", None))
+        self.assertEqual(set(cataleg), {"id", "titol", "autor"})
+        self.assertEqual(files[0]["centre"], {"id": self.centre.pk, "nom": "Centre"})
+
+        self.assertEqual([f["id"] for f in self.get("/api/exemplars", tipus="revista")], [self.exemplars[2].pk])
+        self.assertEqual([f["id"] for f in self.get("/api/exemplars", tipus="indefinit")], [self.exemplars[4].pk])
+        self.assertEqual(self.client.get("/api/exemplars", {"tipus": "vinil"}).status_code, 400)
+
+    def test_endpoints_comparteixen_la_forma(self):
+        per_llibre = self.get(f"/api/llibres/{self.llibre.pk}/exemplars")
+        detall = self.get(f"/api/llibres/{self.llibre.pk}")["exemplars"]
+        general = self.get("/api/exemplars", cataleg=self.llibre.pk)
+        self.assertEqual(len(per_llibre), 2)
+        self.assertEqual(per_llibre, detall)
+        self.assertEqual(per_llibre, general)
+
+    def test_fields(self):
+        with CaptureQueriesContext(connection) as capturades:
+            files = self.get("/api/exemplars", fields="id,registre")
+        self.assertEqual(files[0], {"id": self.exemplars[0].pk, "registre": "E0"})
+        # sense cataleg ni centre no cal cap JOIN
+        self.assertNotIn("JOIN", capturades[0]["sql"])
+
+        files = self.get("/api/exemplars", fields="registre,tipus")
+        self.assertEqual(files[2], {"registre": "E2", "tipus": "revista"})
+        resposta = self.client.get("/api/exemplars", {"fields": "id,preu"})
+        self.assertEqual(resposta.status_code, 400)
+        self.assertIn("preu", resposta.json()["detail"])
+
+        pagina = self.get("/api/exemplars", fields="id", limit=2)
+        self.assertEqual([f["id"] for f in pagina["results"]], [e.pk for e in self.exemplars[:2]])
+        seguent = self.get("/api/exemplars", fields="id", limit=2, cursor=pagina["next"])
+        self.assertEqual([f["id"] for f in seguent["results"]], [e.pk for e in self.exemplars[2:4]])
+
+
+class DisponibilitatTest(TestCase):
+    """Comptadors materialitzats: sincronia amb les escriptures i verificar_disponibilitat."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.centres = [Centre.objects.create(nom="Centre A"), Centre.objects.create(nom="Centre B")]
+        cls.llibre = Llibre.objects.create(titol="Llibre")
+        cls.altre = Llibre.objects.create(titol="Altre")
+        cls.exemplars = [
+            Exemplar.objects.create(cataleg=cls.llibre, centre=cls.centres[i % 2], registre=f"D{i}") for i in range(4)
+        ]
+        cls.lectora = Usuari.objects.create_user(username="lectora", password="x")
+
+    def comptadors(self, cataleg):
+        cataleg = Cataleg.objects.get(pk=cataleg.pk)
+        per_centre = {
+            fila.pop("centre_id"): fila
+            for fila in DisponibilitatCentre.objects.filter(cataleg=cataleg)
+            .values("centre_id", "exemplars", "disponibles", "prestec", "reserves")
+        }
+        total = (cataleg.comptador_exemplars, cataleg.comptador_disponibles,
+                 cataleg.comptador_prestec, cataleg.comptador_reserves)
+        return total, per_centre
+
+    def test_escriptures(self):
+        a, b = (c.pk for c in self.centres)
+        total, per_centre = self.comptadors(self.llibre)
+        self.assertEqual(total, (4, 4, 0, 0))
+        self.assertEqual(per_centre[a], {"exemplars": 2, "disponibles": 2, "prestec": 0, "reserves": 0})
+
+        prestecs.prestar(self.lectora.pk, self.exemplars[0].pk)
+        exemplar = self.exemplars[1]
+        exemplar.baixa = True
+        exemplar.save()
+        total, per_centre = self.comptadors(self.llibre)
+        self.assertEqual(total, (4, 2, 1, 0))
+        self.assertEqual(per_centre[a], {"exemplars": 2, "disponibles": 1, "prestec": 1, "reserves": 0})
+        self.assertEqual(per_centre[b], {"exemplars": 2, "disponibles": 1, "prestec": 0, "reserves": 0})
+
+        # moure un exemplar a un altre registre toca els dos
+        exemplar = self.exemplars[3]
+        exemplar.cataleg = self.altre
+        exemplar.save()
+        self.assertEqual(self.comptadors(self.llibre)[0], (3, 1, 1, 0))
+        self.assertEqual(self.comptadors(self.altre)[0], (1, 1, 0, 0))
+
+        prestecs.retornar(self.exemplars[0].pk)
+        self.exemplars[2].delete()
+        self.assertEqual(self.comptadors(self.llibre)[0], (2, 1, 0, 0))
+        self.assertEqual(disponibilitat.derives([self.llibre.pk, self.altre.pk]), [])
+
+    def verificar(self, *args):
+        sortida = io.StringIO()
+        call_command("verificar_disponibilitat", *args, stdout=sortida)
+        return sortida.getvalue().strip()
+
+    def test_verificar_disponibilitat(self):
+        self.assertEqual(self.verificar(), "2 catàlegs revisats, 0 desquadrats")
+        # update() i bulk_create no passen pels signals
+        Exemplar.objects.filter(pk=self.exemplars[0].pk).update(baixa=True)
+        Exemplar.objects.bulk_create([Exemplar(cataleg=self.altre, centre=self.centres[0], registre="X")])
+        self.assertEqual(self.verificar("--lot", "1"), "2 catàlegs revisats, 2 desquadrats")
+        self.assertEqual(self.comptadors(self.llibre)[0], (4, 4, 0, 0))
+
+        self.assertEqual(self.verificar("--reparar"), "2 catàlegs revisats, 2 reparats")
+        self.assertEqual(self.comptadors(self.llibre)[0], (4, 3, 0, 0))
+        self.assertEqual(self.comptadors(self.altre)[0], (1, 1, 0, 0))
+        self.assertEqual(self.verificar(), "2 catàlegs revisats, 0 desquadrats")
+
+
+class MigracioComptadorsTest(TransactionTestCase):
+    """0013 omple els comptadors de les dades que ja hi havia."""
+
+    abans = [("biblioteca", "0012_cerca")]
+    despres = [("biblioteca", "0013_comptadors_disponibilitat")]
+
+    def migrar(self, desti):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate(desti)
+        return executor.loader.project_state(desti).apps
+
+    def tearDown(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes())
+
+    def test_omple_comptadors(self):
+        apps = self.migrar(self.abans)
+        Centre = apps.get_model("biblioteca", "Centre")
+        Llibre = apps.get_model("biblioteca", "Llibre")
+        Exemplar = apps.get_model("biblioteca", "Exemplar")
+        Prestec = apps.get_model("biblioteca", "Prestec")
+        Reserva = apps.get_model("biblioteca", "Reserva")
+        Usuari = apps.get_model("biblioteca", "Usuari")
+        a, b = Centre.objects.create(nom="A"), Centre.objects.create(nom="B")
+        llibre = Llibre.objects.create(titol="Llibre")
+        buit = Llibre.objects.create(titol="Sense exemplars")
+        exemplars = [
+            Exemplar.objects.create(cataleg=llibre, centre=centre, baixa=baixa)
+            for centre, baixa in ((a, False), (a, False), (b, True))
+        ]
+        usuari = Usuari.objects.create(username="lectora")
+        Prestec.objects.create(usuari=usuari, exemplar=exemplars[0])
+        Reserva.objects.create(usuari=usuari, exemplar=exemplars[0])
+
+        apps = self.migrar(self.despres)
+        Cataleg = apps.get_model("biblioteca", "Cataleg")
+        DisponibilitatCentre = apps.get_model("biblioteca", "DisponibilitatCentre")
+        camps = ("comptador_exemplars", "comptador_disponibles", "comptador_prestec", "comptador_reserves")
+        self.assertEqual(Cataleg.objects.values_list(*camps).get(pk=llibre.pk), (3, 1, 1, 1))
+        self.assertEqual(Cataleg.objects.values_list(*camps).get(pk=buit.pk), (0, 0, 0, 0))
+        self.assertEqual(
+            sorted(DisponibilitatCentre.objects.values_list("centre_id", "exemplars", "disponibles", "prestec", "reserves")),
+            [(a.pk, 2, 1, 1, 1), (b.pk, 1, 0, 0, 0)],
+        )
+
+
+class MigracioCercaTest(TransactionTestCase):
+    """0012 indexa el catàleg existent sense dependre de cerca.py."""
+
+    abans = [("biblioteca", "0011_remove_llibre_editorial_remove_llibre_llengua_and_more")]
+    despres = [("biblioteca", "0012_cerca")]
+    migrar = MigracioComptadorsTest.migrar
+    tearDown = MigracioComptadorsTest.tearDown
+
+    def crear(self):
+        apps = self.migrar(self.abans)
+        autor = apps.get_model("biblioteca", "Autor").objects.create(nom="Mercè Rodoreda")
+        Llibre = apps.get_model("biblioteca", "Llibre")
+        return Llibre.objects.create(titol="La plaça del Diamant", autor=autor, ISBN="9788473291002")
+
+    @skipUnless(connection.vendor == 'sqlite', "taula FTS5")
+    def test_fts5(self):
+        llibre = self.crear()
+        self.migrar(self.despres)
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT rowid FROM biblioteca_cerca_fts WHERE biblioteca_cerca_fts MATCH 'rodoreda plaça'")
+            self.assertEqual(cursor.fetchall(), [(llibre.pk,)])
+
+    @override_settings(CERCA_BACKEND="termes")
+    def test_termes(self):
+        llibre = self.crear()
+        apps = self.migrar(self.despres)
+        TermeCerca = apps.get_model("biblioteca", "TermeCerca")
+        self.assertEqual(
+            dict(TermeCerca.objects.filter(cataleg_id=llibre.pk).values_list("terme", "pes")),
+            {"la": 10.0, "placa": 10.0, "del": 10.0, "diamant": 10.0, "merce": 6.0, "rodoreda": 6.0,
+             "9788473291002": 10.0},
+        )
+
+
+class MigracioRegistresTest(TransactionTestCase):
+    """0021 no afegeix la restricció si hi ha registres repetits, i no els toca."""
+
+    abans = [("biblioteca", "0020_prestec_usuari_data")]
+    despres = [("biblioteca", "0021_exemplar_registre_centre")]
+    migrar = MigracioComptadorsTest.migrar
+    tearDown = MigracioComptadorsTest.tearDown
+
+    def test_repetits(self):
+        apps = self.migrar(self.abans)
+        Centre = apps.get_model("biblioteca", "Centre")
+        Llibre = apps.get_model("biblioteca", "Llibre")
+        Exemplar = apps.get_model("biblioteca", "Exemplar")
+        a, b = Centre.objects.create(nom="A"), Centre.objects.create(nom="B")
+        llibre = Llibre.objects.create(titol="Llibre")
+        for centre, registre in ((a, "1"), (a, "1"), (b, "1"), (a, ""), (a, ""), (b, ""), (a, None), (a, None)):
+            Exemplar.objects.create(cataleg=llibre, centre=centre, registre=registre)
+        abans = list(Exemplar.objects.order_by("pk").values_list("pk", "centre_id", "registre"))
+
+        with self.assertRaises(RuntimeError) as error:
+            self.migrar(self.despres)
+        missatge = str(error.exception)
+        self.assertIn("Hi ha 4 exemplars", missatge)
+        for pk, centre, registre in abans[:2] + abans[3:5]:
+            self.assertIn(f"exemplar {pk}: centre {centre}, registre {registre!r}", missatge)
+        self.assertEqual(list(Exemplar.objects.order_by("pk").values_list("pk", "centre_id", "registre")), abans)
+
+        # un cop corregits, migra
+        Exemplar.objects.filter(pk=abans[1][0]).update(registre="2")
+        Exemplar.objects.filter(registre="").update(registre=None)
+        self.migrar(self.despres)
+
+
+class MigracioReservesTest(TransactionTestCase):
+    """0022: les reserves d'un exemplar passen a la cua del seu registre."""
+
+    abans = [("biblioteca", "0021_exemplar_registre_centre")]
+    despres = [("biblioteca", "0022_reserves_cua_restriccio")]
+    migrar = MigracioComptadorsTest.migrar
+    tearDown = MigracioComptadorsTest.tearDown
+
+    def test_encua(self):
+        apps = self.migrar(self.abans)
+        Centre = apps.get_model("biblioteca", "Centre")
+        Llibre = apps.get_model("biblioteca", "Llibre")
+        Exemplar = apps.get_model("biblioteca", "Exemplar")
+        Reserva = apps.get_model("biblioteca", "Reserva")
+        Usuari = apps.get_model("biblioteca", "Usuari")
+        centre = Centre.objects.create(nom="A")
+        llibres = [Llibre.objects.create(titol=f"Llibre {i}") for i in range(2)]
+        exemplars = [Exemplar.objects.create(cataleg=llibre, centre=centre) for llibre in llibres for _ in range(2)]
+        usuaris = [Usuari.objects.create(username=f"u{i}") for i in range(3)]
+        reserves_ = [
+            Reserva.objects.create(usuari=usuari, exemplar=exemplar)
+            for usuari, exemplar in zip(usuaris, exemplars[:2])
+        ] + [Reserva.objects.create(usuari=usuaris[2], exemplar=exemplars[2])]
+
+        apps = self.migrar(self.despres)
+        Reserva = apps.get_model("biblioteca", "Reserva")
+        self.assertEqual(
+            list(Reserva.objects.order_by("pk").values_list("pk", "cataleg_id", "exemplar_id", "posicio", "estat")),
+            [
+                (reserves_[0].pk, llibres[0].pk, None, 1, "espera"),
+                (reserves_[1].pk, llibres[0].pk, None, 2, "espera"),
+                (reserves_[2].pk, llibres[1].pk, None, 1, "espera"),
+            ],
+        )
+
+
+class CacheRespostesTest(TestCase):
+    """cache_api: encerts, fallades i invalidació per grups."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.llibre = Llibre.objects.create(titol="Crim")
+        cls.negra = Categoria.objects.create(nom="Novel·la negra")
+        cls.poesia = Categoria.objects.create(nom="Poesia")
+
+    def setUp(self):
+        cache_api.invalidar("llibres", "categories", "detalls", f"llibre:{self.llibre.pk}")
+
+    def get(self, url):
+        resposta = self.client.get(url)
+        self.assertEqual(resposta.status_code, 200)
+        return resposta["X-Cache"], resposta.json()
+
+    def test_encert_i_fallada(self):
+        url = f"/api/llibres/{self.llibre.pk}"
+        self.assertEqual(self.get(url)[0], "MISS")
+        with self.assertNumQueries(0):
+            estat, dades = self.get(url)
+        self.assertEqual((estat, dades["titol"]), ("HIT", "Crim"))
+        # els paràmetres formen part de la clau
+        self.assertEqual(self.get("/api/llibres?limit=1")[0], "MISS")
+        self.assertEqual(self.get("/api/llibres?limit=2")[0], "MISS")
+        self.assertEqual(self.get("/api/llibres?limit=1")[0], "HIT")
+        metriques = cache_api.metriques(["llibre"])["llibre"]
+        self.assertGreaterEqual((metriques["hits"], metriques["misses"]), (1, 1))
+
+    def test_desar_invalida(self):
+        url = f"/api/llibres/{self.llibre.pk}"
+        self.get(url)
+        self.get("/api/llibres")
+        with self.captureOnCommitCallbacks(execute=True):
+            Llibre.objects.filter(pk=self.llibre.pk).get().save()
+        self.assertEqual(self.get(url)[0], "MISS")
+        self.assertEqual(self.get("/api/llibres")[0], "MISS")
+        # un exemplar d'un altre registre no toca el detall d'aquest
+        self.assertEqual(self.get(url)[0], "HIT")
+        altre = Llibre.objects.create(titol="Un altre")
+        centre = Centre.objects.create(nom="Centre")
+        self.get("/api/llibres")
+        with self.captureOnCommitCallbacks(execute=True):
+            Exemplar.objects.create(cataleg=altre, centre=centre, registre="C1")
+        self.assertEqual(self.get(url)[0], "HIT")
+        self.assertEqual(self.get("/api/llibres")[0], "MISS")
+
+    def test_tags_invaliden_el_filtre_per_categoria(self):
+        url = f"/api/llibres?categoria={self.negra.pk}"
+        self.assertEqual(self.get(url), ("MISS", []))
+        self.assertEqual(self.get(url), ("HIT", []))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.llibre.tags.add(self.negra)
+        estat, dades = self.get(url)
+        self.assertEqual((estat, [ll["titol"] for ll in dades]), ("MISS", ["Crim"]))
+
+        # pel costat de la categoria, amb pk_set i amb clear()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.negra.cataleg_set.remove(self.llibre)
+        self.assertEqual(self.get(url), ("MISS", []))
+        self.llibre.tags.add(self.negra, self.poesia)
+        self.get(url)
+        self.get(f"/api/llibres/{self.llibre.pk}")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.negra.cataleg_set.clear()
+        self.assertEqual(self.get(url), ("MISS", []))
+        self.assertEqual(self.get(f"/api/llibres/{self.llibre.pk}")[0], "MISS")
+
+
+class GetCondicionalTest(TestCase):
+    """ETag i Last-Modified calculats de la base de dades: 304 i canvis després d'escriure."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.autor = Autor.objects.create(nom="Mercè Rodoreda")
+        cls.llibre = Llibre.objects.create(titol="Crim", autor=cls.autor)
+        cls.centre = Centre.objects.create(nom="Centre")
+        cls.exemplar = Exemplar.objects.create(cataleg=cls.llibre, centre=cls.centre, registre="G1")
+        cls.lectora = Usuari.objects.create_user(username="lectora", password="x")
+        cls.categoria = Categoria.objects.create(nom="Novel·la negra")
+        cls.altre = Llibre.objects.create(titol="Un altre")
+
+    def setUp(self):
+        cache_api.invalidar("llibres", "exemplars", "categories", "detalls", f"llibre:{self.llibre.pk}")
+
+    def etag(self, url, **headers):
+        resposta = self.client.get(url, **headers)
+        return resposta.status_code, resposta.get("ETag")
+
+    def test_304_sense_executar_la_vista(self):
+        url = f"/api/llibres/{self.llibre.pk}"
+        resposta = self.client.get(url)
+        etag, modificat = resposta["ETag"], resposta["Last-Modified"]
+        # la resposta guardada porta els mateixos validadors
+        self.assertEqual(self.client.get(url)["ETag"], etag)
+        # una consulta per als validadors i cap més: ni cache ni vista
+        cache_api.invalidar(f"llibre:{self.llibre.pk}")
+        with self.assertNumQueries(1):
+            resposta = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resposta.status_code, 304)
+        self.assertEqual(resposta["ETag"], etag)
+        self.assertEqual(self.etag(url, HTTP_IF_MODIFIED_SINCE=modificat)[0], 304)
+        self.assertEqual(self.etag(url, HTTP_IF_NONE_MATCH='"un-altre"')[0], 200)
+
+    def test_l_etag_canvia_en_escriure(self):
+        url = f"/api/llibres?categoria={self.categoria.pk}"
+        _, etag = self.etag(url)
+        self.assertEqual(self.etag(url, HTTP_IF_NONE_MATCH=etag), (304, etag))
+        escriptures = [
+            lambda: self.llibre.tags.add(self.categoria),
+            lambda: prestecs.prestar(self.lectora.pk, self.exemplar.pk),
+            lambda: Autor.objects.get(pk=self.autor.pk).save(),
+            lambda: Categoria.objects.create(nom="Poesia"),
+            # esborrar no canvia cap updated_at, però sí el nombre de files
+            lambda: self.altre.delete(),
+        ]
+        for escriptura in escriptures:
+            time.sleep(0.001)
+            # les invalidacions es fan en confirmar la transacció
+            with self.captureOnCommitCallbacks(execute=True):
+                escriptura()
+            estat, nou = self.etag(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(estat, 200)
+            self.assertNotEqual(nou, etag)
+            etag = nou
+
+    def test_historial(self):
+        url = "/api/prestecs?username=lectora"
+        _, etag = self.etag(url)
+        self.assertEqual(self.etag(url, HTTP_IF_NONE_MATCH=etag)[0], 304)
+        with self.captureOnCommitCallbacks(execute=True):
+            prestecs.prestar(self.lectora.pk, self.exemplar.pk)
+        estat, nou = self.etag(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(estat, 200)
+        time.sleep(0.001)
+        with self.captureOnCommitCallbacks(execute=True):
+            prestecs.retornar(self.exemplar.pk)
+        self.assertEqual(self.etag(url, HTTP_IF_NONE_MATCH=nou)[0], 200)
+
+    def test_validadors_guardats_fins_a_invalidar(self):
+        url = f"/api/llibres?categoria={self.categoria.pk}"
+        _, etag = self.etag(url)
+        # mentre els grups no canvien, un 304 no fa cap agregat
+        with self.assertNumQueries(0):
+            self.assertEqual(self.etag(url, HTTP_IF_NONE_MATCH=etag), (304, etag))
+        time.sleep(0.001)
+        with self.captureOnCommitCallbacks(execute=True):
+            Autor.objects.get(pk=self.autor.pk).save()
+        estat, nou = self.etag(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(estat, 200)
+        self.assertNotEqual(nou, etag)
+
+
+@override_settings(TASQUES_TERMINI=60, TASQUES_MAX_INTENTS=2)
+class TasquesTest(TestCase):
+    """Cua de tasques: termini de les tasques en curs i treballadors perduts."""
+
+    def setUp(self):
+        self.lots = []
+        tasques.TIPUS["prova"] = lambda tasca, progres: self.lots and self.lots.pop(0)(tasca, progres)
+        self.addCleanup(tasques.TIPUS.pop, "prova")
+
+    def envellir(self, tasca, segons):
+        Tasca.objects.filter(pk=tasca.pk).update(batec=timezone.now() - timedelta(seconds=segons))
+
+    def test_reclama_la_tasca_d_un_treballador_caigut(self):
+        tasca = tasques.encuar("prova")
+        self.assertEqual(tasques.reclamar("caigut").pk, tasca.pk)
+        # dins del termini ningú més la pot agafar
+        self.assertIsNone(tasques.reclamar("b"))
+        self.envellir(tasca, 61)
+        reclamada = tasques.reclamar("b")
+        self.assertEqual((reclamada.pk, reclamada.treballador, reclamada.intents), (tasca.pk, "b", 2))
+        tasques.executar(reclamada)
+        self.assertEqual(Tasca.objects.get().estat, Tasca.COMPLETADA)
+
+    def test_el_progres_renova_el_termini(self):
+        tasca = tasques.encuar("prova")
+        reclamada = tasques.reclamar("a")
+        self.envellir(tasca, 61)
+
+        def lot(tasca, progres):
+            progres(10, 10, [])
+            self.assertIsNone(tasques.reclamar("b"))
+        self.lots.append(lot)
+        tasques.executar(reclamada)
+        self.assertEqual(Tasca.objects.values_list("estat", "processades").get(), (Tasca.COMPLETADA, 10))
+
+    def test_el_treballador_lent_no_trepitja_el_nou(self):
+        tasca = tasques.encuar("prova")
+        lent = tasques.reclamar("lent")
+        self.envellir(tasca, 61)
+        nou = tasques.reclamar("nou")
+        self.lots.append(lambda tasca, progres: progres(5, 5, []))
+        tasques.executar(lent)
+        self.assertEqual(
+            Tasca.objects.values_list("estat", "treballador", "processades").get(),
+            (Tasca.EN_CURS, "nou", 0),
+        )
+        tasques.executar(nou)
+        self.assertEqual(Tasca.objects.get().estat, Tasca.COMPLETADA)
+
+    def test_massa_intents(self):
+        tasca = tasques.encuar("prova")
+        for treballador in ("a", "b"):
+            self.assertEqual(tasques.reclamar(treballador).pk, tasca.pk)
+            self.envellir(tasca, 61)
+        self.assertIsNone(tasques.reclamar("c"))
+        tasca.refresh_from_db()
+        self.assertEqual((tasca.estat, tasca.intents), (Tasca.FALLIDA, 3))
+        self.assertIn("2 vegades", tasca.missatge)
+
+
+class TreballadorMort(BaseException):
+    """Com si el procés del worker morís: executar() no la captura."""
+
+
+@override_settings(TASQUES_MIDA_LOT=2)
+class TasquesRepresaTest(TestCase):
+    """Una importació interrompuda continua on ho havia deixat, sense duplicar files."""
+
+    def setUp(self):
+        self.personal = Usuari.objects.create_user(username="personal", password="x", is_staff=True)
+
+    def encuar(self, tipus, nom, contingut):
+        document = Documento.objects.create(archivo=SimpleUploadedFile(nom, contingut.encode()))
+        return tasques.encuar(tipus, document, usuari=self.personal, format="csv")
+
+    def morir_al_segon_lot(self, tasca):
+        # el primer lot es desa; el segon mor abans del commit
+        original = tasques.TIPUS[tasca.tipus]
+        lots = []
+
+        def mortal(tasca, progres):
+            def progres_mortal(*args):
+                if lots:
+                    raise TreballadorMort()
+                lots.append(args)
+                progres(*args)
+            original(tasca, progres_mortal)
+
+        with mock.patch.dict(tasques.TIPUS, {tasca.tipus: mortal}):
+            with self.assertRaises(TreballadorMort):
+                tasques.executar(tasques.reclamar("mort"))
+        Tasca.objects.filter(pk=tasca.pk).update(batec=timezone.now() - timedelta(seconds=3600))
+
+    def test_cataleg(self):
+        # cap fila té ISBN: només la clau natural evitaria duplicats
+        tasca = self.encuar("importar_cataleg", "cataleg.csv", "titol,autor\n" + "".join(
+            f"Títol {i},Autora {i}\n" for i in range(5)
+        ) + ",Sense títol\n")
+        self.morir_al_segon_lot(tasca)
+        self.assertEqual(Llibre.objects.count(), 2)
+        self.assertEqual(Tasca.objects.values_list("estat", "processades", "creades").get(), (Tasca.EN_CURS, 2, 2))
+
+        tasques.executar(tasques.reclamar("nou"))
+        tasca.refresh_from_db()
+        self.assertEqual((tasca.estat, tasca.intents), (Tasca.COMPLETADA, 2))
+        self.assertEqual((tasca.processades, tasca.creades), (6, 5))
+        self.assertEqual(tasca.errors, [{"fila": 6, "error": "Falta el títol"}])
+        self.assertEqual(
+            sorted(Llibre.objects.values_list("titol", flat=True)), [f"Títol {i}" for i in range(5)],
+        )
+
+    def test_usuaris(self):
+        capcalera = "nom,cognom1,cognom2,email,telefon,centre,grup\n"
+        tasca = self.encuar("importar_usuaris", "usuaris.csv", capcalera + "".join(
+            f"Nom,Puig,Vila,usuari{i}@exemple.cat,60000000{i},Centre,1r\n" for i in range(5)
+        ))
+        self.morir_al_segon_lot(tasca)
+        self.assertEqual(Usuari.objects.filter(username__startswith="usuari").count(), 2)
+
+        tasques.executar(tasques.reclamar("nou"))
+        tasca.refresh_from_db()
+        self.assertEqual((tasca.estat, tasca.processades, tasca.creades), (Tasca.COMPLETADA, 5, 5))
+        # cap "ya existe" pels usuaris creats en el primer intent
+        self.assertEqual(tasca.errors, [])
+        self.assertEqual(Usuari.objects.filter(username__startswith="usuari").count(), 5)
+
+
+class GenerarDatosTest(TestCase):
+    """generar_datos --scale: la mateixa llavor dona les mateixes dades."""
+
+    def generar(self, workers):
+        with contextlib.redirect_stdout(io.StringIO()):
+            call_command("generar_datos", scale=1, seed=7, workers=workers, lote=700, stdout=io.StringIO())
+        # sense pk: SQLite no les reutilitza després de buidar les taules
+        return {
+            "llibres": list(Llibre.objects.order_by("pk").values_list(
+                "titol", "ISBN", "autor__nom", "editorial__nom", "data_edicio")),
+            "tags": sorted(Cataleg.tags.through.objects.values_list("cataleg__titol", "categoria__nom")),
+            "exemplars": list(Exemplar.objects.order_by("pk").values_list("registre", "cataleg__titol", "centre__nom")),
+            "usuaris": list(Usuari.objects.order_by("pk").values_list("username", "centre__nom")),
+            "prestecs": list(Prestec.objects.order_by("pk").values_list(
+                "exemplar__registre", "usuari__username", "data_prestec", "data_retorn")),
+            "reserves": list(Reserva.objects.order_by("pk").values_list("cataleg__titol", "usuari__username")),
+        }
+
+    def test_un_o_dos_processos(self):
+        un = self.generar(workers=1)
+        self.assertEqual(len(un["llibres"]), 1000)
+        self.assertTrue(un["tags"] and un["prestecs"])
+        # les dates generades, no la d'avui (data_prestec és auto_now_add)
+        self.assertFalse(Prestec.objects.filter(data_retorn__lt=F("data_prestec")).exists())
+        self.assertFalse(Prestec.objects.filter(data_prestec__gte=date(2025, 1, 1)).exists())
+        self.assertGreater(len({fila[2] for fila in un["prestecs"]}), 100)
+        tam = {
+            "usuarios": Usuari.objects.filter(is_staff=False, is_superuser=False).count(),
+            "disponibles": Exemplar.objects.filter(baixa=False, exclos_prestec=False).count(),
+        }
+        generats = generar_datos._generar_lote(("prestamos", 7, 0, 0, 500, tam))
+        self.assertEqual(
+            [(fila[2], fila[3]) for fila in un["prestecs"]],
+            [(fila["data_prestec"], fila["data_retorn"]) for fila in generats],
+        )
+        # el segon, com a MySQL: bulk_create no retorna les pk
+        with mock.patch.object(type(connection.features), "can_return_rows_from_bulk_insert", False):
+            dos = self.generar(workers=2)
+        for clau in un:
+            self.assertEqual(un[clau], dos[clau], clau)
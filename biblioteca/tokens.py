@@ -0,0 +1,181 @@
+import copy
+import hashlib
+import hmac
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth import authenticate
+from django.utils import timezone
+
+from .models import TokenAcces, Usuari
+
+
+# Tokens Bearer de l'API
+#
+# A la base de dades només hi ha el sha256 del token, amb índex únic, de
+# manera que resoldre'l és una cerca per clau. Davant hi ha una cache en
+# memòria del procés (LRU amb TTL curt) per no tocar la base de dades a cada
+# petició. Revocar un token l'esborra de la cache del procés; els altres
+# processos el deixen d'acceptar com a molt passat API_TOKEN_CACHE_TTL.
+# Desar un Usuari (is_staff, is_active...) també esborra els seus tokens de
+# la cache, i cada petició rep una còpia pròpia de l'usuari guardat: la
+# instància de la cache no es comparteix entre fils ni peticions.
+#
+# El token en clar és un HMAC de la llavor de la fila amb SECRET_KEY, així
+# que /token pot tornar el token vigent de l'usuari sense escriure res. Només
+# quan li queda menys d'API_TOKEN_ROTACIO es rota: la mateixa fila rep llavor,
+# hash i caducitat noves (UPDATE amb update_fields).
+#
+# Les credencials verificades es recorden uns segons (API_CREDENCIALS_TTL)
+# per no passar pel hasher (PBKDF2) a cada crida. Es guarda un HMAC de
+# l'usuari i la contrasenya, mai la contrasenya, i l'entrada deixa de valer
+# si l'usuari canvia la contrasenya o es desactiva.
+
+
+def hash_token(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def _hmac(missatge):
+    return hmac.new(settings.SECRET_KEY.encode(), missatge.encode(), hashlib.sha256).hexdigest()
+
+
+def token_de(llavor):
+    return _hmac(f"token:{llavor}")[:32]
+
+
+class _CacheTokens:
+    def __init__(self, maxim="API_TOKEN_CACHE_MAX"):
+        self._maxim = maxim
+        self._dades = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, clau):
+        with self._lock:
+            entrada = self._dades.get(clau)
+            if entrada is None:
+                return None
+            usuari, caduca = entrada
+            if caduca < time.monotonic():
+                del self._dades[clau]
+                return None
+            self._dades.move_to_end(clau)
+            return usuari
+
+    def set(self, clau, usuari, ttl):
+        maxim = getattr(settings, self._maxim, 10000)
+        with self._lock:
+            self._dades[clau] = (usuari, time.monotonic() + ttl)
+            self._dades.move_to_end(clau)
+            while len(self._dades) > maxim:
+                self._dades.popitem(last=False)
+
+    def esborrar(self, claus):
+        with self._lock:
+            for clau in claus:
+                self._dades.pop(clau, None)
+
+    def buidar(self):
+        with self._lock:
+            self._dades.clear()
+
+
+cache = _CacheTokens()
+credencials = _CacheTokens("API_CREDENCIALS_CACHE_MAX")
+
+
+def verificar(username, password):
+    """
+    authenticate() amb una cache curta de credencials verificades.
+    Retorna l'usuari o None.
+    """
+    clau = _hmac(f"credencials:{username}\0{password}")
+    guardat = credencials.get(clau)
+    if guardat is not None:
+        pk, hash_password = guardat
+        usuari = Usuari.objects.filter(pk=pk, is_active=True).first()
+        if usuari is not None and usuari.password == hash_password:
+            return usuari
+        credencials.esborrar([clau])
+
+    usuari = authenticate(username=username, password=password)
+    if usuari is not None:
+        credencials.set(clau, (usuari.pk, usuari.password),
+                        getattr(settings, "API_CREDENCIALS_TTL", 30))
+    return usuari
+
+
+def emetre(usuari):
+    """
+    Token en clar de l'usuari. Reaprofita el vigent si encara no toca
+    rotar-lo; si no, rota la fila més recent o en crea una.
+    """
+    ara = timezone.now()
+    rotacio = timedelta(seconds=getattr(settings, "API_TOKEN_ROTACIO", 24 * 3600))
+    fila = (
+        TokenAcces.objects.filter(usuari=usuari, revocat=False)
+        .exclude(llavor="")
+        .order_by("-expira")
+        .first()
+    )
+    if fila is not None and fila.expira > ara + rotacio:
+        return token_de(fila.llavor)
+
+    llavor = secrets.token_hex(16)
+    token = token_de(llavor)
+    expira = ara + timedelta(seconds=getattr(settings, "API_TOKEN_TTL", 7 * 24 * 3600))
+    if fila is None:
+        TokenAcces.objects.create(usuari=usuari, llavor=llavor, hash=hash_token(token), expira=expira)
+    else:
+        hash_anterior = fila.hash
+        fila.llavor, fila.hash, fila.expira = llavor, hash_token(token), expira
+        fila.save(update_fields=["llavor", "hash", "expira"])
+        cache.esborrar([hash_anterior])
+    return token
+
+
+def resoldre(token):
+    """Usuari del token, o None si no existeix, ha caducat o s'ha revocat."""
+    if not token:
+        return None
+    clau = hash_token(token)
+    usuari = cache.get(clau)
+    if usuari is not None:
+        return copy.copy(usuari)
+
+    fila = (
+        TokenAcces.objects.select_related("usuari")
+        .filter(hash=clau, revocat=False, expira__gt=timezone.now())
+        .first()
+    )
+    if fila is None or not fila.usuari.is_active:
+        return None
+    # la cache no pot allargar la vida del token
+    restant = (fila.expira - timezone.now()).total_seconds()
+    ttl = min(getattr(settings, "API_TOKEN_CACHE_TTL", 60), restant)
+    cache.set(clau, copy.copy(fila.usuari), ttl)
+    return fila.usuari
+
+
+def oblidar_usuari(usuari):
+    """Treu de la cache del procés els tokens de l'usuari."""
+    cache.esborrar(list(TokenAcces.objects.filter(usuari=usuari).values_list("hash", flat=True)))
+
+
+def revocar(token=None, usuari=None):
+    """Revoca un token concret o tots els d'un usuari."""
+    qs = TokenAcces.objects.filter(revocat=False)
+    if token is not None:
+        qs = qs.filter(hash=hash_token(token))
+    elif usuari is not None:
+        qs = qs.filter(usuari=usuari)
+    else:
+        return 0
+    hashes = list(qs.values_list("hash", flat=True))
+    revocats = TokenAcces.objects.filter(hash__in=hashes).update(revocat=True)
+    cache.esborrar(hashes)
+    return revocats
@@ -0,0 +1,110 @@
+from datetime import date, timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+
+from .models import Avis, Cataleg, Exemplar, PoliticaPrestec, Prestec, Usuari
+
+
+# Venciments dels préstecs
+#
+# Els dies de préstec surten de PoliticaPrestec segons el grup de l'usuari
+# i el tipus de material, de la més específica a la més general:
+# (grup, tipus), (grup, tots), (tots, tipus), (tots, tots) i, si no n'hi ha
+# cap, settings.PRESTECS_DIES. La data de venciment es fixa en crear el
+# préstec (prestecs.py).
+#
+# processar() busca els préstecs oberts vençuts amb l'índex parcial
+# prestec_obert_venciment_idx, que només conté els oberts, i els recorre per
+# lots amb keyset (data_venciment, id): l'historial de préstecs retornats no
+# es llegeix mai i la memòria no depèn de quants n'hi ha. Cada usuari rep un
+# sol Avis al dia amb tots els seus préstecs vençuts, per molts lots que
+# ocupin; darrer_avis evita repetir-los abans de PRESTECS_DIES_ENTRE_AVISOS.
+
+TIPUS = [tipus for tipus, _ in PoliticaPrestec.TIPUS]
+
+
+def tipus_de(cataleg_ids):
+    """{cataleg_id: tipus} en una consulta (un LEFT JOIN per cada subtaula)."""
+    resultat = {}
+    for pk, *fills in Cataleg.objects.filter(pk__in=cataleg_ids).values_list("pk", *TIPUS):
+        resultat[pk] = next((tipus for tipus, fill in zip(TIPUS, fills) if fill is not None), "")
+    return resultat
+
+
+def politiques():
+    """{(grup_id, tipus): dies}; grup None o tipus "" valen per a tots."""
+    return {
+        (grup_id, tipus): dies
+        for grup_id, tipus, dies in PoliticaPrestec.objects.order_by("-pk").values_list("grup_id", "tipus", "dies")
+    }
+
+
+def dies(taula, grup_id, tipus):
+    for clau in ((grup_id, tipus), (grup_id, ""), (None, tipus), (None, "")):
+        if clau in taula:
+            return taula[clau]
+    return getattr(settings, "PRESTECS_DIES", 21)
+
+
+def assignar(prestecs):
+    """Omple data_venciment dels préstecs nous (encara sense desar)."""
+    prestecs = list(prestecs)
+    if not prestecs:
+        return
+    grups = dict(Usuari.objects.filter(pk__in={p.usuari_id for p in prestecs}).values_list("pk", "grup_id"))
+    catalegs = dict(Exemplar.objects.filter(pk__in={p.exemplar_id for p in prestecs}).values_list("pk", "cataleg_id"))
+    tipus = tipus_de(set(catalegs.values()))
+    taula = politiques()
+    for prestec in prestecs:
+        n = dies(taula, grups.get(prestec.usuari_id), tipus.get(catalegs.get(prestec.exemplar_id), ""))
+        prestec.data_venciment = (prestec.data_prestec or date.today()) + timedelta(days=n)
+
+
+def vencuts(avui):
+    """Préstecs oberts vençuts que no s'han avisat en els darrers dies."""
+    interval = timedelta(days=getattr(settings, "PRESTECS_DIES_ENTRE_AVISOS", 7))
+    return Prestec.objects.filter(
+        Q(darrer_avis__isnull=True) | Q(darrer_avis__lte=avui - interval),
+        data_retorn__isnull=True, data_venciment__lt=avui,
+    )
+
+
+def _avisar(lot, avui):
+    """Afegeix els préstecs del lot a l'avís del dia de cada usuari; retorna els avisos nous."""
+    usuaris = {usuari_id for _, usuari_id, _ in lot}
+    avisos = Avis.objects.filter(tipus=Avis.VENCIMENT, data=avui, usuari_id__in=usuaris)
+    nous = usuaris - set(avisos.values_list("usuari_id", flat=True))
+    Avis.objects.bulk_create(
+        [Avis(usuari_id=usuari_id, tipus=Avis.VENCIMENT, data=avui) for usuari_id in nous],
+        ignore_conflicts=True,
+    )
+    ids = dict(avisos.values_list("usuari_id", "pk"))
+    Through = Avis.prestecs.through
+    Through.objects.bulk_create(
+        [Through(avis_id=ids[usuari_id], prestec_id=pk) for pk, usuari_id, _ in lot],
+        ignore_conflicts=True,
+    )
+    Prestec.objects.filter(pk__in=[pk for pk, _, _ in lot]).update(darrer_avis=avui)
+    return len(nous)
+
+
+def processar(avui=None, mida_lot=1000):
+    """Genera els avisos de venciment del dia. Retorna (préstecs, avisos nous)."""
+    avui = avui or date.today()
+    pendents = vencuts(avui).order_by("data_venciment", "pk").values_list("pk", "usuari_id", "data_venciment")
+    n_prestecs = n_avisos = 0
+    darrer = None
+    while True:
+        qs = pendents
+        if darrer:
+            venciment, pk = darrer
+            qs = qs.filter(Q(data_venciment__gt=venciment) | Q(data_venciment=venciment, pk__gt=pk))
+        lot = list(qs[:mida_lot])
+        if not lot:
+            return n_prestecs, n_avisos
+        with transaction.atomic():
+            n_avisos += _avisar(lot, avui)
+        n_prestecs += len(lot)
+        darrer = lot[-1][2], lot[-1][0]